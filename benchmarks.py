@@ -0,0 +1,615 @@
+"""
+Heightmap pipeline benchmarks.
+
+Runs against synthetic terrain so no map files are needed:
+
+    python benchmarks.py smooth --size 4096 --sigma 2 5
+    python benchmarks.py dither --size 4096
+    python benchmarks.py tiles --size 2048
+    python benchmarks.py rules --size 2048 --rules 24
+    python benchmarks.py masks --size 2048 --mask-size 1024
+    python benchmarks.py slope --size 4096
+    python benchmarks.py repaint --size 4096 --rules 16
+    python benchmarks.py variants --size 2048
+    python benchmarks.py tiled --size 4096 --tile 512
+    python benchmarks.py layers --size 4096
+    python benchmarks.py flags --zones 16 --depth 7
+"""
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from PIL import Image, ImageFilter
+from scipy.ndimage import gaussian_filter
+
+from world_builder import (AutoPainter, AutoPainterSession, HG2Codec, HG2Exporter, HG2File, HeightmapCache,
+                           HeightmapDither, HeightmapFilters, MaskCache, TerrainLayers, load_height16)
+
+
+def synthetic_terrain(size, seed=0):
+    """Multi-octave value noise in 16-bit space (0-65535) with gentle slopes and ridges."""
+    rng = np.random.default_rng(seed)
+    acc = np.zeros((size, size), dtype=np.float32)
+    amp = 1.0
+    cells = 4
+    while cells <= max(4, size // 4):
+        noise = rng.random((cells, cells), dtype=np.float32)
+        layer = Image.fromarray(noise, mode="F").resize((size, size), Image.Resampling.BICUBIC)
+        acc += np.array(layer) * amp
+        amp *= 0.5
+        cells *= 2
+    acc -= acc.min()
+    acc /= acc.max()
+    return (acc * 65535).astype(np.uint16)
+
+
+def timed(fn, *args, repeat=3, **kwargs):
+    """Best-of-N wall time in seconds and the last result."""
+    best = None
+    result = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn(*args, **kwargs)
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    return best, result
+
+
+def rms(a, b):
+    d = a.astype(np.float64) - b.astype(np.float64)
+    return float(np.sqrt(np.mean(d * d)))
+
+
+def legacy_smooth_8bit(arr, sigma):
+    """The pre-float32 export path: 16-bit -> 8-bit RGB -> Pillow blur -> L -> x256."""
+    img = Image.fromarray((arr / 256).astype(np.uint8)).convert("RGB")
+    img = img.filter(ImageFilter.GaussianBlur(sigma))
+    return np.array(img.convert("L")).astype(np.float32) * 256
+
+
+def bench_smooth(args):
+    src = synthetic_terrain(args.size).astype(np.float32)
+    mpix = src.size / 1e6
+    print(f"Gaussian smoothing, {args.size}x{args.size} ({mpix:.1f} MPix), error in 13-bit HG2 steps")
+    print(f"{'sigma':>6} {'path':<22} {'time ms':>9} {'MPix/s':>8} {'RMS err':>8} {'max err':>8}")
+
+    for sigma in args.sigma:
+        ref = gaussian_filter(src.astype(np.float64), sigma, mode="nearest")
+        ref_q = HG2Codec.quantize(ref, 13)
+
+        rows = [("8-bit Pillow (legacy)", lambda: legacy_smooth_8bit(src, sigma))]
+        for bands in args.bands:
+            rows.append((f"float32, {bands} band(s)",
+                         lambda b=bands: HeightmapFilters.gaussian_smooth(src, sigma, bands=b)))
+
+        baseline = None
+        for name, fn in rows:
+            dt, out = timed(fn, repeat=args.repeat)
+            q = HG2Codec.quantize(out, 13)
+            err = np.abs(q.astype(np.int32) - ref_q.astype(np.int32))
+            print(f"{sigma:>6g} {name:<22} {dt * 1000:>9.1f} {mpix / dt:>8.1f} {rms(q, ref_q):>8.3f} {err.max():>8d}")
+            if name.startswith("float32"):
+                if baseline is None:
+                    baseline = out
+                elif not np.array_equal(baseline, out):
+                    print("       !! band results differ")
+
+
+def slope_rms(q, ref, step, sigma=0.0):
+    """RMS gradient error (height steps per pixel); sigma > 0 low-passes both first."""
+    a = q.astype(np.float64)
+    b = ref.astype(np.float64) / step
+    if sigma > 0:
+        a = gaussian_filter(a, sigma, mode="nearest")
+        b = gaussian_filter(b, sigma, mode="nearest")
+    ay, ax = np.gradient(a)
+    by, bx = np.gradient(b)
+    return float(np.sqrt(np.mean((ay - by) ** 2 + (ax - bx) ** 2)))
+
+
+def quantize_strips(src, bits, mode, zone):
+    """Quantize the way HG2Exporter does: one zone row at a time."""
+    out = np.empty(src.shape, dtype=np.uint16)
+    state = {}
+    for y0 in range(0, src.shape[0], zone):
+        out[y0 : y0 + zone] = HeightmapDither.quantize(src[y0 : y0 + zone], bits, mode, y0, state)
+    return out
+
+
+def bench_dither(args):
+    # Gentle slopes are where terracing shows, so flatten the synthetic terrain a lot
+    src = synthetic_terrain(args.size).astype(np.float32) * 0.05 + 20000
+    step = 65536 >> args.bits
+    mpix = src.size / 1e6
+    print(f"Dithered quantization to {args.bits}-bit, {args.size}x{args.size} ({mpix:.1f} MPix), {args.zone}-row strips")
+    print(f"Slope error in {args.bits}-bit steps/pixel: raw, and after a sigma={args.lowpass:g} low-pass (what terracing looks like)")
+    print(f"{'mode':<10} {'time ms':>9} {'MPix/s':>8} {'x plain':>8} {'slope RMS':>10} {'low-pass':>9} {'mean err':>9}")
+
+    plain = None
+    for mode in HeightmapDither.MODES:
+        dt, q = timed(quantize_strips, src, args.bits, mode, args.zone, repeat=args.repeat)
+        plain = plain or dt
+        mean_err = float(q.mean() - src.mean() / step)
+        print(f"{mode:<10} {dt * 1000:>9.1f} {mpix / dt:>8.1f} {dt / plain:>8.2f} "
+              f"{slope_rms(q, src, step):>10.4f} {slope_rms(q, src, step, args.lowpass):>9.4f} {mean_err:>+9.3f}")
+
+
+def legacy_tile_loop(vertex_mats):
+    """The per-tile Python loop generate_mat used before tile_vertex_mats (kept as the reference)."""
+    h, w = vertex_mats.shape
+    mat_h, mat_w = h // 2, w // 2
+    mat_data = np.zeros((mat_h, mat_w), dtype=np.uint16)
+    corner_rot = {8: 0, 4: 3, 2: 2, 1: 1}
+    side_rot = {12: 0, 6: 3, 3: 2, 9: 1}
+    for y in range(mat_h):
+        for x in range(mat_w):
+            colors = [vertex_mats[y*2, x*2], vertex_mats[y*2, x*2+1],
+                      vertex_mats[y*2+1, x*2+1], vertex_mats[y*2+1, x*2]]
+            unique_mats = sorted(list(set(colors)))
+            base_mat = unique_mats[0]
+            next_mat = unique_mats[-1] if len(unique_mats) > 1 else base_mat
+            if base_mat == next_mat:
+                mat_data[y, x] = AutoPainter.encode_entry(base_mat, base_mat, cap=0, flip=0, rot=0, variant=0)
+                continue
+            mask = 0
+            if colors[0] == next_mat: mask |= 8
+            if colors[1] == next_mat: mask |= 4
+            if colors[2] == next_mat: mask |= 2
+            if colors[3] == next_mat: mask |= 1
+            cap = flip = rot = 0
+            if mask in corner_rot:
+                rot = corner_rot[mask]
+            elif mask in side_rot:
+                flip, rot = 1, side_rot[mask]
+            elif mask == 10:
+                cap = 1
+            elif mask == 5:
+                cap, flip = 1, 1
+            elif mask in (7, 11, 13, 14):
+                base_mat, next_mat = next_mat, base_mat
+                rot = corner_rot[(~mask) & 15]
+            mat_data[y, x] = AutoPainter.encode_entry(base_mat, next_mat, cap, flip, rot, variant=0)
+    return mat_data
+
+
+def synthetic_vertex_mats(size, materials, seed=0):
+    """Banded materials from synthetic terrain plus speckle, so every corner mask shows up."""
+    terrain = synthetic_terrain(size, seed).astype(np.float32)
+    mats = np.minimum((terrain / 65536.0 * materials).astype(np.uint8), materials - 1)
+    rng = np.random.default_rng(seed + 1)
+    speckle = rng.random(mats.shape) < 0.05
+    mats[speckle] = rng.integers(0, materials, int(speckle.sum()), dtype=np.uint8)
+    return mats
+
+
+def bench_tiles(args):
+    mats = synthetic_vertex_mats(args.size, args.materials)
+    tiles = (args.size // 2) ** 2
+    print(f"Marching-squares MAT tiling, {args.size}x{args.size} vertices -> {tiles / 1e6:.2f} M tiles, {args.materials} materials")
+    dt_new, new = timed(AutoPainter.tile_vertex_mats, mats, repeat=args.repeat)
+    dt_old, old = timed(legacy_tile_loop, mats, repeat=1)
+    print(f"{'per-tile loop':<16} {dt_old * 1000:>10.1f} ms")
+    print(f"{'vectorized':<16} {dt_new * 1000:>10.1f} ms   ({dt_old / dt_new:.0f}x)")
+    print("byte-identical:", new.tobytes() == old.tobytes())
+
+
+def sequential_rules(height_data, slope_map, rules, bzn_paths=None):
+    """Reference painter's algorithm: one full-size mask and assignment per rule."""
+    vertex_mats = np.zeros(height_data.shape, dtype=np.uint8)
+    for rule in rules:
+        vertex_mats[AutoPainter.rule_mask(rule, height_data, slope_map, bzn_paths)] = rule['mat_id']
+    return vertex_mats
+
+
+def random_rules(rng, heights, slopes, count, mask_paths=()):
+    """Bounds are often drawn from the data itself so exact-equality edges get exercised."""
+    def bound(data, lo, hi):
+        if rng.random() < 0.5:
+            return float(data.flat[rng.integers(data.size)])
+        return float(rng.uniform(lo, hi))
+
+    rules = []
+    for _ in range(count):
+        min_h, max_h = sorted((bound(heights, -10, 4200), bound(heights, -10, 4200)))
+        min_s, max_s = sorted((bound(slopes, 0, 90), bound(slopes, 0, 90)))
+        if rng.random() < 0.1:
+            min_h, max_h = max_h, min_h  # empty range
+        rule = {"mat_id": int(rng.integers(0, 16)), "min_h": min_h, "max_h": max_h,
+                "min_s": min_s, "max_s": max_s, "mask_path": ""}
+        if mask_paths and rng.random() < 0.2:
+            rule["mask_path"] = str(rng.choice(list(mask_paths)))
+        rules.append(rule)
+    return rules
+
+
+def bench_rules(args):
+    rng = np.random.default_rng(args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        # Masks: a real image, a missing file and a PATH: label without paths (both fall back to unmasked)
+        mask_img = os.path.join(tmp, "mask.png")
+        Image.fromarray(((synthetic_terrain(256, 5) >> 8) > 127).astype(np.uint8) * 255).save(mask_img)
+        mask_paths = (mask_img, os.path.join(tmp, "missing.png"), "PATH:road")
+
+        failures = 0
+        for trial in range(args.trials):
+            size = int(rng.integers(8, 96))
+            dtype = (np.float32, np.float64, np.uint16)[trial % 3]
+            heights = (synthetic_terrain(size, trial).astype(np.float64) / 16).astype(dtype)
+            if dtype == np.float32 and trial % 2:
+                heights[::7] = heights[0, 0]  # repeated values on a breakpoint
+            slopes = AutoPainter.calculate_slope_map(heights)
+            rules = random_rules(rng, heights, slopes, int(rng.integers(1, 30)), mask_paths)
+            ref = sequential_rules(heights, slopes, rules)
+            got = AutoPainter.classify_vertices(heights, slopes, rules)
+            if not np.array_equal(ref, got):
+                failures += 1
+                print(f"  trial {trial}: {int((ref != got).sum())} vertices differ ({dtype.__name__}, {len(rules)} rules)")
+        print(f"Equivalence: {args.trials - failures}/{args.trials} random rule sets identical to sequential evaluation")
+
+        heights = (synthetic_terrain(args.size).astype(np.float32) / 16)
+        slopes = AutoPainter.calculate_slope_map(heights)
+        rules = random_rules(rng, heights, slopes, args.rules, (mask_img,) if args.masked else ())
+        masked = sum(1 for r in rules if r["mask_path"])
+        print(f"Vertex classification, {args.size}x{args.size}, {len(rules)} rules ({masked} masked)")
+        dt_old, ref = timed(sequential_rules, heights, slopes, rules, repeat=args.repeat)
+        dt_new, got = timed(AutoPainter.classify_vertices, heights, slopes, rules, repeat=args.repeat)
+        print(f"{'sequential':<12} {dt_old * 1000:>9.1f} ms")
+        print(f"{'lookup table':<12} {dt_new * 1000:>9.1f} ms   ({dt_old / dt_new:.1f}x)   identical: {np.array_equal(ref, got)}")
+
+
+def bench_masks(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "mask.png")
+        Image.fromarray((synthetic_terrain(args.mask_size, 3) >> 8).astype(np.uint8)).save(path)
+        shape = (args.size, args.size)
+        cache = MaskCache(max_bytes=args.cap << 20)
+
+        def uncached():
+            img = Image.open(path).convert("L").resize((args.size, args.size), Image.Resampling.BILINEAR)
+            return np.array(img) > 127
+
+        dt_old, ref = timed(uncached, repeat=args.repeat)
+        dt_cold, _ = timed(lambda: MaskCache(args.cap << 20).get(path, shape), repeat=args.repeat)
+        cache.get(path, shape)
+        dt_hit, got = timed(cache.get, path, shape, repeat=args.repeat)
+        print(f"Mask {args.mask_size}x{args.mask_size} -> {args.size}x{args.size}")
+        print(f"{'uncached':<10} {dt_old * 1000:>9.2f} ms")
+        print(f"{'miss':<10} {dt_cold * 1000:>9.2f} ms")
+        print(f"{'hit':<10} {dt_hit * 1000:>9.2f} ms   ({dt_old / dt_hit:.1f}x)   identical: {np.array_equal(ref, got)}")
+        print(f"packed {cache.nbytes / 1024:.0f} KiB vs {ref.nbytes / 1024:.0f} KiB as bool")
+
+
+def bench_slope(args):
+    heights = synthetic_terrain(args.size).astype(np.float32) / 16
+    spacing = args.spacing
+
+    def legacy():
+        gy, gx = np.gradient(heights.astype(np.float64))
+        return np.degrees(np.arctan(np.sqrt(gx**2 + gy**2)))
+
+    dt_old, _ = timed(legacy, repeat=args.repeat)
+    print(f"Slope field, {args.size}x{args.size}, {spacing} m grid, 0.1 m height steps")
+    print(f"{'legacy f64':<12} {dt_old * 1000:>9.1f} ms   (unit spacing)")
+    for kernel in ("central", "horn", "sobel"):
+        dt, slope = timed(AutoPainter.calculate_slope_map, heights, 0.1, spacing, kernel, repeat=args.repeat)
+        print(f"{kernel:<12} {dt * 1000:>9.1f} ms   median {np.median(slope):5.2f} deg, max {slope.max():5.2f} deg")
+    entry = {"key": ("synthetic.png",), "heights": heights, "extras": {"paint_heights": heights}}
+    HeightmapCache.slope(entry, spacing)
+    dt_hit, _ = timed(HeightmapCache.slope, entry, spacing, repeat=args.repeat)
+    print(f"{'cached rerun':<12} {dt_hit * 1000:>9.3f} ms")
+
+
+def bench_repaint(args):
+    rng = np.random.default_rng(args.seed)
+    heights = synthetic_terrain(args.size).astype(np.float32) / 16
+    slopes = AutoPainter.calculate_slope_map(heights, 0.1, 10.0)
+    rules = random_rules(rng, heights, slopes, args.rules)
+    session = AutoPainterSession()
+
+    print(f"Rule-tuning reruns, {args.size}x{args.size}, {len(rules)} rules")
+    dt_full, _ = timed(AutoPainter.generate_mat, heights, rules, slope_map=slopes, repeat=1)
+    print(f"{'generate_mat':<22} {dt_full * 1000:>9.1f} ms")
+    dt, _ = timed(session.paint, heights, slopes, rules, repeat=1)
+    print(f"{'session, first run':<22} {dt * 1000:>9.1f} ms")
+
+    identical = True
+    for step in range(args.edits):
+        rules = [dict(r) for r in rules]
+        r = rules[int(rng.integers(len(rules)))]
+        if step % 3 == 2:
+            r["max_s"] += float(rng.normal(0, 0.5))
+            label = "slope nudge"
+        else:
+            r["min_h"] += float(rng.normal(0, args.nudge))
+            label = "height nudge"
+        dt, mat = timed(session.paint, heights, slopes, rules, repeat=1)
+        identical &= np.array_equal(mat, AutoPainter.generate_mat(heights, rules, slope_map=slopes))
+        if session.last_dirty is None:
+            print(f"{label:<22} {dt * 1000:>9.1f} ms   full repaint")
+        else:
+            print(f"{label:<22} {dt * 1000:>9.1f} ms   {session.last_dirty} vertices, {session.last_tiles} tiles")
+    print(f"identical to generate_mat after every edit: {identical}")
+
+
+def per_tile_variants(mat_data, solid_variants, seed):
+    """Plain (no anti-repeat) variant pick with Python ints per tile, as the reference for assign_variants."""
+    mask = 0xFFFFFFFF
+    out = mat_data.copy()
+    for y in range(mat_data.shape[0]):
+        for x in range(mat_data.shape[1]):
+            entry = int(mat_data[y, x])
+            base = entry >> 12
+            if base != (entry >> 8) & 0xF:
+                continue
+            found = sorted(solid_variants.get(base, {})) or [0]
+            h = ((y * 0x9E3779B1) & mask) ^ ((x * 0x85EBCA77) & mask)
+            h ^= (base * 0xC2B2AE3D) & mask
+            h ^= (seed * 0x27D4EB2F) & mask
+            h ^= h >> 16
+            h = (h * 0x85EBCA6B) & mask
+            h ^= h >> 13
+            h = (h * 0xC2B2AE35) & mask
+            h ^= h >> 16
+            out[y, x] = entry | found[h % len(found)]
+    return out
+
+
+def repeated_neighbours(mat_data, solid_variants):
+    """Same-material solid 4-neighbour pairs showing the same map file (materials with 2+ maps only)."""
+    codes, looks, counts = AutoPainter.variant_table(solid_variants)
+    look_of = np.zeros((16, 4), dtype=np.uint8)
+    for m in range(16):
+        look_of[m, codes[m, :counts[m]]] = looks[m, :counts[m]]
+    base = (mat_data >> 12) & 0xF
+    solid = (base == ((mat_data >> 8) & 0xF)) & (looks.max(axis=1) > 0)[base]
+    shown = look_of[base, mat_data & 3]
+    total = 0
+    for a, b in (((slice(1, None),), (slice(None, -1),)), ((slice(None), slice(1, None)), (slice(None), slice(None, -1)))):
+        total += int((solid[a] & solid[b] & (base[a] == base[b]) & (shown[a] == shown[b])).sum())
+    return total
+
+
+def bench_variants(args):
+    heights = synthetic_terrain(args.size).astype(np.float32) / 16
+    slopes = AutoPainter.calculate_slope_map(heights, 0.1, 10.0)
+    rules = random_rules(np.random.default_rng(args.seed), heights, slopes, args.materials)
+    mat = AutoPainter.generate_mat(heights, rules, slope_map=slopes)
+    # Material m gets m % 4 + 1 distinct maps, like the stock TRNs (A-only up to A-D)
+    variants = {m: {v: f"t{m}s{v}.map" for v in range(m % 4 + 1)} for m in range(args.materials)}
+
+    print(f"Solid variant assignment, {mat.shape[1]}x{mat.shape[0]} tiles, {args.materials} materials")
+    dt_new, new = timed(AutoPainter.assign_variants, mat, variants, args.seed, repeat=args.repeat)
+    dt_anti, anti = timed(AutoPainter.assign_variants, mat, variants, args.seed, True, repeat=args.repeat)
+    rows = max(1, mat.shape[0] // 8)
+    dt_old, old = timed(per_tile_variants, mat[:rows], variants, args.seed, repeat=1)
+    dt_old *= mat.shape[0] / rows
+    print(f"{'per-tile loop':<16} {dt_old * 1000:>10.1f} ms   (extrapolated from {rows} rows)")
+    print(f"{'vectorized':<16} {dt_new * 1000:>10.1f} ms   ({dt_old / dt_new:.0f}x)")
+    print(f"{'+ anti-repeat':<16} {dt_anti * 1000:>10.1f} ms")
+    print("matches per-tile reference:", np.array_equal(new[:rows], old))
+    print(f"repeated neighbours: {repeated_neighbours(new, variants)} plain, {repeated_neighbours(anti, variants)} anti-repeat")
+
+
+def traced(fn, *args, **kwargs):
+    """Wall time in seconds, peak traced allocation in bytes and the result (one run)."""
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    result = fn(*args, **kwargs)
+    dt = time.perf_counter() - t0
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return dt, peak, result
+
+
+def in_memory_mat(path, out_path, rules, kernel):
+    """The in-memory paint the app runs: detile, paint heights, slope, generate_mat, write."""
+    with HG2File(path) as hg:
+        raw = hg.detile()
+    heights = HeightmapCache.to_paint_heights(raw, HG2Codec.HG2_BITS)
+    del raw
+    slopes = AutoPainter.calculate_slope_map(heights, 0.1, 10.0, kernel)
+    mat = AutoPainter.generate_mat(heights, rules, slope_map=slopes)
+    mat.tofile(out_path)
+
+
+def tiled_mat(path, out_path, rules, kernel, tile):
+    with HG2File(path) as hg:
+        AutoPainter.generate_mat_tiled(hg, rules, out_path, spacing=10.0, kernel=kernel, tile=tile)
+
+
+def bench_tiled(args):
+    size = args.size // 128 * 128
+    raw = HG2Codec.quantize(synthetic_terrain(size).astype(np.float32), 13)
+    heights = HeightmapCache.to_paint_heights(raw, HG2Codec.HG2_BITS)
+    rules = random_rules(np.random.default_rng(args.seed), heights, AutoPainter.calculate_slope_map(heights, 0.1, 10.0), args.rules)
+    del heights
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "map.hg2")
+        with open(path, "wb") as f:
+            f.write(HG2Codec.HEADER.pack(1, 7, size // 128, size // 128, 10, 0))
+            HG2Codec.encode_zones(raw, 128).tofile(f)
+        del raw
+
+        print(f"AutoPainter on a {size}x{size} HG2, {len(rules)} rules, {args.kernel} slope")
+        ref_path, out_path = os.path.join(tmp, "ref.mat"), os.path.join(tmp, "tiled.mat")
+        dt, peak, _ = traced(in_memory_mat, path, ref_path, rules, args.kernel)
+        print(f"{'in memory':<16} {dt * 1000:>9.1f} ms   peak {peak / 1048576:>7.1f} MB")
+        for tile in args.tile:
+            dt, peak, _ = traced(tiled_mat, path, out_path, rules, args.kernel, tile)
+            with open(ref_path, "rb") as a, open(out_path, "rb") as b:
+                same = a.read() == b.read()
+            print(f"{f'tiled {tile}':<16} {dt * 1000:>9.1f} ms   peak {peak / 1048576:>7.1f} MB   identical: {same}")
+
+
+def bench_layers(args):
+    raw = synthetic_terrain(args.size)
+    layers = TerrainLayers()
+    layers.bind(("synthetic", args.size), lambda y0, y1, x0, x1: raw[y0:y1, x0:x1], raw.shape, None, args.spacing)
+    shape = raw.shape
+    proxy = TerrainLayers.proxy_factor(shape)
+
+    print(f"Hydrology layers, {args.size}x{args.size} at {args.spacing} m (proxy 1/{proxy})")
+    z = TerrainLayers.proxy_heights(layers.source[1], shape, None, proxy)
+    dt, (filled, _) = timed(TerrainLayers.fill_depressions, z, repeat=1)
+    print(f"{'depression fill':<22} {dt * 1000:>9.1f} ms   {np.count_nonzero(filled > z) * 100 / z.size:5.1f}% of cells filled")
+    dt, fields = timed(layers.fields, repeat=1)
+    print(f"{'fields, first':<22} {dt * 1000:>9.1f} ms")
+    dt, _ = timed(layers.fields, repeat=1)
+    print(f"{'fields, cached':<22} {dt * 1000:>9.1f} ms")
+    for spec in args.specs:
+        dt, mask = timed(layers.mask, spec, shape, repeat=1)
+        dt_hit, _ = timed(layers.mask, spec, shape, repeat=1)
+        print(f"{spec:<22} {dt * 1000:>9.1f} ms   cached {dt_hit * 1000:>6.1f} ms   covers {mask.mean() * 100:5.1f}%")
+    print(f"flow: up to {np.expm1(fields['flow'].max()):.0f} cells; twi {fields['twi'].min():.1f}..{fields['twi'].max():.1f}")
+
+
+def flags_round_trip(tmp, ext, bits, zones, zone, keep_flags, seed=0):
+    """
+    Random heights + flags -> HG2/HGT -> lossless 16-bit PNG (as HG2 -> PNG writes it)
+    -> HG2Exporter with the flags re-merged from the source. Returns (source bytes, output bytes, time).
+    """
+    rng = np.random.default_rng(seed)
+    size = zones * zone
+    heights = rng.integers(0, 1 << bits, (size, size), dtype=np.uint16)
+    flags = rng.integers(0, 1 << (16 - bits), (size, size), dtype=np.uint16)
+    src_path = os.path.join(tmp, "map" + ext)
+    header = None if ext == ".hgt" else HG2Codec.HEADER.pack(1, zone.bit_length() - 1, zones, zones, 10, 0)
+    with open(src_path, "wb") as f:
+        if header:
+            f.write(header)
+        HG2Codec.encode_zones(HG2Codec.merge(heights, flags, bits), zone).tofile(f)
+
+    t0 = time.perf_counter()
+    png_path = os.path.join(tmp, "map_edit.png")
+    with HG2File(src_path, zones, zones) as hg:
+        img_array = hg.detile() & np.uint16(HG2Codec.height_mask(bits))
+    Image.fromarray((img_array.astype(np.uint32) << (16 - bits)).astype(np.uint16)).convert("I;16").save(png_path)
+
+    out_path = os.path.join(tmp, "map_edit_export" + ext)
+    plane = HG2Exporter.open_flags(src_path, out_path, zones, zones, zone) if keep_flags else None
+    cfg = {"brightness": 1.0, "contrast": 1.0, "smooth": 0, "dither": "none", "incremental": False}
+    HG2Exporter.write(load_height16(png_path), out_path, zone, cfg, bits, header=header, flags=plane)
+    dt = time.perf_counter() - t0
+    if plane is not None:
+        assert plane.raw is None, "flag source left open after the export"
+    with open(src_path, "rb") as a, open(out_path, "rb") as b:
+        return a.read(), b.read(), dt
+
+
+def bench_flags(args):
+    zone = 1 << args.depth
+    print(f"Flag round trip, {args.zones}x{args.zones} zones of {zone}px: source -> 16-bit PNG -> export")
+    print(f"{'format':<8} {'keep_flags':<11} {'time ms':>9}  result")
+    failed = False
+    for ext, bits, zone_size in ((".hg2", HG2Codec.HG2_BITS, zone), (".hgt", HG2Codec.HGT_BITS, HG2File.HGT_ZONE)):
+        for keep in (True, False):
+            with tempfile.TemporaryDirectory() as tmp:
+                src, out, dt = flags_round_trip(tmp, ext, bits, args.zones, zone_size, keep)
+            head = 0 if ext == ".hgt" else HG2Codec.HEADER.size
+            src_raw = np.frombuffer(src[head:], dtype="<u2")
+            out_raw = np.frombuffer(out[head:], dtype="<u2")
+            if keep:
+                ok = src == out
+                result = "byte-identical" if ok else f"{int(np.count_nonzero(src_raw != out_raw))} words differ"
+            else:
+                height_mask = np.uint16(HG2Codec.height_mask(bits))
+                ok = (src[:head] == out[:head] and not (out_raw & ~height_mask).any()
+                      and np.array_equal(src_raw & height_mask, out_raw))
+                result = "flags zeroed, heights identical" if ok else "MISMATCH"
+            failed |= not ok
+            print(f"{ext[1:].upper():<8} {str(keep):<11} {dt * 1000:>9.1f}  {result}")
+    if failed:
+        raise SystemExit("flag round trip failed")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("smooth", help="float32 banded Gaussian vs the 8-bit Pillow path")
+    p.add_argument("--size", type=int, default=4096)
+    p.add_argument("--sigma", type=float, nargs="+", default=[2.0, 5.0])
+    p.add_argument("--bands", type=int, nargs="+", default=[1, 4, 16])
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=bench_smooth)
+
+    p = sub.add_parser("dither", help="dithered 12/13-bit quantization: throughput and slope error")
+    p.add_argument("--size", type=int, default=4096)
+    p.add_argument("--bits", type=int, choices=[12, 13], default=13)
+    p.add_argument("--zone", type=int, default=128)
+    p.add_argument("--lowpass", type=float, default=2.0)
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=bench_dither)
+
+    p = sub.add_parser("tiles", help="vectorized marching-squares tiling vs the per-tile loop")
+    p.add_argument("--size", type=int, default=1024)
+    p.add_argument("--materials", type=int, default=5)
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=bench_tiles)
+
+    p = sub.add_parser("rules", help="compiled (height, slope) rule table vs sequential rules, plus an equivalence check")
+    p.add_argument("--size", type=int, default=2048)
+    p.add_argument("--rules", type=int, default=24)
+    p.add_argument("--masked", action="store_true", help="let some timed rules use an image mask")
+    p.add_argument("--trials", type=int, default=200)
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=bench_rules)
+
+    p = sub.add_parser("masks", help="cached packed rule masks vs re-reading and resizing the image")
+    p.add_argument("--size", type=int, default=2048)
+    p.add_argument("--mask-size", type=int, default=1024)
+    p.add_argument("--cap", type=int, default=64, help="cache cap in MB")
+    p.add_argument("--repeat", type=int, default=5)
+    p.set_defaults(func=bench_masks)
+
+    p = sub.add_parser("slope", help="float32 slope kernels at real grid spacing vs the old float64 unit-spacing pass")
+    p.add_argument("--size", type=int, default=4096)
+    p.add_argument("--spacing", type=float, default=10.0, help="grid spacing in meters")
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=bench_slope)
+
+    p = sub.add_parser("repaint", help="incremental AutoPainterSession reruns after small rule edits vs generate_mat")
+    p.add_argument("--size", type=int, default=4096)
+    p.add_argument("--rules", type=int, default=16)
+    p.add_argument("--edits", type=int, default=6)
+    p.add_argument("--nudge", type=float, default=5.0, help="height nudge size (painter units)")
+    p.add_argument("--seed", type=int, default=0)
+    p.set_defaults(func=bench_repaint)
+
+    p = sub.add_parser("variants", help="seeded solid-variant assignment with and without anti-repeat vs a per-tile loop")
+    p.add_argument("--size", type=int, default=2048)
+    p.add_argument("--materials", type=int, default=8)
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=bench_variants)
+
+    p = sub.add_parser("tiled", help="out-of-core tiled AutoPainter vs the in-memory paint: time, peak memory, identity")
+    p.add_argument("--size", type=int, default=4096)
+    p.add_argument("--rules", type=int, default=16)
+    p.add_argument("--tile", type=int, nargs="+", default=[256, 512, 1024])
+    p.add_argument("--kernel", choices=["central", "horn", "sobel"], default="horn")
+    p.add_argument("--seed", type=int, default=0)
+    p.set_defaults(func=bench_tiled)
+
+    p = sub.add_parser("layers", help="flow / wetness / channel-distance layers: field build and mask times")
+    p.add_argument("--size", type=int, default=4096)
+    p.add_argument("--spacing", type=float, default=10.0, help="meters per pixel")
+    p.add_argument("--specs", nargs="+", default=["flow>=1000", "twi>=10", "channel<=40"])
+    p.set_defaults(func=bench_layers)
+
+    p = sub.add_parser("flags", help="HG2/HGT -> 16-bit PNG -> export round trip with and without keep_flags")
+    p.add_argument("--zones", type=int, default=16)
+    p.add_argument("--depth", type=int, default=7, help="HG2 zone depth (HGT is always 128px zones)")
+    p.set_defaults(func=bench_flags)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
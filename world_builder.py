@@ -3,7 +3,12 @@ import sys
 import ctypes
 import math
 import json
+import hashlib
+import lzma
+import zlib
 import threading
+import time
+from collections import OrderedDict
 import random
 import re
 import numpy as np
@@ -11,9 +16,12 @@ import struct
 import imageio
 import tkinter as tk
 from datetime import datetime
-from tkinter import filedialog, messagebox, ttk
+from tkinter import filedialog, messagebox, simpledialog, ttk
 from PIL import Image, ImageDraw, ImageFilter, ImageTk, ImageOps, ImageEnhance
-from scipy.ndimage import map_coordinates
+from concurrent.futures import ThreadPoolExecutor
+from scipy.ndimage import map_coordinates, gaussian_filter1d, distance_transform_edt, label as label_regions
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import breadth_first_order, minimum_spanning_tree
 
 # --- BATTLEZONE HUD COLORS ---
 BZ_BG = "#0a0a0a"
@@ -106,6 +114,65 @@ class ToolTip:
             self.tip_window = None
 
 
+class PreviewWorker:
+    """
+    One background thread that renders only the newest request.
+    Every submit() bumps a generation counter: a request superseded before it
+    starts is skipped, the render callback can poll cancelled() to bail out
+    early, and a result that is stale by the time it is done is dropped
+    instead of being posted back to Tk.
+    render(params, cancelled) runs on the worker; deliver(result) and the
+    optional report(latency_ms, dropped) run on the Tk thread via root.after.
+    """
+
+    def __init__(self, root, render, deliver, report=None):
+        self.root = root
+        self.render = render
+        self.deliver = deliver
+        self.report = report
+        self.generation = 0
+        self.dropped = 0
+        self.pending = None
+        self.cond = threading.Condition()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, params):
+        with self.cond:
+            self.generation += 1
+            if self.pending is not None:
+                self.dropped += 1
+            self.pending = (self.generation, time.perf_counter(), params)
+            self.cond.notify()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while self.pending is None:
+                    self.cond.wait()
+                gen, t0, params = self.pending
+                self.pending = None
+
+            cancelled = lambda: gen != self.generation
+            try:
+                result = self.render(params, cancelled)
+            except Exception as e:
+                print(f"Preview Worker Error: {e}")
+                continue
+            if result is None or cancelled():
+                self.dropped += 1
+                continue
+            self.root.after(0, lambda g=gen, t=t0, r=result: self._deliver(g, t, r))
+
+    def _deliver(self, gen, t0, result):
+        if gen != self.generation:
+            self.dropped += 1
+            return
+        self.deliver(result)
+        if self.report:
+            # Measured after the canvas is updated: input event -> pixels on screen
+            self.report((time.perf_counter() - t0) * 1000.0, self.dropped)
+
+
 class BinaryFieldType:
     DATA_VOID = 0
     DATA_BOOL = 1
@@ -340,91 +407,2087 @@ class BinaryBZNParser:
             # Skip one token
             self.read_token()
 
+class HG2Codec:
+    """
+    Zone tiling for HG2/HGT heightfields.
+    On disk the map is stored zone by zone (row-major zones, each zone a
+    row-major zone x zone block). Both directions are a single
+    reshape/transpose, so there is no per-zone Python loop.
+    """
+
+    HEADER = struct.Struct("<HHHHHH") # version, depth, x_zones, z_zones, 10, 0
+
+    # Height bits per word; the bits above are per-vertex flags (3 in HG2, 4 in HGT)
+    HG2_BITS = 13
+    HGT_BITS = 12
+
+    @staticmethod
+    def height_mask(bits):
+        return (1 << bits) - 1
+
+    @staticmethod
+    def flag_mask(bits):
+        return 0xFFFF & ~((1 << bits) - 1)
+
+    @staticmethod
+    def split(raw, bits):
+        """(heights, flags) planes of a packed uint16 array; flags are shifted down to 0-7 / 0-15."""
+        return raw & np.uint16(HG2Codec.height_mask(bits)), raw >> np.uint16(bits)
+
+    @staticmethod
+    def merge(heights, flags, bits):
+        """Inverse of split()."""
+        merged = (np.asarray(flags, dtype=np.uint16) << np.uint16(bits))
+        merged |= np.asarray(heights, dtype=np.uint16) & np.uint16(HG2Codec.height_mask(bits))
+        return merged
+
+    @staticmethod
+    def decode_zones(raw, zw, zl, zone):
+        """
+        raw: 1D uint16 array in file (zone) order.
+        Returns a (zl*zone, zw*zone) de-tiled array (one copy).
+        Short files are zero padded, trailing data is ignored.
+        """
+        expected = zw * zl * zone * zone
+        if raw.size < expected:
+            padded = np.zeros(expected, dtype=raw.dtype)
+            padded[:raw.size] = raw
+            raw = padded
+        tiled = raw[:expected].reshape(zl, zw, zone, zone)
+        return tiled.transpose(0, 2, 1, 3).reshape(zl * zone, zw * zone)
+
+    @staticmethod
+    def encode_zones(arr, zone):
+        """
+        arr: 2D (H, W) array, both multiples of zone.
+        Returns a contiguous 1D array in file (zone) order, ready for tofile()/tobytes().
+        """
+        h, w = arr.shape
+        if h % zone or w % zone:
+            raise ValueError(f"Array {w}x{h} is not a multiple of the zone size {zone}.")
+        zl, zw = h // zone, w // zone
+        tiled = arr.reshape(zl, zone, zw, zone).transpose(0, 2, 1, 3)
+        return np.ascontiguousarray(tiled).reshape(-1)
+
+    @staticmethod
+    def quantize(arr16, bits):
+        """16-bit space (0-65535) float heights -> 12-bit (HGT/legacy) or 13-bit (HG2) uint16."""
+        step = 65536 >> bits
+        return np.clip(arr16 / step, 0, (1 << bits) - 1).astype(np.uint16)
+
+class BitPlane:
+    """
+    Lazy shift/mask view of a packed uint16 buffer (e.g. an HG2File memmap).
+    Indexing masks only the selected elements, so one zone's flags never
+    touch the rest of the map. `owner` (e.g. the HG2File behind the memmap)
+    is closed along with the view.
+    """
+
+    def __init__(self, raw, mask, shift=0, owner=None):
+        self.raw, self.mask, self.shift = raw, mask, shift
+        self.owner = owner
+        self.shape = raw.shape
+        self.ndim = raw.ndim
+        self.dtype = np.dtype(np.uint16)
+
+    def __getitem__(self, key):
+        block = np.asarray(self.raw[key]) & np.uint16(self.mask)
+        return block >> np.uint16(self.shift) if self.shift else block
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self[...]
+        return arr if dtype is None else arr.astype(dtype)
+
+    def close(self):
+        # Drop the memmap reference too, otherwise the mapping outlives owner.close()
+        if self.owner is not None:
+            self.owner.close()
+            self.owner = None
+        self.raw = None
+
+class HG2File:
+    """
+    Memory-mapped HG2/HGT heightfield.
+    Only the 12-byte header (or the sibling TRN for HGT) is read up front;
+    zone() and region() touch just the pages of the zones they cover, and the
+    full map is de-tiled only when detile() is called.
+    """
+
+    HGT_ZONE = 128
+
+    def __init__(self, path, zw=None, zl=None, mode="r"):
+        self.path = path
+        self.is_hgt = path.lower().endswith(".hgt")
+
+        if self.is_hgt:
+            # HGT: no header, fixed 128x128 zones, zone counts from TRN or caller
+            zw, zl = HG2File.hgt_zone_counts(path, zw, zl)
+            self.header = None
+            self.depth = 7
+            offset = 0
+        else:
+            with open(path, "rb") as f:
+                header = f.read(HG2Codec.HEADER.size)
+            if len(header) < HG2Codec.HEADER.size:
+                raise ValueError("Truncated HG2 header.")
+            self.header = HG2Codec.HEADER.unpack(header)
+            _, self.depth, zw, zl, _, _ = self.header
+            offset = HG2Codec.HEADER.size
+
+        self.zone_size = 2**self.depth
+        self.zw, self.zl = zw, zl
+        if zw <= 0 or zl <= 0:
+            raise ValueError("Invalid zone dimensions.")
+
+        expected = zw * zl * self.zone_size * self.zone_size
+        available = (os.path.getsize(path) - offset) // 2
+        if available < expected:
+            kind = "HGT" if self.is_hgt else "HG2"
+            raise ValueError(f"Invalid {kind} size. Expected {expected} entries, got {available}.")
+
+        self.data = np.memmap(path, dtype="<u2", mode=mode, offset=offset,
+                              shape=(zl, zw, self.zone_size, self.zone_size))
+        self.height_bits = HG2Codec.HGT_BITS if self.is_hgt else HG2Codec.HG2_BITS
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.data is not None:
+            if self.data.mode != "r":
+                self.data.flush()
+            self.data = None
+
+    @property
+    def width(self):
+        return self.zw * self.zone_size
+
+    @property
+    def height(self):
+        return self.zl * self.zone_size
+
+    @property
+    def tiled(self):
+        """Zero-copy (zl, zone, zw, zone) view; [zy, y, zx, x] is pixel (zy*zone+y, zx*zone+x)."""
+        return self.data.transpose(0, 2, 1, 3)
+
+    @property
+    def heights(self):
+        """Height plane in file order, (zl, zw, zone, zone); masked lazily on indexing."""
+        return BitPlane(self.data, HG2Codec.height_mask(self.height_bits))
+
+    @property
+    def flags(self):
+        """Flag plane (0-7 HG2, 0-15 HGT) in file order; shifted lazily on indexing."""
+        return BitPlane(self.data, HG2Codec.flag_mask(self.height_bits), self.height_bits)
+
+    def zone(self, zx, zy):
+        """Zero-copy (zone, zone) view of a single zone."""
+        return self.data[zy, zx]
+
+    def region(self, x0, y0, x1, y1):
+        """De-tiled copy of the pixel rectangle [y0:y1, x0:x1]; only the zones it overlaps are read."""
+        x0, y0 = max(0, x0), max(0, y0)
+        x1, y1 = min(self.width, x1), min(self.height, y1)
+        if x1 <= x0 or y1 <= y0:
+            return np.zeros((0, 0), dtype=np.uint16)
+        zs = self.zone_size
+        zx0, zx1 = x0 // zs, (x1 - 1) // zs + 1
+        zy0, zy1 = y0 // zs, (y1 - 1) // zs + 1
+        block = self.tiled[zy0:zy1, :, zx0:zx1, :].reshape((zy1 - zy0) * zs, (zx1 - zx0) * zs)
+        return block[y0 - zy0 * zs : y1 - zy0 * zs, x0 - zx0 * zs : x1 - zx0 * zs]
+
+    def detile(self):
+        """Full (height, width) uint16 array. This is the only call that reads the whole file."""
+        return HG2Codec.decode_zones(self.data.reshape(-1), self.zw, self.zl, self.zone_size)
+
+    @staticmethod
+    def hgt_zone_counts(path, zw=None, zl=None):
+        """HGT files carry no header: take the zone counts from the sibling TRN, else the given defaults."""
+        trn = TRNParser.parse(os.path.splitext(path)[0] + ".trn")
+        if trn.get("Width") and trn.get("Depth"):
+            tw = int(round(trn["Width"] / 1280.0))
+            tl = int(round(trn["Depth"] / 1280.0))
+            if tw > 0 and tl > 0:
+                return tw, tl
+        return zw or 0, zl or 0
+
+    @staticmethod
+    def trn_mtime(path):
+        """mtime_ns of the sibling TRN, 0 if there is none. Freshness keys of HGT data include it."""
+        trn_path = os.path.splitext(path)[0] + ".trn"
+        return os.stat(trn_path).st_mtime_ns if os.path.exists(trn_path) else 0
+
+class ScaledHeights:
+    """
+    Row-sliceable float32 view of a raw float memmap mapped to 16-bit space:
+    (raw - lo) * scale. Slicing reads just those rows, so the exporter can
+    stream it like any other source.
+    """
+
+    def __init__(self, raw, lo, scale):
+        self.raw, self.lo, self.scale = raw, lo, scale
+        self.shape = raw.shape
+        self.ndim = raw.ndim
+        self.dtype = np.dtype(np.float32)
+
+    def __getitem__(self, key):
+        block = np.asarray(self.raw[key], dtype=np.float32) - np.float32(self.lo)
+        block *= np.float32(self.scale)
+        return block
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self[:]
+        return arr if dtype is None else arr.astype(dtype)
+
+    def to_uint16(self, rows=1024):
+        """Clipped uint16 copy, converted a band of rows at a time."""
+        out = np.empty(self.shape, dtype=np.uint16)
+        for y in range(0, self.shape[0], rows):
+            out[y : y + rows] = np.clip(self[y : y + rows] + 0.5, 0, 65535)
+        return out
+
+class RawHeightmap:
+    """
+    Headerless heightmaps as exported by World Machine / Gaea.
+    RAW16 (.r16/.raw) is unsigned 16-bit, R32 (.r32) is 32-bit float. Width,
+    height and byte order are inferred from the file size and the data, and
+    the pixels are exposed as a read-only np.memmap (no decode, no copy).
+    """
+
+    RAW16_EXTS = (".r16", ".raw")
+    R32_EXTS = (".r32",)
+    EXTENSIONS = RAW16_EXTS + R32_EXTS
+    ASPECTS = (1, 2, 0.5, 4, 0.25)  # width / height ratios tried when no size is given
+
+    @staticmethod
+    def is_raw(path):
+        return path.lower().endswith(RawHeightmap.EXTENSIONS)
+
+    @staticmethod
+    def infer_shape(count, width=None, height=None):
+        """(height, width) for `count` samples: the given size, else square, else 2:1 / 4:1 either way."""
+        if width and height:
+            if width * height != count:
+                raise ValueError(f"RAW size mismatch: {width}x{height} needs {width * height} samples, file has {count}.")
+            return height, width
+        if width or height:
+            known = width or height
+            if count % known:
+                raise ValueError(f"RAW file of {count} samples is not a multiple of {known}.")
+            return (count // width, width) if width else (height, count // height)
+        for aspect in RawHeightmap.ASPECTS:
+            h = int(round(math.sqrt(count / aspect)))
+            w = int(round(h * aspect))
+            if h > 0 and w * h == count:
+                return h, w
+        raise ValueError(f"Cannot infer RAW dimensions from {count} samples (not square, 2:1 or 4:1).")
+
+    @staticmethod
+    def roughness(sample):
+        """
+        Mean absolute neighbour difference relative to the value range.
+        Byte-swapped terrain is far rougher than the real thing, and swapped
+        floats land on NaN/inf or absurd magnitudes, which count as infinite.
+        """
+        with np.errstate(invalid="ignore", over="ignore"):
+            sample = sample.astype(np.float64)
+            mag = np.abs(sample)
+            if not np.all(np.isfinite(sample)) or mag.max() > 1e7 or np.any((mag > 0) & (mag < 1e-10)):
+                return np.inf
+            if sample.shape[1] < 2:
+                return 0.0
+            span = sample.max() - sample.min()
+            return float(np.mean(np.abs(np.diff(sample, axis=1)))) / span if span > 0 else 0.0
+
+    @staticmethod
+    def open(path, width=None, height=None, byteorder=None):
+        """Read-only (height, width) memmap of a RAW16/R32 file. byteorder "<" or ">", inferred if None."""
+        kind = "f4" if path.lower().endswith(RawHeightmap.R32_EXTS) else "u2"
+        itemsize = 4 if kind == "f4" else 2
+        size = os.path.getsize(path)
+        if size % itemsize:
+            raise ValueError(f"RAW file size {size} is not a multiple of {itemsize} bytes.")
+        shape = RawHeightmap.infer_shape(size // itemsize, width, height)
+
+        if byteorder is None:
+            # Compare a band from the middle of the map read both ways
+            little = np.memmap(path, dtype="<" + kind, mode="r", shape=shape)
+            y0 = shape[0] // 2
+            band = np.array(little[y0 : y0 + 64])
+            del little
+            swapped = band.view(band.dtype.newbyteorder())
+            byteorder = "<" if RawHeightmap.roughness(band) <= RawHeightmap.roughness(swapped) else ">"
+        return np.memmap(path, dtype=byteorder + kind, mode="r", shape=shape)
+
+    @staticmethod
+    def open_height16(path, width=None, height=None, byteorder=None):
+        """
+        16-bit (0-65535) source for the exporter. RAW16 is the memmap itself;
+        R32 is normalized lazily: 0-1 data keeps its absolute level, anything
+        else is stretched from its min/max.
+        """
+        raw = RawHeightmap.open(path, width, height, byteorder)
+        if raw.dtype.kind == "u":
+            return raw
+        lo, hi = float(np.nanmin(raw)), float(np.nanmax(raw))
+        if lo >= 0.0 and hi <= 1.0:
+            lo, hi = 0.0, 1.0
+        return ScaledHeights(raw, lo, 65535.0 / max(hi - lo, 1e-12))
+
+    @staticmethod
+    def write(path, arr16):
+        """Little-endian RAW16 (.r16/.raw) or 0-1 float R32 (.r32), written a band of rows at a time."""
+        r32 = path.lower().endswith(RawHeightmap.R32_EXTS)
+        with open(path, "wb") as f:
+            for y in range(0, arr16.shape[0], 1024):
+                block = arr16[y : y + 1024]
+                if r32:
+                    (block.astype(np.float32) / np.float32(65535.0)).astype("<f4").tofile(f)
+                else:
+                    block.astype("<u2").tofile(f)
+
+class HeightmapFilters:
+    """
+    Float32 filters for 16-bit height data. No 8-bit round trips, so the
+    full 13-bit HG2 precision survives smoothing.
+    """
+
+    GAUSS_TRUNCATE = 4.0
+
+    @staticmethod
+    def gaussian_halo(sigma):
+        """Kernel radius in pixels (matches scipy's truncate rule)."""
+        if sigma <= 0:
+            return 0
+        return int(HeightmapFilters.GAUSS_TRUNCATE * float(sigma) + 0.5)
+
+    @staticmethod
+    def gaussian_smooth(arr, sigma, bands=None, workers=None):
+        """
+        Separable Gaussian (edge pixels repeated). The rows are split into
+        horizontal bands, each read with a halo of gaussian_halo(sigma) rows
+        and filtered on a thread pool. Every output pixel sees exactly the
+        same inputs in the same order, so the result is bit-identical for
+        any band count (and to scipy's gaussian_filter on the whole array).
+        """
+        arr = np.asarray(arr, dtype=np.float32)
+        if sigma <= 0:
+            return arr.copy()
+
+        h = arr.shape[0]
+        halo = HeightmapFilters.gaussian_halo(sigma)
+        if bands is None:
+            bands = os.cpu_count() or 1
+        bands = max(1, min(bands, h))
+        edges = np.linspace(0, h, bands + 1).astype(int)
+        out = np.empty_like(arr)
+
+        def run_band(i):
+            y0, y1 = edges[i], edges[i + 1]
+            a0, a1 = max(0, y0 - halo), min(h, y1 + halo)
+            block = gaussian_filter1d(arr[a0:a1], sigma, axis=0, mode="nearest",
+                                      truncate=HeightmapFilters.GAUSS_TRUNCATE)
+            out[y0:y1] = gaussian_filter1d(block[y0 - a0 : y1 - a0], sigma, axis=1, mode="nearest",
+                                           truncate=HeightmapFilters.GAUSS_TRUNCATE)
+
+        if bands == 1:
+            run_band(0)
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(run_band, range(bands)))
+        return out
+
+class HeightmapDither:
+    """
+    Dithered alternatives to HG2Codec.quantize for 16-bit -> 12/13-bit.
+    A plain divide terraces gentle slopes; these trade the terraces for fine
+    noise that averages back to the true surface. All modes are unbiased
+    (the plain divide floors, i.e. sits half a step low on average).
+
+      ordered   - 8x8 Bayer threshold tile
+      blue      - 64x64 blue-noise threshold tile (less visible pattern)
+      diffusion - error diffusion down each column: a pixel's whole
+                  rounding error goes to the pixel below. That is a floored
+                  running sum along the column, so a block of rows costs one
+                  array add per row. Columns start at staggered (blue-noise)
+                  phases so neighbours do not step on the same row. There is
+                  no sideways share as in Floyd-Steinberg; that is what keeps
+                  it under 2x the plain divide. More fine noise than ordered,
+                  but the least low-frequency error. The error carries across strips.
+    """
+
+    MODES = ("none", "ordered", "blue", "diffusion")
+    # Rows per running sum. 32 rows of 13-bit heights stay under 2^18, where float32
+    # still holds 1/64 steps: 16-bit inputs plus the odd-1/64 phases add up exactly
+    DIFFUSION_ROWS = 32
+    BAYER_8 = np.array([
+        [0, 32, 8, 40, 2, 34, 10, 42], [48, 16, 56, 24, 50, 18, 58, 26],
+        [12, 44, 4, 36, 14, 46, 6, 38], [60, 28, 52, 20, 62, 30, 54, 22],
+        [3, 35, 11, 43, 1, 33, 9, 41], [51, 19, 59, 27, 49, 17, 57, 25],
+        [15, 47, 7, 39, 13, 45, 5, 37], [63, 31, 55, 23, 61, 29, 53, 21]])
+    _tiles = {}
+
+    @staticmethod
+    def threshold_tile(mode):
+        """(N, N) float32 thresholds, uniform on (0, 1)."""
+        tile = HeightmapDither._tiles.get(mode)
+        if tile is None:
+            if mode == "ordered":
+                tile = (HeightmapDither.BAYER_8 + 0.5) / 64.0
+            else:
+                # High-passed white noise, rank-equalized back to uniform a few times
+                size = 64
+                t = np.random.default_rng(7).random((size, size))
+                for _ in range(4):
+                    low = gaussian_filter1d(gaussian_filter1d(t, 1.5, axis=0, mode="wrap"), 1.5, axis=1, mode="wrap")
+                    ranks = np.argsort(np.argsort((t - low).ravel()))
+                    t = ((ranks + 0.5) / ranks.size).reshape(size, size)
+                tile = t
+            tile = tile.astype(np.float32)
+            HeightmapDither._tiles[mode] = tile
+        return tile
+
+    @staticmethod
+    def tiled_thresholds(mode, h, w, y0=0):
+        """Threshold tile repeated over an (h, w) block starting at image row y0."""
+        tile = HeightmapDither.threshold_tile(mode)
+        n = tile.shape[0]
+        oy = y0 % n
+        reps = np.tile(tile, (-(-(h + oy) // n), -(-w // n)))
+        return reps[oy : oy + h, :w]
+
+    @staticmethod
+    def quantize(arr16, bits, mode="none", y0=0, state=None):
+        """
+        Like HG2Codec.quantize; y0 is the block's first image row (keeps tiles aligned across strips).
+        state: a dict shared by the strips of one image, quantized top to bottom;
+        diffusion keeps the error owed to the next row (and a scratch block) in it.
+        """
+        if mode == "none":
+            return HG2Codec.quantize(arr16, bits)
+        top = (1 << bits) - 1
+        arr16 = np.asarray(arr16)
+        scale = np.float32(1.0 / (65536 >> bits))
+        h, w = arr16.shape
+
+        if mode in ("ordered", "blue"):
+            # floor(x + t) with t uniform on (0, 1)
+            x = arr16.astype(np.float32) * scale
+            x += HeightmapDither.tiled_thresholds(mode, h, w, y0)
+            return np.clip(x, 0, top).astype(np.uint16)
+
+        if mode != "diffusion":
+            raise ValueError(f"Unknown dither mode: {mode}")
+        state = {} if state is None else state
+        # Reusing one float block per image skips page-faulting a fresh one for every strip
+        x = state.get("scratch")
+        if x is None or x.shape != (h, w):
+            x = state["scratch"] = np.empty((h, w), dtype=np.float32)
+        np.multiply(arr16, scale, out=x, casting="unsafe")
+        np.clip(x, 0, top, out=x)
+        carry = state.get("carry")
+        if carry is None or carry.shape != (w,):
+            phase = np.tile(HeightmapDither.threshold_tile("blue")[0], -(-w // 64))[:w]
+            carry = (np.floor(phase * 32) + np.float32(0.5)) / np.float32(32)
+        out = np.empty((h, w), dtype=np.uint16)
+        for b0 in range(0, h, HeightmapDither.DIFFUSION_ROWS):
+            block = x[b0 : b0 + HeightmapDither.DIFFUSION_ROWS]
+            # Running sum down each column (row by row: a strided cumsum is several times slower)
+            block[0] += carry
+            rows = list(block)
+            for above, row in zip(rows, rows[1:]):
+                np.add(above, row, out=row)
+            # Each pixel gets what its floored running sum gained over the pixel above
+            last = block[-1].copy()
+            np.floor(block, out=block)
+            carry = last - block[-1]
+            out[b0] = block[0]  # the carry in was under one step
+            np.subtract(block[1:], block[:-1], out=out[b0 + 1 : b0 + block.shape[0]], casting="unsafe")
+        state["carry"] = carry
+        # A pixel gains less than a step over its input, and only inexact sums round that far:
+        # the rare top + 1 (= 1 << bits) is pulled back without a slow uint16 minimum
+        out -= out >> np.uint16(bits)
+        return out
+
+class HeightmapResampler:
+    """
+    Resizes float32 16-bit-space heights onto HG2 zone grids.
+    Shrinking is area-averaged (BOX), enlarging is bicubic. pyramid() anchors
+    on the finest depth the source can fill and halves it with 2x2 means, so
+    every depth comes out of one decode and one resize.
+    """
+
+    LOD_DEPTHS = (6, 7, 8)  # 64/128/256px zones: low/medium/high detail
+
+    @staticmethod
+    def resample(arr, width, height):
+        arr = np.asarray(arr, dtype=np.float32)
+        if arr.shape == (height, width):
+            return arr
+        out = Image.fromarray(np.ascontiguousarray(arr)).resize((width, height), HeightmapResampler.method(arr.shape, width, height))
+        return np.asarray(out, dtype=np.float32)
+
+    @staticmethod
+    def method(shape, width, height):
+        shrinking = width <= shape[1] and height <= shape[0]
+        return Image.Resampling.BOX if shrinking else Image.Resampling.BICUBIC
+
+    @staticmethod
+    def resample_rows(src, width, height, y0, y1):
+        """
+        Rows y0:y1 of resample(src, width, height), reading only the source
+        rows they need (plus the filter's reach), so a zone row costs a band
+        instead of a full-size float32 copy. Identical to the full resize.
+        """
+        sh, sw = src.shape
+        scale = sh / height
+        method = HeightmapResampler.method(src.shape, width, height)
+        # BOX reaches half an output pixel, bicubic two (in source pixels when shrinking)
+        reach = 0.5 if method == Image.Resampling.BOX else 2.0
+        halo = int(math.ceil(max(scale, 1.0) * reach)) + 2
+        s0, s1 = y0 * scale, y1 * scale
+        a0, a1 = max(0, int(math.floor(s0)) - halo), min(sh, int(math.ceil(s1)) + halo)
+        band = Image.fromarray(np.ascontiguousarray(src[a0:a1], dtype=np.float32))
+        out = band.resize((width, y1 - y0), method, box=(0, s0 - a0, sw, s1 - a0))
+        return np.asarray(out, dtype=np.float32)
+
+    @staticmethod
+    def halve(arr):
+        """2x2 area average (both dimensions even)."""
+        h, w = arr.shape
+        return arr.reshape(h // 2, 2, w // 2, 2).mean(axis=(1, 3), dtype=np.float32)
+
+    @staticmethod
+    def zone_size_for(width, zones):
+        """Nearest power-of-two zone size for `width` source pixels spread over `zones` zones."""
+        return 2 ** max(1, int(round(math.log2(max(1.0, width / zones)))))
+
+    @staticmethod
+    def pyramid(src, zw, zl, depths):
+        """Returns {depth: (zl * 2^depth, zw * 2^depth) float32} for each requested depth."""
+        src = np.asarray(src, dtype=np.float32)
+        depths = sorted(set(depths))
+        levels = {}
+
+        # Depths the source covers come from one area-averaged resize plus repeated halving
+        covered = [d for d in depths if (zw << d) <= src.shape[1] and (zl << d) <= src.shape[0]]
+        if covered:
+            level = HeightmapResampler.resample(src, zw << covered[-1], zl << covered[-1])
+            for d in range(covered[-1], depths[0] - 1, -1):
+                if d in depths:
+                    levels[d] = level
+                if d > depths[0]:
+                    level = HeightmapResampler.halve(level)
+
+        # Depths finer than the source are upsampled from the source itself
+        for d in depths:
+            if d not in levels:
+                levels[d] = HeightmapResampler.resample(src, zw << d, zl << d)
+        return levels
+
+class ResampledHeights:
+    """
+    Row-sliceable view of a source resized to (height, width): like
+    ScaledHeights, slicing rows resamples just that band, so the exporter
+    streams a resize without ever holding the resized map.
+    """
+
+    def __init__(self, src, width, height):
+        self.src = src
+        self.shape = (height, width)
+        self.ndim = 2
+        self.dtype = np.dtype(np.float32)
+
+    def __getitem__(self, key):
+        rows, cols = (key[0], key[1:]) if isinstance(key, tuple) else (key, ())
+        y0, y1, step = rows.indices(self.shape[0]) if isinstance(rows, slice) else (rows, rows + 1, 1)
+        band = HeightmapResampler.resample_rows(self.src, self.shape[1], self.shape[0], y0, max(y0, y1))[::step]
+        band = band[(slice(None),) + cols] if cols else band
+        return band if isinstance(rows, slice) else band[0]
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self[:]
+        return arr if dtype is None else arr.astype(dtype)
+
+class HG2Exporter:
+    """
+    Streaming export of a 16-bit (0-65535) height source to HG2/HGT.
+    The source is processed one zone row at a time (plus a blur halo):
+    adjusted, quantized and written straight to the file, so the float
+    working set is one zone row instead of several full-size copies.
+    """
+
+    @staticmethod
+    def adjust(block, brightness, contrast):
+        """Brightness/contrast in 16-bit space (same float32 steps as the preview)."""
+        arr = block.astype(np.float32)
+        arr *= brightness
+        mean = 32768.0
+        arr -= mean
+        arr *= contrast
+        arr += mean
+        return arr
+
+    @staticmethod
+    def levels_adjust(lo16, hi16):
+        """Brightness/contrast for adjust() that stretch [lo16, hi16] onto 0-65535."""
+        scale = 65535.0 / max(1.0, hi16 - lo16)
+        contrast = 1.0 + lo16 * scale / 32768.0
+        return scale / contrast, contrast
+
+    @staticmethod
+    def iter_strips(src, zone, cfg, bits):
+        """Yields quantized (zone, W) uint16 strips, top to bottom."""
+        h = src.shape[0]
+        radius = cfg.get("smooth", 0)
+        # With a full kernel radius of context the strip blur equals a full-image blur
+        halo = HeightmapFilters.gaussian_halo(radius)
+        dither_state = {}
+        for y0 in range(0, h, zone):
+            a0, a1 = max(0, y0 - halo), min(h, y0 + zone + halo)
+            block = HG2Exporter.adjust(src[a0:a1], cfg["brightness"], cfg["contrast"])
+            if radius > 0:
+                block = HeightmapFilters.gaussian_smooth(block, radius)
+            yield HeightmapDither.quantize(block[y0 - a0 : y0 - a0 + zone], bits, cfg.get("dither", "none"), y0, dither_state)
+
+    @staticmethod
+    def write(src, out_path, zone, cfg, bits, header=None, flags=None):
+        """
+        Returns (zones written, total zones); with cfg["incremental"] unchanged zones are skipped.
+        flags: unshifted flag bits in file order, (zl, zw, zone, zone), from open_flags(); OR-ed into each row.
+        The flag source is closed when the write finishes (or fails).
+        """
+        zl, zw = src.shape[0] // zone, src.shape[1] // zone
+        writer = HG2ZoneWriter(out_path, zw, zl, zone, header, incremental=cfg.get("incremental", False))
+        try:
+            for zy, strip in enumerate(HG2Exporter.iter_strips(src, zone, cfg, bits)):
+                row = HG2Codec.encode_zones(strip, zone)
+                if flags is not None:
+                    row |= flags[zy].reshape(-1)
+                writer.write_row(zy, row)
+        finally:
+            written = writer.close()
+            if isinstance(flags, BitPlane):
+                flags.close()
+        return written, zw * zl
+
+    @staticmethod
+    def open_flags(path, out_path, zw, zl, zone):
+        """
+        Flag bits of an existing HG2/HGT laid out like the export (same format
+        and zone grid), or None. If path is the export target itself the
+        flags are copied first, since the writer may truncate it; otherwise
+        the view keeps the file mapped until write() closes it.
+        """
+        if path.lower().endswith(".hgt") != out_path.lower().endswith(".hgt"):
+            return None
+        hg = HG2File(path, zw, zl)
+        if (hg.zw, hg.zl, hg.zone_size) != (zw, zl, zone):
+            hg.close()
+            return None
+        flags = BitPlane(hg.data, HG2Codec.flag_mask(hg.height_bits), owner=hg)
+        if os.path.exists(out_path) and os.path.samefile(path, out_path):
+            plane = flags[...]
+            flags.close()
+            return plane
+        return flags
+
+class HG2ZoneWriter:
+    """
+    Writes an HG2/HGT one zone row at a time.
+    If the target already exists with the same header and size, it is patched
+    in place: each zone is hashed and only zones whose hash changed are
+    overwritten. The hashes are kept in a "<file>.zhash" sidecar, so the
+    existing file only has to be read when the sidecar is missing or stale.
+    With incremental=False the file is rewritten whole and no sidecar is kept.
+    """
+
+    SIDECAR_EXT = ".zhash"
+
+    def __init__(self, path, zw, zl, zone, header=None, incremental=True):
+        self.path = path
+        self.zw, self.zl, self.zone = zw, zl, zone
+        self.header = header or b""
+        self.zone_bytes = zone * zone * 2
+        self.incremental = incremental
+        self.hashes = [None] * (zw * zl)
+        self.rewritten = 0
+
+        expected_size = len(self.header) + zw * zl * self.zone_bytes
+        self.old_hashes = None
+        if incremental and os.path.exists(path) and os.path.getsize(path) == expected_size:
+            with open(path, "rb") as f:
+                same_header = f.read(len(self.header)) == self.header
+            if same_header:
+                self.old_hashes = self._load_sidecar() or self._hash_existing()
+
+        self.patching = self.old_hashes is not None
+        self.f = open(path, "r+b" if self.patching else "wb")
+        if not self.patching:
+            self.f.write(self.header)
+
+    @staticmethod
+    def zone_hash(zone_data):
+        return hashlib.blake2b(zone_data.tobytes(), digest_size=8).hexdigest()
+
+    def _sidecar_path(self):
+        return self.path + HG2ZoneWriter.SIDECAR_EXT
+
+    def _load_sidecar(self):
+        try:
+            with open(self._sidecar_path(), "r") as f:
+                data = json.load(f)
+            st = os.stat(self.path)
+            if (data["mtime"] == st.st_mtime_ns and data["size"] == st.st_size and
+                    (data["zw"], data["zl"], data["zone"]) == (self.zw, self.zl, self.zone)):
+                return data["hashes"]
+        except Exception:
+            pass
+        return None
+
+    def _hash_existing(self):
+        offset = len(self.header)
+        raw = np.memmap(self.path, dtype="<u2", mode="r", offset=offset,
+                        shape=(self.zl * self.zw, self.zone, self.zone))
+        hashes = [HG2ZoneWriter.zone_hash(raw[i]) for i in range(raw.shape[0])]
+        del raw
+        return hashes
+
+    def write_row(self, zy, row_zones):
+        """row_zones: zone row in file order (from HG2Codec.encode_zones, or zw zones straight off a memmap)."""
+        zones = row_zones.reshape(self.zw, self.zone, self.zone)
+        base = zy * self.zw
+        if not self.patching:
+            self.f.write(row_zones.tobytes())
+            if self.incremental:
+                for zx in range(self.zw):
+                    self.hashes[base + zx] = HG2ZoneWriter.zone_hash(zones[zx])
+            self.rewritten += self.zw
+            return
+
+        for zx in range(self.zw):
+            i = base + zx
+            self.hashes[i] = HG2ZoneWriter.zone_hash(zones[zx])
+            if self.hashes[i] != self.old_hashes[i]:
+                self.f.seek(len(self.header) + i * self.zone_bytes)
+                self.f.write(zones[zx].tobytes())
+                self.rewritten += 1
+
+    def close(self):
+        """
+        Finishes the file and, for incremental writes, the sidecar. A full
+        rewrite deletes any old sidecar instead. Returns the number of zones written.
+        """
+        self.f.close()
+        sidecar = self._sidecar_path()
+        if not self.incremental:
+            if os.path.exists(sidecar):
+                os.remove(sidecar)
+            return self.rewritten
+        st = os.stat(self.path)
+        with open(sidecar, "w") as f:
+            json.dump({"zw": self.zw, "zl": self.zl, "zone": self.zone,
+                       "mtime": st.st_mtime_ns, "size": st.st_size, "hashes": self.hashes}, f)
+        return self.rewritten
+
+class HG2ZoneTools:
+    """
+    Stitching and cropping on whole zones. Inputs are memory-mapped and
+    output is written one zone row at a time through HG2ZoneWriter; zones
+    are copied as-is in file order, so nothing is ever de-tiled.
+    """
+
+    @staticmethod
+    def _output_header(out_path, depth, zw, zl):
+        if out_path.lower().endswith(".hgt"):
+            if depth != 7:
+                raise ValueError("HGT output requires 128x128 zones (depth 7).")
+            return None
+        return HG2Codec.HEADER.pack(1, depth, zw, zl, 10, 0)
+
+    @staticmethod
+    def _check_kind(files, out_path):
+        kinds = {hg.is_hgt for hg in files}
+        if len(kinds) > 1:
+            raise ValueError("Cannot mix HG2 and HGT inputs (12-bit vs 13-bit heights).")
+        if kinds.pop() != out_path.lower().endswith(".hgt"):
+            raise ValueError("Output format must match the inputs (HG2 -> .hg2, HGT -> .hgt).")
+
+    @staticmethod
+    def crop(src_path, out_path, zx0, zy0, zx1, zy1, incremental=True):
+        """Zones [zy0:zy1, zx0:zx1] of src_path into out_path. Returns (zones written, total)."""
+        with HG2File(src_path) as hg:
+            HG2ZoneTools._check_kind([hg], out_path)
+            if not (0 <= zx0 < zx1 <= hg.zw and 0 <= zy0 < zy1 <= hg.zl):
+                raise ValueError(f"Crop {zx0},{zy0} -> {zx1},{zy1} is outside the {hg.zw}x{hg.zl} zone grid.")
+            zw, zl = zx1 - zx0, zy1 - zy0
+            header = HG2ZoneTools._output_header(out_path, hg.depth, zw, zl)
+            writer = HG2ZoneWriter(out_path, zw, zl, hg.zone_size, header, incremental)
+            try:
+                for zy in range(zy0, zy1):
+                    # A zone row slice of the memmap is contiguous in the file
+                    writer.write_row(zy - zy0, hg.data[zy, zx0:zx1])
+            finally:
+                written = writer.close()
+        return written, zw * zl
+
+    @staticmethod
+    def stitch(grid, out_path, incremental=True):
+        """
+        grid: rows of HG2/HGT paths in file (zone row) order. Tiles in a grid
+        row must share a zone height, tiles in a grid column a zone width,
+        and all must share a depth. Returns (zones written, total).
+        """
+        files = [[HG2File(p) for p in row] for row in grid]
+        try:
+            flat = [hg for row in files for hg in row]
+            if not flat or any(len(row) != len(files[0]) for row in files):
+                raise ValueError("Stitch grid must be a full rectangle of tiles.")
+            HG2ZoneTools._check_kind(flat, out_path)
+            if len({hg.depth for hg in flat}) > 1:
+                raise ValueError("All tiles must share the same depth (zone size).")
+            for row in files:
+                if len({hg.zl for hg in row}) > 1:
+                    raise ValueError("Tiles in a grid row must have the same number of zone rows.")
+            for col in zip(*files):
+                if len({hg.zw for hg in col}) > 1:
+                    raise ValueError("Tiles in a grid column must have the same number of zone columns.")
+
+            zw = sum(hg.zw for hg in files[0])
+            zl = sum(row[0].zl for row in files)
+            zone = flat[0].zone_size
+            header = HG2ZoneTools._output_header(out_path, flat[0].depth, zw, zl)
+            writer = HG2ZoneWriter(out_path, zw, zl, zone, header, incremental)
+            try:
+                zy_out = 0
+                for row in files:
+                    for zy in range(row[0].zl):
+                        writer.write_row(zy_out, np.concatenate([hg.data[zy] for hg in row]))
+                        zy_out += 1
+            finally:
+                written = writer.close()
+        finally:
+            for hg in [hg for row in files for hg in row]:
+                hg.close()
+        return written, zw * zl
+
+class HeightStats:
+    """
+    Height statistics from one pass over zone rows.
+    Every zone keeps min/max/mean and a compact histogram (just the bins
+    between its min and max), every zone row a dense histogram, and the map
+    the total. Zone-aligned region queries merge those partials, so nothing
+    is rescanned. Bins are 12-bit (HGT) or 13-bit (HG2/PNG) height units;
+    `unit` is the number of source units per bin (8 for 16-bit PNGs).
+    """
+
+    def __init__(self, zw, zl, zone, bits, unit=1):
+        self.zw, self.zl, self.zone = zw, zl, zone
+        self.bits = bits
+        self.bins = 1 << bits
+        self.unit = unit
+        self.zmin = np.zeros((zl, zw), dtype=np.int32)
+        self.zmax = np.zeros((zl, zw), dtype=np.int32)
+        self.zsum = np.zeros((zl, zw), dtype=np.float64)
+        self.zcount = np.zeros((zl, zw), dtype=np.int64)
+        self.zhist = [[None] * zw for _ in range(zl)]
+        self.row_hist = np.zeros((zl, self.bins), dtype=np.int64)
+        self.hist = np.zeros(self.bins, dtype=np.int64)
+
+    @staticmethod
+    def from_hg2(hg):
+        """Streams an HG2File one zone row at a time (the memory map is never fully materialized)."""
+        bits = hg.height_bits
+        stats = HeightStats(hg.zw, hg.zl, hg.zone_size, bits)
+        mask = HG2Codec.height_mask(bits)
+        for zy in range(hg.zl):
+            stats.add_row(zy, hg.tiled[zy].reshape(hg.zone_size, hg.width) & mask)
+        return stats
+
+    @staticmethod
+    def from_array(arr, src_bits=16, bits=13, zone=128):
+        """De-tiled source (e.g. a 16-bit PNG); edge zones may be partial."""
+        h, w = arr.shape
+        shift = src_bits - bits
+        stats = HeightStats(-(-w // zone), -(-h // zone), zone, bits, unit=1 << shift)
+        for zy in range(stats.zl):
+            strip = arr[zy * zone : (zy + 1) * zone]
+            stats.add_row(zy, strip >> shift if shift else strip)
+        return stats
+
+    def add_row(self, zy, strip):
+        """strip: (rows, width) bin values of zone row zy. One bincount covers every zone in the row."""
+        offsets = (np.arange(strip.shape[1], dtype=np.int64) // self.zone) * self.bins
+        counts = np.bincount((strip.astype(np.int64) + offsets).ravel(), minlength=self.zw * self.bins)
+        counts = counts.reshape(self.zw, self.bins)
+
+        present = counts > 0
+        lo = np.argmax(present, axis=1)
+        hi = self.bins - 1 - np.argmax(present[:, ::-1], axis=1)
+        self.zmin[zy], self.zmax[zy] = lo, hi
+        self.zcount[zy] = counts.sum(axis=1)
+        self.zsum[zy] = counts @ np.arange(self.bins, dtype=np.float64)
+        for zx in range(self.zw):
+            self.zhist[zy][zx] = counts[zx, lo[zx] : hi[zx] + 1].astype(np.int32)
+        self.row_hist[zy] = counts.sum(axis=0)
+        self.hist += self.row_hist[zy]
+
+    def region(self, zx0=0, zy0=0, zx1=None, zy1=None):
+        """Merged stats of zones [zy0:zy1, zx0:zx1]: dict with min, max, mean, count, hist."""
+        zx1 = self.zw if zx1 is None else min(zx1, self.zw)
+        zy1 = self.zl if zy1 is None else min(zy1, self.zl)
+        zx0, zy0 = max(0, zx0), max(0, zy0)
+        if zx1 <= zx0 or zy1 <= zy0:
+            raise ValueError("Empty zone region.")
+
+        if (zx0, zy0, zx1, zy1) == (0, 0, self.zw, self.zl):
+            hist = self.hist
+        elif (zx0, zx1) == (0, self.zw):
+            hist = self.row_hist[zy0:zy1].sum(axis=0)
+        else:
+            hist = np.zeros(self.bins, dtype=np.int64)
+            for zy in range(zy0, zy1):
+                for zx in range(zx0, zx1):
+                    part = self.zhist[zy][zx]
+                    lo = self.zmin[zy, zx]
+                    hist[lo : lo + part.size] += part
+
+        count = int(self.zcount[zy0:zy1, zx0:zx1].sum())
+        return {
+            "min": int(self.zmin[zy0:zy1, zx0:zx1].min()),
+            "max": int(self.zmax[zy0:zy1, zx0:zx1].max()),
+            "mean": float(self.zsum[zy0:zy1, zx0:zx1].sum()) / count,
+            "count": count,
+            "hist": hist,
+        }
+
+    def source_range(self):
+        """Whole-map (min, max) in source units."""
+        return int(self.zmin.min()) * self.unit, int(self.zmax.max()) * self.unit + self.unit - 1
+
+    @staticmethod
+    def levels(hist, clip=0.0):
+        """(low, high) bins after clipping a fraction `clip` of the samples off each end."""
+        cdf = np.cumsum(hist)
+        total = cdf[-1]
+        lo = int(np.searchsorted(cdf, clip * total, side="right"))
+        hi = int(np.searchsorted(cdf, (1.0 - clip) * total, side="left"))
+        return lo, max(lo, hi)
+
+class HeightmapCache:
+    """
+    Decoded heightmaps keyed by (path, mtime, size), so UI refreshes do not
+    re-read and re-detile the file. Derived data (preview proxies etc.) is
+    kept in each entry's "extras" and goes away with it when the file changes.
+    """
+
+    # Guards every entry's "extras": the preview and paint threads share entries
+    extras_lock = threading.Lock()
+
+    def __init__(self, max_entries=4):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_key(path, zw=None, zl=None):
+        st = os.stat(path)
+        key = (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+        if path.lower().endswith(".hgt"):
+            # HGT zone counts depend on the sibling TRN and the UI defaults
+            key += (HG2File.trn_mtime(path), zw, zl)
+        return key
+
+    @staticmethod
+    def load(path, zw=None, zl=None):
+        """Full-resolution uint16 array for an HG2/HGT/PNG heightmap (from a fresh .hgz cache if there is one)."""
+        hgz = HGZFile.fresh_for(path, zw, zl)
+        if hgz is not None:
+            return hgz.detile()
+        if path.lower().endswith((".hg2", ".hgt")):
+            with HG2File(path, zw, zl) as hg:
+                return hg.detile()
+        return load_height16(path)
+
+    def get(self, path, zw=None, zl=None):
+        key = HeightmapCache.make_key(path, zw, zl)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                return entry
+
+        entry = {"key": key, "heights": HeightmapCache.load(path, zw, zl), "extras": {}}
+
+        with self.lock:
+            # Drop stale versions of the same file, then the least recently used
+            for old in [k for k in self.entries if k[0] == key[0]]:
+                del self.entries[old]
+            self.entries[key] = entry
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return entry
+
+    @staticmethod
+    def extra(entry, key, build):
+        """entry["extras"][key], built once. build() runs outside the lock; the first result stored wins."""
+        with HeightmapCache.extras_lock:
+            value = entry["extras"].get(key)
+        if value is None:
+            value = build()
+            with HeightmapCache.extras_lock:
+                value = entry["extras"].setdefault(key, value)
+        return value
+
+    @staticmethod
+    def proxy(entry, max_w, max_h):
+        """
+        Area-averaged float32 copy no larger than about max_w x max_h, in the
+        units of stats(): HG2/HGT flag bits are stripped before averaging.
+        Returns (proxy, factor); factor is the integer downsample step.
+        """
+        heights = entry["heights"]
+        h, w = heights.shape
+        factor = max(1, int(math.ceil(max(w / max_w, h / max_h))))
+
+        def build():
+            bits = HeightmapCache.height_bits(entry["key"][0])
+            ph, pw = h // factor, w // factor
+            proxy = np.empty((ph, pw), dtype=np.float32)
+            step = max(1, 1024 // factor)  # proxy rows per band, so the flag strip never copies the whole map
+            for i0 in range(0, ph, step):
+                i1 = min(ph, i0 + step)
+                band = heights[i0 * factor : i1 * factor, : pw * factor]
+                if bits:
+                    band, _ = HG2Codec.split(band, bits)
+                if factor == 1:
+                    proxy[i0:i1] = band
+                else:
+                    proxy[i0:i1] = band.reshape(i1 - i0, factor, pw, factor).mean(axis=(1, 3), dtype=np.float32)
+            return proxy
+
+        return HeightmapCache.extra(entry, ("proxy", factor), build), factor
+
+    @staticmethod
+    def stats(entry):
+        """HeightStats for the entry, computed once (HG2/HGT straight from the memory map)."""
+        def build():
+            key = entry["key"]
+            if key[0].lower().endswith((".hg2", ".hgt")):
+                zw, zl = key[4:6] if len(key) > 3 else (None, None)
+                with HG2File(key[0], zw, zl) as hg:
+                    return HeightStats.from_hg2(hg)
+            return HeightStats.from_array(entry["heights"])
+
+        return HeightmapCache.extra(entry, "stats", build)
+
+    @staticmethod
+    def paint_heights(entry):
+        """AutoPainter heights (float32, 0-4095 scale like the rule ranges) without HG2 flag bits."""
+        return HeightmapCache.extra(entry, "paint_heights", lambda: HeightmapCache.to_paint_heights(
+            entry["heights"], HeightmapCache.height_bits(entry["key"][0])))
+
+    @staticmethod
+    def height_bits(path):
+        """Height bits of the raw words in a heightmap file (None: plain 16-bit)."""
+        path = path.lower()
+        if path.endswith(".hgt"):
+            return HG2Codec.HGT_BITS
+        if path.endswith(".hg2"):
+            return HG2Codec.HG2_BITS
+        return None
+
+    @staticmethod
+    def to_paint_heights(raw, bits=None):
+        """Raw 16-bit words (any window of them) -> paint heights; bits as in height_bits()."""
+        if bits:
+            heights, _ = HG2Codec.split(np.asarray(raw), bits)
+            arr = heights.astype(np.float32)
+            arr *= np.float32(4095.0 / HG2Codec.height_mask(bits))
+        else:
+            arr = np.asarray(raw).astype(np.float32)
+            arr /= 65535.0
+            arr *= 4095.0
+        return arr
+
+    @staticmethod
+    def slope(entry, spacing, scale_factor=0.1, kernel="central"):
+        """Slope in degrees of paint_heights(), computed once per kernel and grid spacing."""
+        return HeightmapCache.extra(entry, ("slope", kernel, spacing, scale_factor), lambda: AutoPainter.calculate_slope_map(
+            HeightmapCache.paint_heights(entry), scale_factor, spacing, kernel))
+
+
+class HGZFile:
+    """
+    Compressed zone cache, stored as a "<file>.hgz" sidecar next to any heightmap.
+    Each zone is zlib- or lzma-compressed behind an offset table, and zones
+    holding a single value store only that value, so flat stock maps shrink
+    to the table. The sidecar records the source's mtime/size (and for HGT
+    the sibling TRN's mtime) and is ignored once either changes or, for HGT,
+    the zone counts differ. Zones decompress lazily (zone()) or
+    all at once on a thread pool (detile()); both codecs release the GIL.
+    Values are the source's raw 16-bit words (HG2 flag bits included).
+    """
+
+    EXT = ".hgz"
+    MAGIC = b"HGZ2"
+    # magic, codec, zone, width, height, x_zones, z_zones, source mtime_ns, source size, TRN mtime_ns (HGT, else 0)
+    HEADER = struct.Struct("<4sHHIIHHQQQ")
+    ENTRY = struct.Struct("<QIH")  # data offset, compressed length (0 = flat zone), flat value
+    CODECS = {"zlib": 0, "lzma": 1}
+    DEFAULT_ZONE = 128  # zone size used for non-HG2 sources
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            head = f.read(HGZFile.HEADER.size)
+            if len(head) < HGZFile.HEADER.size:
+                raise ValueError("Truncated HGZ header.")
+            (magic, codec, self.zone_size, self.width, self.height,
+             self.zw, self.zl, self.src_mtime, self.src_size, self.trn_mtime) = HGZFile.HEADER.unpack(head)
+            if magic != HGZFile.MAGIC:
+                raise ValueError("Not an HGZ file.")
+            table = f.read(HGZFile.ENTRY.size * self.zw * self.zl)
+        self.entries = list(HGZFile.ENTRY.iter_unpack(table))
+        self.decompress = lzma.decompress if codec == HGZFile.CODECS["lzma"] else zlib.decompress
+        self.blob = np.memmap(path, dtype=np.uint8, mode="r")
+
+    @staticmethod
+    def path_for(src_path):
+        return src_path + HGZFile.EXT
+
+    @staticmethod
+    def fresh_for(src_path, zw=None, zl=None):
+        """
+        The sidecar of src_path if it exists and matches the source's mtime/size, else None.
+        For HGT the TRN mtime and zone counts (zw/zl as the fallback, like HG2File) must match too.
+        """
+        path = HGZFile.path_for(src_path)
+        if not os.path.exists(path):
+            return None
+        try:
+            hgz = HGZFile(path)
+            st = os.stat(src_path)
+            fresh = hgz.src_mtime == st.st_mtime_ns and hgz.src_size == st.st_size
+            if fresh and src_path.lower().endswith(".hgt"):
+                fresh = (hgz.trn_mtime == HG2File.trn_mtime(src_path) and
+                         (hgz.zw, hgz.zl) == HG2File.hgt_zone_counts(src_path, zw, zl))
+            if fresh:
+                return hgz
+        except Exception as e:
+            print(f"HGZ cache ignored ({path}): {e}")
+        return None
+
+    def zone(self, zx, zy):
+        """Decompressed (zone, zone) uint16 array for one zone."""
+        offset, length, value = self.entries[zy * self.zw + zx]
+        if length == 0:
+            return np.full((self.zone_size, self.zone_size), value, dtype=np.uint16)
+        raw = self.decompress(self.blob[offset : offset + length])
+        return np.frombuffer(raw, dtype="<u2").reshape(self.zone_size, self.zone_size)
+
+    def detile(self, workers=None):
+        """Full (height, width) uint16 array, zones decompressed in parallel."""
+        zs = self.zone_size
+        out = np.empty((self.zl * zs, self.zw * zs), dtype=np.uint16)
+        tiled = out.reshape(self.zl, zs, self.zw, zs).transpose(0, 2, 1, 3)
+
+        def fill(i):
+            zy, zx = divmod(i, self.zw)
+            tiled[zy, zx] = self.zone(zx, zy)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(fill, range(self.zw * self.zl)))
+        return out[:self.height, :self.width]
+
+    @staticmethod
+    def write(src_path, codec="zlib", level=None, workers=None, zw=None, zl=None):
+        """Builds the sidecar for src_path. Returns (sidecar bytes, raw height bytes)."""
+        st = os.stat(src_path)
+        trn_mtime = HG2File.trn_mtime(src_path) if src_path.lower().endswith(".hgt") else 0
+        hg = None
+        if src_path.lower().endswith((".hg2", ".hgt")):
+            hg = HG2File(src_path, zw, zl)
+            zones, zone = hg.data, hg.zone_size
+            width, height = hg.width, hg.height
+        else:
+            heights = load_height16(src_path)
+            zone = HGZFile.DEFAULT_ZONE
+            height, width = heights.shape
+            padded = np.zeros((-(-height // zone) * zone, -(-width // zone) * zone), dtype=np.uint16)
+            padded[:height, :width] = heights
+            zones = padded.reshape(padded.shape[0] // zone, zone, padded.shape[1] // zone, zone).transpose(0, 2, 1, 3)
+        n_zl, n_zw = zones.shape[:2]
+
+        if codec == "lzma":
+            compress = lambda data: lzma.compress(data, preset=6 if level is None else level)
+        else:
+            compress = lambda data: zlib.compress(data, 6 if level is None else level)
+
+        def pack(i):
+            block = zones[i // n_zw, i % n_zw]
+            lo = int(block.min())
+            if lo == int(block.max()):
+                return None, lo
+            return compress(np.ascontiguousarray(block, dtype="<u2").tobytes()), 0
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                packed = list(pool.map(pack, range(n_zw * n_zl)))
+        finally:
+            if hg is not None:
+                hg.close()
+
+        out_path = HGZFile.path_for(src_path)
+        tmp_path = out_path + ".tmp"
+        offset = HGZFile.HEADER.size + HGZFile.ENTRY.size * len(packed)
+        with open(tmp_path, "wb") as f:
+            f.write(HGZFile.HEADER.pack(HGZFile.MAGIC, HGZFile.CODECS[codec], zone, width, height,
+                                        n_zw, n_zl, st.st_mtime_ns, st.st_size, trn_mtime))
+            for data, value in packed:
+                f.write(HGZFile.ENTRY.pack(offset, len(data) if data else 0, value))
+                offset += len(data) if data else 0
+            for data, _ in packed:
+                if data:
+                    f.write(data)
+        os.replace(tmp_path, out_path)
+        return os.path.getsize(out_path), width * height * 2
+
+def load_height16(path):
+    """
+    Full-resolution 16-bit heights from an image or raw export. RAW16 comes
+    back as its memmap; R32 and float TIFFs are normalized like R32.
+    """
+    if RawHeightmap.is_raw(path):
+        src = RawHeightmap.open_height16(path)
+        return src if isinstance(src, np.memmap) else src.to_uint16()
+    with Image.open(path) as img:
+        if img.mode == "F":
+            raw = np.array(img)
+            lo, hi = float(np.nanmin(raw)), float(np.nanmax(raw))
+            if lo >= 0.0 and hi <= 1.0:
+                lo, hi = 0.0, 1.0
+            return ScaledHeights(raw, lo, 65535.0 / max(hi - lo, 1e-12)).to_uint16()
+        return np.array(img.convert("I;16"))
+
+HEIGHTMAP_CACHE = HeightmapCache()
+
+class MaskCache:
+    """
+    Thresholded AutoPainter image masks, packed 8 pixels per byte and keyed by
+    (path, mtime, target size, threshold). Shared by every rule and every run
+    in the process; the least recently used masks go once max_bytes is hit.
+    """
+
+    def __init__(self, max_bytes=64 << 20):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_key(path, shape, threshold):
+        return (os.path.abspath(path), os.stat(path).st_mtime_ns, tuple(shape), threshold)
+
+    @staticmethod
+    def load(path, shape, threshold):
+        h, w = shape
+        with Image.open(path) as img:
+            mask_img = img.convert("L")
+        if mask_img.size != (w, h):
+            mask_img = mask_img.resize((w, h), Image.Resampling.BILINEAR)
+        return np.packbits(np.asarray(mask_img) > threshold, axis=1)
+
+    @staticmethod
+    def unpack(packed, width, window=None):
+        """Boolean mask from packbits(axis=1) rows; window (y0, y1, x0, x1) unpacks just that block."""
+        if window is None:
+            return np.unpackbits(packed, axis=1, count=width).view(bool)
+        y0, y1, x0, x1 = window
+        b0 = x0 >> 3
+        bits = np.unpackbits(packed[y0:y1, b0:(x1 + 7) >> 3], axis=1)
+        return bits[:, x0 - (b0 << 3):x1 - (b0 << 3)].view(bool)
+
+    def get(self, path, shape, threshold=127, window=None):
+        """
+        Boolean (h, w) mask: pixels of the image at path brighter than threshold.
+        window (y0, y1, x0, x1) returns just that block of the full-size mask.
+        """
+        key = MaskCache.make_key(path, shape, threshold)
+        return self.cached(key, lambda: MaskCache.load(path, shape, threshold), shape[1], window)
+
+    def cached(self, key, build, width, window=None):
+        """
+        Mask for any key whose first two items are (source, version); a miss
+        stores build()'s packed bits. Unpacked like get().
+        """
+        with self.lock:
+            packed = self.entries.get(key)
+            if packed is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+        if packed is None:
+            packed = build()
+            with self.lock:
+                self.misses += 1
+                # An edited mask replaces its stale versions
+                for old in [k for k in self.entries if k[0] == key[0] and k[1] != key[1]]:
+                    self.nbytes -= self.entries.pop(old).nbytes
+                if key not in self.entries and packed.nbytes <= self.max_bytes:
+                    self.entries[key] = packed
+                    self.nbytes += packed.nbytes
+                self.trim()
+        return MaskCache.unpack(packed, width, window)
+
+    def trim(self):
+        while self.entries and self.nbytes > self.max_bytes:
+            self.nbytes -= self.entries.popitem(last=False)[1].nbytes
+
+    def set_limit(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self.trim()
+
+    def summary(self):
+        with self.lock:
+            return (f"Mask cache: {self.hits} hits, {self.misses} misses, {len(self.entries)} masks, "
+                    f"{self.nbytes / 1048576:.1f}/{self.max_bytes / 1048576:.0f} MB")
+
+MASK_CACHE = MaskCache()
+
+class PathMaskLayer:
+    """
+    BZN AI paths indexed by label for PATH:<label> rule masks. Paths are drawn
+    in world space: bounds are the TRN (MinX, MinZ, Width, Depth) in meters, so
+    heightmap row 0 is MinZ like the HG2 zones. Each (label, size) is rasterized
+    once and kept as packed bits until the BZN file, bounds or line width change.
+    """
+
+    DEFAULT_BOUNDS = (0.0, 0.0, 1280.0, 1280.0)
+
+    def __init__(self, paths, source=None, bounds=None, line_width=8.0):
+        self.source = source
+        self.mtime = os.stat(source).st_mtime_ns if source and os.path.exists(source) else None
+        self.bounds = tuple(bounds) if bounds else PathMaskLayer.DEFAULT_BOUNDS
+        self.line_width = line_width
+        self.masks = {}
+        self.lock = threading.Lock()
+        self.set_paths(paths)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def set_paths(self, paths):
+        paths = list(paths)
+        by_label = {}
+        for p in paths:
+            by_label.setdefault(p['label'], p)  # first one wins, like the old linear scan
+        with self.lock:
+            self.paths, self.by_label = paths, by_label
+            self.masks = {}
+
+    @staticmethod
+    def read_paths(path):
+        with open(path, "rb") as f:
+            parser = BinaryBZNParser(f.read())
+        # Fall back to the heuristic scan if the structured load finds nothing
+        return parser.load() or parser.scan_for_paths()
+
+    @staticmethod
+    def load(path, bounds=None, line_width=8.0):
+        return PathMaskLayer(PathMaskLayer.read_paths(path), path, bounds, line_width)
+
+    @staticmethod
+    def of(bzn_paths):
+        """Use a plain list of path dicts (uncached, default bounds) where a layer is expected."""
+        return bzn_paths if isinstance(bzn_paths, PathMaskLayer) else PathMaskLayer(bzn_paths or [])
+
+    def configure(self, bounds=None, line_width=None):
+        bounds = tuple(bounds) if bounds else self.bounds
+        line_width = self.line_width if line_width is None else line_width
+        with self.lock:
+            if bounds != self.bounds or line_width != self.line_width:
+                self.bounds, self.line_width = bounds, line_width
+                self.masks = {}
+
+    def refresh(self):
+        """Re-read the BZN if it changed on disk. Returns True if it did."""
+        if not self.source or not os.path.exists(self.source):
+            return False
+        mtime = os.stat(self.source).st_mtime_ns
+        if mtime == self.mtime:
+            return False
+        self.set_paths(PathMaskLayer.read_paths(self.source))
+        self.mtime = mtime
+        return True
+
+    def prepare(self, labels, shape):
+        """Once per run: pick up BZN edits, then rasterize every referenced label once."""
+        self.refresh()
+        for label in dict.fromkeys(labels):
+            self.mask(label, shape)
+
+    def mask(self, label, shape, window=None):
+        """Boolean mask of one label at shape (window as in MaskCache.unpack)."""
+        key = (label, tuple(shape))
+        with self.lock:
+            # One consistent view: configure/set_paths swap in a new masks dict,
+            # so a mask drawn against old paths or bounds lands in the old dict
+            masks, path, bounds, line_width = self.masks, self.by_label.get(label), self.bounds, self.line_width
+            packed = masks.get(key)
+        if packed is None:
+            bits = PathMaskLayer.rasterize(path, shape, bounds, line_width)
+            packed = np.packbits(bits, axis=1)
+            with self.lock:
+                masks[key] = packed
+        return MaskCache.unpack(packed, shape[1], window)
+
+    @staticmethod
+    def world_to_pixel(points, bounds, shape):
+        """
+        World (x, z) meters -> (column, row) floats on an (h, w) image covering
+        bounds (MinX, MinZ, Width, Depth). Row 0 is MinZ, as in the de-tiled
+        HG2/HGT and the MAT, so nothing is flipped.
+        """
+        min_x, min_z, width, depth = bounds
+        h, w = shape
+        pts = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        return np.column_stack(((pts[:, 0] - min_x) * (w / width), (pts[:, 1] - min_z) * (h / depth)))
+
+    @staticmethod
+    def rasterize(path, shape, bounds, line_width):
+        """Boolean (h, w) mask of one path: loops (type 3) are filled, others drawn line_width meters wide."""
+        h, w = shape
+        if not path or not path['points']:
+            return np.zeros((h, w), dtype=bool)
+
+        pts = [tuple(p) for p in PathMaskLayer.world_to_pixel(path['points'], bounds, shape).tolist()]
+        lw = max(1, int(round(line_width * (w / bounds[2] + h / bounds[3]) / 2)))
+
+        img = Image.new('L', (w, h), 0)
+        draw = ImageDraw.Draw(img)
+        if path['type'] == 3 and len(pts) > 2:  # Loop
+            draw.polygon(pts, fill=255)
+        elif len(pts) > 1:
+            draw.line(pts, fill=255, width=lw, joint="curve")
+        else:
+            (px, pz), r = pts[0], lw / 2
+            draw.ellipse((px - r, pz - r, px + r, pz + r), fill=255)
+        return np.asarray(img) > 127
+
+class TerrainLayers:
+    """
+    Heightmap-derived AutoPainter masks for LAYER:<layer><op><value> rules,
+    e.g. LAYER:flow>=1000, LAYER:twi>10 or LAYER:channel<=30:
+      flow    - D8 flow accumulation: full-resolution cells draining through each cell
+      twi     - topographic wetness index ln(a / tan(slope)), a in m^2 per m of contour
+      channel - meters to the nearest cell with flow >= CHANNEL_FLOW
+    Depressions are filled first, so pits drain over their spill point
+    instead of swallowing the flow (a filled pit's cells all get the flow
+    through it, like a lake bed). The fields are computed once per heightmap
+    (by its HeightmapCache key and grid spacing) on an area-averaged proxy
+    of at most MAX_SIDE pixels a side, then stretched back to the mask size;
+    the masks themselves go through MASK_CACHE. A 2048 proxy costs about
+    5x the time and 1 GB, hence the cap: on bigger maps a channel is at
+    least one proxy cell (factor pixels) wide.
+    """
+
+    SPEC = re.compile(r"^\s*(flow|twi|channel)\s*(>=|<=|>|<)\s*([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)\s*$", re.IGNORECASE)
+    OPS = {">=": np.greater_equal, "<=": np.less_equal, ">": np.greater, "<": np.less}
+    MAX_SIDE = 1024
+    CHANNEL_FLOW = 1000
+    BAND_ROWS = 256
+    FAR = 1e9  # "no channel anywhere" distance; stays finite so interpolation does not make NaNs
+    D8 = ((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1))
+
+    def __init__(self, max_entries=2):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # (heightmap key, spacing) -> fields
+        self.source = None
+        self.lock = threading.Lock()
+
+    def bind(self, key, read, shape, bits=None, spacing=1.0, log=None):
+        """
+        Point LAYER: masks at a heightmap. key is its HeightmapCache key,
+        read(y0, y1, x0, x1) returns raw words (bits as in height_bits) and
+        spacing is meters per pixel, one number or (row, col). Nothing is
+        computed until a layer mask is asked for; log(message) hears about
+        each field build.
+        """
+        spacing = (float(spacing),) * 2 if np.isscalar(spacing) else tuple(float(s) for s in spacing)
+        with self.lock:
+            self.source = ((key, spacing), read, tuple(shape), bits, log)
+
+    def bound(self, key, read, shape, bits=None, spacing=1.0, log=None):
+        """
+        A copy bound to its own source (arguments as in bind()) that shares
+        this one's field cache. For paints whose read() dies with them, so
+        the global binding other threads read is left alone.
+        """
+        layers = TerrainLayers(self.max_entries)
+        layers.entries, layers.lock = self.entries, self.lock
+        layers.bind(key, read, shape, bits, spacing, log)
+        return layers
+
+    @property
+    def version(self):
+        """The bound (heightmap key, spacing), None if unbound. Part of rule stamps and mask keys."""
+        source = self.source
+        return source[0] if source else None
+
+    @staticmethod
+    def parse(spec):
+        """(layer, op, value) for "flow>=1000" and the like, None if spec is not one."""
+        m = TerrainLayers.SPEC.match(spec)
+        if not m:
+            return None
+        return m.group(1).lower(), m.group(2), float(m.group(3))
+
+    def mask(self, spec, shape, window=None):
+        """Boolean mask at shape (window as in MaskCache.unpack); None if unbound or spec is invalid."""
+        parsed = TerrainLayers.parse(spec)
+        source = self.source
+        if parsed is None or source is None:
+            return None
+        layer, op, value = parsed
+
+        def build():
+            field = self.fields(source)[layer]
+            # flow is kept as log1p(cells), which interpolates better across channels
+            threshold = np.log1p(max(value, 0.0)) if layer == "flow" else value
+            h, w = shape
+            packed = np.empty((h, (w + 7) >> 3), dtype=np.uint8)
+            for y0 in range(0, h, TerrainLayers.BAND_ROWS):
+                y1 = min(h, y0 + TerrainLayers.BAND_ROWS)
+                band = TerrainLayers.resample(field, y0, y1, shape)
+                packed[y0:y1] = np.packbits(TerrainLayers.OPS[op](band, threshold), axis=1)
+            return packed
+
+        key = (f"LAYER:{layer}{op}{value!r}", source[0], tuple(shape))
+        return MASK_CACHE.cached(key, build, shape[1], window)
+
+    def fields(self, source=None):
+        """{"flow", "twi", "channel"} proxy-resolution fields of the bound heightmap (or of a bind() snapshot)."""
+        key, read, shape, bits, log = source or self.source
+        with self.lock:
+            fields = self.entries.get(key)
+            if fields is not None:
+                self.entries.move_to_end(key)
+                return fields
+        t0 = time.perf_counter()
+        fields = TerrainLayers.compute(read, shape, bits, key[1])
+        if log:
+            ph, pw = fields["flow"].shape
+            log(f"Terrain layers (flow/twi/channel): {pw}x{ph} proxy, 1/{TerrainLayers.proxy_factor(shape)} "
+                f"of {shape[1]}x{shape[0]}, built in {time.perf_counter() - t0:.2f}s")
+        with self.lock:
+            self.entries[key] = fields
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return fields
+
+    @staticmethod
+    def proxy_factor(shape):
+        """Proxy cell size in pixels: the smallest that fits MAX_SIDE."""
+        h, w = shape
+        return min(h, w, max(1, int(math.ceil(max(h, w) / TerrainLayers.MAX_SIDE))))
+
+    @staticmethod
+    def compute(read, shape, bits, spacing):
+        factor = TerrainLayers.proxy_factor(shape)
+        z = TerrainLayers.proxy_heights(read, shape, bits, factor)
+        dz, dx = spacing[0] * factor, spacing[1] * factor  # proxy cell size in meters
+
+        filled, parent = TerrainLayers.fill_depressions(z)
+        receivers = TerrainLayers.flow_directions(filled, parent, dz, dx)
+        flow = TerrainLayers.accumulate(receivers).reshape(z.shape)
+        flow *= factor * factor
+        # A filled pit reads as one lake carrying everything that drains into it,
+        # not as parallel streaks along the flood tree to its spill point
+        lakes, count = label_regions(filled > z, structure=np.ones((3, 3)))
+        if count:
+            inflow = np.zeros(count + 1)
+            np.maximum.at(inflow, lakes.ravel(), flow.ravel())
+            flow = np.where(lakes > 0, inflow[lakes], flow)
+
+        # Specific catchment area over the local slope (0.1 m per height step); flats are clamped
+        tan_b = np.tan(np.radians(AutoPainter.calculate_slope_map(filled, 0.1, (dz, dx))))
+        area = flow * (spacing[0] * spacing[1]) / ((dz + dx) / 2)
+        twi = np.log(area / np.maximum(tan_b, 1e-3))
+
+        channel = flow >= TerrainLayers.CHANNEL_FLOW
+        if channel.any():
+            dist = distance_transform_edt(~channel, sampling=(dz, dx))
+        else:
+            dist = np.full(z.shape, TerrainLayers.FAR)
+        return {"flow": np.log1p(flow).astype(np.float32), "twi": twi.astype(np.float32),
+                "channel": dist.astype(np.float32)}
+
+    @staticmethod
+    def proxy_heights(read, shape, bits, factor):
+        """Paint heights averaged over factor x factor blocks, read a band of blocks at a time."""
+        h, w = shape
+        ph, pw = h // factor, w // factor
+        proxy = np.empty((ph, pw), dtype=np.float32)
+        step = max(1, TerrainLayers.BAND_ROWS // factor)
+        for i0 in range(0, ph, step):
+            i1 = min(ph, i0 + step)
+            band = HeightmapCache.to_paint_heights(read(i0 * factor, i1 * factor, 0, pw * factor), bits)
+            proxy[i0:i1] = band.reshape(i1 - i0, factor, pw, factor).mean(axis=(1, 3))
+        return proxy
+
+    @staticmethod
+    def fill_depressions(z):
+        """
+        Depression filling as a minimax problem: a cell's water level is the
+        lowest possible "highest point" on any D8 path to the map edge. That
+        is the largest edge on its path through the minimum spanning tree of
+        the grid (edge weight max(z_a, z_b), plus a virtual outlet joined to
+        the edge cells), so the fill is one scipy MST, one BFS and a few
+        pointer-jumping passes instead of a per-cell priority queue.
+        Returns (filled, parent); parent is each cell's next cell towards the
+        outlet along the tree (-1 on the way out), which never climbs in
+        filled height and so gives flats and filled pits a way out.
+        """
+        h, w = z.shape
+        n = h * w
+        zf = z.astype(np.float64).ravel()
+        idx = np.arange(n, dtype=np.int32).reshape(h, w)
+        # E, S, SE, SW neighbours cover every D8 pair once
+        heads = [idx[:, :-1], idx[:-1, :], idx[:-1, :-1], idx[:-1, 1:]]
+        tails = [idx[:, 1:], idx[1:, :], idx[1:, 1:], idx[1:, :-1]]
+        border = np.ones((h, w), dtype=bool)
+        border[1:-1, 1:-1] = False
+        heads.append(idx[border])
+        tails.append(np.full(np.count_nonzero(border), n, dtype=np.int32))
+        a = np.concatenate([v.ravel() for v in heads])
+        b = np.concatenate([v.ravel() for v in tails])
+        del heads, tails
+        # csgraph treats 0 as "no edge", so weights are shifted to start at 1
+        zw = np.append(zf - (zf.min() - 1.0), 0.0)
+        weights = np.maximum(zw[a], zw[b])
+        tree = minimum_spanning_tree(coo_matrix((weights, (a, b)), shape=(n + 1, n + 1)).tocsr())
+        del a, b, weights
+        _, pred = breadth_first_order(tree, n, directed=False, return_predecessors=True)
+        del tree
+
+        # Level = max tree edge to the outlet, by pointer jumping (log2 of the path length passes)
+        up = pred.astype(np.int64)
+        up[n] = n
+        level = np.maximum(zw, zw[up])
+        level[n] = 0.0
+        while (up != n).any():
+            np.maximum(level, level[up], out=level)
+            up = up[up]
+
+        filled = np.maximum(level[:n] + (zf.min() - 1.0), zf).astype(np.float32).reshape(h, w)
+        parent = pred[:n].astype(np.int64)
+        parent[parent >= n] = -1
+        return filled, parent.reshape(h, w)
+
+    @staticmethod
+    def flow_directions(filled, parent, dz, dx):
+        """D8 receivers as flat indices (-1 drains off the map): steepest drop, else the flood parent."""
+        h, w = filled.shape
+        zp = np.pad(filled, 1, constant_values=np.inf)
+        idx = np.arange(h * w, dtype=np.int64).reshape(h, w)
+        best = np.zeros((h, w), dtype=np.float32)
+        receivers = np.full((h, w), -1, dtype=np.int64)
+        for dy, dx_ in TerrainLayers.D8:
+            drop = (filled - zp[1 + dy:1 + dy + h, 1 + dx_:1 + dx_ + w]) * np.float32(1.0 / math.hypot(dy * dz, dx_ * dx))
+            steeper = drop > best
+            best[steeper] = drop[steeper]
+            receivers[steeper] = idx[steeper] + (dy * w + dx_)
+        flat = best <= 0
+        receivers[flat] = parent[flat]
+        return receivers.ravel()
+
+    @staticmethod
+    def accumulate(receivers):
+        """
+        Cells draining through each cell (itself included). Kahn-style: the
+        frontier is every cell whose donors are all done, so each step is
+        one array op and the loop runs once per cell of the longest path.
+        """
+        n = receivers.size
+        acc = np.ones(n, dtype=np.float64)
+        drains = receivers >= 0
+        pending = np.bincount(receivers[drains], minlength=n)
+        frontier = np.flatnonzero(pending == 0)
+        while frontier.size:
+            frontier = frontier[drains[frontier]]
+            down = receivers[frontier]
+            np.add.at(acc, down, acc[frontier])
+            np.subtract.at(pending, down, 1)
+            down = np.unique(down)
+            frontier = down[pending[down] == 0]
+        return acc
+
+    @staticmethod
+    def resample(field, y0, y1, shape):
+        """Rows y0:y1 of field stretched bilinearly over shape (cell centres aligned, edges clamped)."""
+        def taps(lo, hi, n, m):
+            u = (np.arange(lo, hi) + 0.5) * (m / n) - 0.5
+            np.clip(u, 0, m - 1, out=u)
+            i0 = u.astype(np.intp)
+            t = (u - i0).astype(np.float32)
+            return i0, np.minimum(i0 + 1, m - 1), t
+
+        r0, r1, ty = taps(y0, y1, shape[0], field.shape[0])
+        rows = field[r0] * (1 - ty)[:, None] + field[r1] * ty[:, None]
+        c0, c1, tx = taps(0, shape[1], shape[1], field.shape[1])
+        return rows[:, c0] * (1 - tx) + rows[:, c1] * tx
+
+TERRAIN_LAYERS = TerrainLayers()
+
+class HeightmapIndex:
+    """
+    Persistent per-folder index of heightmaps (heightmap_index.json, written
+    next to the maps, which is also where the converter exports). Entries
+    hold dimensions, depth, zone counts, height stats, TRN linkage and a
+    content hash. refresh() only re-reads files whose mtime/size changed.
+    """
+
+    INDEX_NAME = "heightmap_index.json"
+    EXTENSIONS = (".hg2", ".hgt", ".png", ".tif", ".tiff") + RawHeightmap.EXTENSIONS
+    VERSION = 1
+
+    # One index per folder, so browse and background refresh share entries and lock
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    @classmethod
+    def for_folder(cls, folder):
+        key = os.path.normcase(os.path.abspath(folder))
+        with cls._shared_lock:
+            index = cls._shared.get(key)
+            if index is None:
+                index = cls._shared[key] = cls(folder)
+            return index
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.path = os.path.join(folder, HeightmapIndex.INDEX_NAME)
+        self.entries = {}
+        self.lock = threading.Lock()
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r") as f:
+                    data = json.load(f)
+                if data.get("version") == HeightmapIndex.VERSION:
+                    self.entries = data.get("entries", {})
+            except Exception as e:
+                print(f"Heightmap Index Error: {e}")
+
+    def save(self):
+        # Unique temp name: another process may be saving the same folder's index
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with self.lock:
+            with open(tmp_path, "w") as f:
+                json.dump({"version": HeightmapIndex.VERSION, "entries": self.entries}, f, indent=1)
+            os.replace(tmp_path, self.path)
+
+    def is_current(self, name, st):
+        entry = self.entries.get(name)
+        return entry is not None and entry["mtime"] == st.st_mtime_ns and entry["size"] == st.st_size
+
+    def lookup(self, path):
+        """Entry for one file, re-described only if it changed since it was indexed."""
+        name = os.path.basename(path)
+        st = os.stat(path)
+        if not self.is_current(name, st):
+            entry = HeightmapIndex.describe(path, st)
+            with self.lock:
+                self.entries[name] = entry
+            self.save()
+        return self.entries[name]
+
+    def refresh(self):
+        """Incremental rescan of the folder. Returns the number of entries (re)built."""
+        updated = 0
+        seen = set()
+        for de in os.scandir(self.folder):
+            if not de.is_file() or not de.name.lower().endswith(HeightmapIndex.EXTENSIONS):
+                continue
+            seen.add(de.name)
+            st = de.stat()
+            if self.is_current(de.name, st):
+                continue
+            try:
+                entry = HeightmapIndex.describe(de.path, st)
+            except Exception as e:
+                print(f"Heightmap Index: skipping {de.name}: {e}")
+                continue
+            with self.lock:
+                self.entries[de.name] = entry
+            updated += 1
+
+        with self.lock:
+            removed = [name for name in self.entries if name not in seen]
+            for name in removed:
+                del self.entries[name]
+        if updated or removed:
+            self.save()
+        return updated
+
+    @staticmethod
+    def file_hash(path, chunk=1 << 20):
+        h = hashlib.blake2b(digest_size=16)
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(chunk), b""):
+                h.update(block)
+        return h.hexdigest()
+
+    @staticmethod
+    def describe(path, st=None):
+        st = st or os.stat(path)
+        ext = os.path.splitext(path)[1].lower()
+        trn_path = os.path.splitext(path)[0] + ".trn"
+        trn = TRNParser.parse(trn_path)
+        entry = {
+            "format": ext[1:], "mtime": st.st_mtime_ns, "size": st.st_size,
+            "depth": None, "zones_x": None, "zones_z": None,
+            "trn": os.path.basename(trn_path) if os.path.exists(trn_path) else None,
+            "trn_width": trn.get("Width"), "trn_depth": trn.get("Depth"),
+        }
+
+        if ext in (".hg2", ".hgt"):
+            zw = zl = None
+            if ext == ".hgt":
+                zw, zl = HG2File.hgt_zone_counts(path)
+                if not zw:
+                    # No TRN: assume a square map of 128x128 zones
+                    side = int(round(math.sqrt(st.st_size / (2 * HG2File.HGT_ZONE ** 2))))
+                    zw = zl = side
+            with HG2File(path, zw, zl) as hg:
+                entry.update(depth=hg.depth, zones_x=hg.zw, zones_z=hg.zl, width=hg.width, height=hg.height)
+                # Zone rows keep the working set small on huge maps
+                summary = HeightStats.from_hg2(hg).region()
+            lo, hi, mean = summary["min"], summary["max"], summary["mean"]
+        else:
+            arr = load_height16(path)
+            entry.update(width=arr.shape[1], height=arr.shape[0])
+            if trn.get("Width") and trn.get("Depth"):
+                entry.update(zones_x=int(round(trn["Width"] / 1280.0)), zones_z=int(round(trn["Depth"] / 1280.0)))
+            lo, hi, mean = int(arr.min()), int(arr.max()), float(arr.mean())
+
+        entry.update(min=lo, max=hi, mean=round(mean, 2), hash=HeightmapIndex.file_hash(path))
+        return entry
+
 class AutoPainter:
     """
     Handles generation of .mat files from heightmap data using configurable rules.
     Implements Marching Squares for tile transitions (Solid, Cap, Diagonal).
     """
     
+    # Separable derivative kernels: (smoothing taps, derivative taps), both normalized
+    # so a height ramp of 1 unit per pixel gives a gradient of exactly 1.
+    SLOPE_KERNELS = {
+        "horn": ((0.25, 0.5, 0.25), (-0.5, 0.0, 0.5)),
+        "sobel": ((1 / 16, 4 / 16, 6 / 16, 4 / 16, 1 / 16), (-1 / 8, -2 / 8, 0.0, 2 / 8, 1 / 8)),
+    }
+
+    @staticmethod
+    def _apply_taps(a, taps, axis):
+        """1D correlation along axis over the valid region only (the input is pre-padded)."""
+        n = a.shape[axis] - len(taps) + 1
+        out = None
+        for k, t in enumerate(taps):
+            if t == 0:
+                continue
+            part = a[k:k + n] if axis == 0 else a[:, k:k + n]
+            if out is None:
+                out = part * np.float32(t)
+            else:
+                out += part * np.float32(t)
+        return out
+
     @staticmethod
-    def calculate_slope_map(heightmap, scale_factor=1.0):
+    def calculate_slope_map(heightmap, scale_factor=1.0, spacing=1.0, kernel="central"):
         """
-        Calculates slope in degrees for each point.
+        Slope in degrees (float32) for each point.
         heightmap: 2D numpy array (0-4095 range usually)
-        scale_factor: Multiplier to convert height units to horizontal units if needed.
-                      BZ grid is 10m? Height is 0-409.5m? 
-                      Each unit in HG2 is 0.1m (0-4095 => 0-409.5m).
-                      Grid spacing is 1280m / 64 = 20m? No, depends on resolution.
-                      Let's assume standard BZ ratio for now.
-        """
-        # Simple gradient magnitude
-        gy, gx = np.gradient(heightmap)
-        slope = np.sqrt(gx**2 + gy**2)
-        # Normalize/Convert to degrees? 
-        # For now, let's keep it abstract or use a heuristic. 
-        # User rules use 0-90 degrees.
-        # atan(slope) * 180/pi
-        # We need the ratio of dz/dx. 
-        # If height is 0.1m units, and grid is X meters.
-        # Let's approximate grid as 10.0 units? 
-        # Actually simplest is to normalize to 0-90 range based on observable max.
-        return np.degrees(np.arctan(slope))
+        scale_factor: meters per height unit. BZ heights are 0.1m per step (0-4095 => 0-409.5m).
+        spacing: grid spacing in meters, one number or (row, col): TRN Width / pixel width.
+        kernel: "central" (np.gradient), "horn" (3x3, 1-2-1 weighted) or
+                "sobel" (5x5, smoother on upscaled or noisy maps).
+        The defaults give the old unit-spacing slope.
+        """
+        dz, dx = (spacing, spacing) if np.isscalar(spacing) else spacing
+        z = np.asarray(heightmap, dtype=np.float32)
+        if kernel == "central":
+            gy, gx = np.gradient(z)
+        else:
+            smooth, deriv = AutoPainter.SLOPE_KERNELS[kernel]
+            # Odd reflection extrapolates linearly, so edges keep their gradient
+            zp = np.pad(z, len(smooth) // 2, mode="reflect", reflect_type="odd")
+            gx = AutoPainter._apply_taps(AutoPainter._apply_taps(zp, smooth, 0), deriv, 1)
+            gy = AutoPainter._apply_taps(AutoPainter._apply_taps(zp, smooth, 1), deriv, 0)
+            del zp
+        gx *= np.float32(scale_factor / dx)
+        gy *= np.float32(scale_factor / dz)
+        slope = np.hypot(gx, gy, out=gx)
+        del gy
+        np.arctan(slope, out=slope)
+        return np.degrees(slope, out=slope)
 
     @staticmethod
     def rasterize_path_mask(h, w, bzn_paths, path_label):
-        """Creates a binary mask from a BZN path."""
-        mask = np.zeros((h, w), dtype=bool)
-        target_path = next((p for p in bzn_paths if p['label'] == path_label), None)
-        if not target_path:
-            return mask
-            
-        pts = target_path['points']
-        if not pts:
-            return mask
-            
-        # Rasterize using PIL
-        # BZ points are in world coords (X, Z). 
-        # We need to map them to (W, H).
-        # Heuristic: Find bounds of heightmap or assume standard 1280x1280 world.
-        # Actually, we should probably know the world size from the app.
-        # For now, let's assume the points are local to the 0-1280 range 
-        # which is common for BZ maps.
-        
-        # Scaling: BZ Maps are typically 1280m x 1280m or 640m x 640m.
-        # HG2s are 128x128 or 64x64 or 256x256.
-        # Let's assume the heightmap represents the full world.
-        
-        # Determine world bounds if possible, or use fixed 1280.0
-        world_size = 1280.0 # Standard BZ world size
-        
-        img = Image.new('L', (w, h), 0)
-        draw = ImageDraw.Draw(img)
-        
-        # Map world (X, Z) to (row, col)
-        # X -> col (0 to w)
-        # Z -> row (0 to h) - note: Z increases "down" in some BZ contexts? 
-        # In BZ, Z is North. In Screen, Y is Down.
-        
-        poly = []
-        for (x, z) in pts:
-            px = (x / world_size) * w
-            pz = (1.0 - (z / world_size)) * h # Invert Z for screen space? 
-            # Actually, let's just use (x, z) relative mapping.
-            poly.append((px, pz))
-            
-        if target_path['type'] == 3: # Loop
-            draw.polygon(poly, fill=255)
-        else:
-            draw.line(poly, fill=255, width=4) # Thickness heuristic
-            
-        return np.array(img) > 127
+        """Creates a binary mask from a BZN path (see PathMaskLayer for the world mapping)."""
+        return PathMaskLayer.of(bzn_paths).mask(path_label, (h, w))
+
+    @staticmethod
+    def range_mask(rule, height_data, slope_map):
+        """The height/slope part of a rule (works on any matching arrays, e.g. gathered pixels)."""
+        return (height_data >= rule['min_h']) & (height_data <= rule['max_h']) & \
+               (slope_map >= rule['min_s']) & (slope_map <= rule['max_s'])
+
+    @staticmethod
+    def source_mask(rule, shape, bzn_paths=None, window=None, layers=None):
+        """
+        The image or path part of a rule's mask, or None if it has none (or it cannot be loaded).
+        window (y0, x0, full_h, full_w): shape is a block at (y0, x0) of a full_h x full_w map.
+        layers: TerrainLayers for LAYER: masks, TERRAIN_LAYERS if None.
+        """
+        m_path = rule.get('mask_path')
+        if not m_path:
+            return None
+        box = None
+        if window is not None:
+            y0, x0 = window[:2]
+            box = (y0, y0 + shape[0], x0, x0 + shape[1])
+            shape = window[2:]
+        if m_path.startswith("LAYER:"):
+            # Flow / wetness / channel distance derived from the heightmap (see TerrainLayers)
+            return (layers or TERRAIN_LAYERS).mask(m_path[6:], shape, box)
+        if m_path.startswith("PATH:") and bzn_paths:
+            # Path-based mask
+            return PathMaskLayer.of(bzn_paths).mask(m_path[5:], shape, box)
+        if os.path.exists(m_path):
+            # Image-based mask (thresholded at 127, cached across rules and runs)
+            try:
+                return MASK_CACHE.get(m_path, shape, 127, box)
+            except Exception as e:
+                print(f"Mask Load Error: {e}")
+        return None
+
+    @staticmethod
+    def rule_mask(rule, height_data, slope_map, bzn_paths=None, window=None, layers=None):
+        """Where a single rule applies: its height/slope ranges plus any image or path mask."""
+        mask = AutoPainter.range_mask(rule, height_data, slope_map)
+        source = AutoPainter.source_mask(rule, height_data.shape, bzn_paths, window, layers)
+        if source is not None:
+            mask &= source
+        return mask
+
+    # Quantization of the compiled rule table (height, slope). Only affects speed:
+    # pixels in a bin that holds a rule boundary are resolved exactly.
+    RULE_BINS = (8192, 8192)
+    # Below this many unmasked rules the plain per-rule comparisons are cheaper than the table
+    RULE_TABLE_MIN = 12
+
+    @staticmethod
+    def interval_codes(values, bounds, bins):
+        """
+        Exact interval classification against the sorted breakpoints b:
+        values below b[0] get 0, equal to b[i] get 2i+1, strictly between
+        b[i] and b[i+1] get 2i+2. So "v >= b[i]" is "code >= 2i+1" and
+        "v <= b[i]" is "code <= 2i+1". Breakpoints take the dtype numpy
+        compares the values in, so the result matches the plain comparisons.
+
+        Values are first quantized into `bins` bins with a monotonic formula
+        applied identically to the breakpoints. A bin without a breakpoint
+        has one code for all its values (a table gather); values in a bin
+        that holds a breakpoint fall back to a binary search.
+        """
+        b = np.unique(np.asarray(bounds, dtype=np.result_type(values.dtype, 0.0)))
+        v = np.asarray(values, dtype=b.dtype)
+        # Spread the bins over the part of the data range the breakpoints cover
+        lo, hi = max(b[0], np.nanmin(v)), min(b[-1], np.nanmax(v))
+        lo = b.dtype.type(lo if np.isfinite(lo) else b[0])
+        scale = b.dtype.type(bins / (hi - lo) if hi > lo else 1.0)
+
+        def bin_of(x):
+            q = (x - lo) * scale
+            q += 1
+            np.fmax(q, 0, out=q)  # NaN lands in bin 0 and, like the comparisons, matches no rule
+            np.minimum(q, bins + 1, out=q)
+            return q.astype(np.int32)
+
+        qb = bin_of(b)
+        bin_codes = 2 * np.searchsorted(qb, np.arange(bins + 2), side="left").astype(np.int32)
+        bin_codes[qb] = -1  # bins holding a breakpoint
+
+        codes = bin_codes.take(bin_of(v))
+        exact = np.flatnonzero(codes < 0)
+        if exact.size:
+            sub = v.reshape(-1)[exact]
+            codes.reshape(-1)[exact] = np.searchsorted(b, sub, side="left") + np.searchsorted(b, sub, side="right")
+        return codes, b
+
+    @staticmethod
+    def classify_vertices(height_data, slope_map, rules, bzn_paths=None, window=None, layers=None):
+        """
+        Painter's-algorithm material per vertex (the last matching rule wins, 0 if none).
+        Rules without an image/path mask depend only on (height, slope), so they are
+        compiled into a small table over exact height x slope intervals and resolved
+        with one gather. Masked rules are then applied on top in priority order.
+        window, layers: see source_mask (the arrays are one block of a larger map).
+        """
+        labels = [r['mask_path'][5:] for r in rules if (r.get('mask_path') or "").startswith("PATH:")]
+        if labels and bzn_paths:
+            bzn_paths = PathMaskLayer.of(bzn_paths)
+            bzn_paths.prepare(labels, window[2:] if window else height_data.shape)
+
+        plain = [i for i, r in enumerate(rules) if not r.get('mask_path')]
+        if len(plain) < AutoPainter.RULE_TABLE_MIN:
+            vertex_mats = np.zeros(height_data.shape, dtype=np.uint8)
+            for rule in rules:
+                vertex_mats[AutoPainter.rule_mask(rule, height_data, slope_map, bzn_paths, window, layers)] = rule['mat_id']
+            return vertex_mats
+
+        h_bins, s_bins = AutoPainter.RULE_BINS
+        h_codes, hb = AutoPainter.interval_codes(height_data, [v for i in plain for v in (rules[i]['min_h'], rules[i]['max_h'])], h_bins)
+        s_codes, sb = AutoPainter.interval_codes(slope_map, [v for i in plain for v in (rules[i]['min_s'], rules[i]['max_s'])], s_bins)
+        lut = np.full((2 * len(hb) + 1, 2 * len(sb) + 1), -1, dtype=np.int16)
+        for i in plain:
+            r = rules[i]
+            h0 = 2 * np.searchsorted(hb, hb.dtype.type(r['min_h'])) + 1
+            h1 = 2 * np.searchsorted(hb, hb.dtype.type(r['max_h'])) + 1
+            s0 = 2 * np.searchsorted(sb, sb.dtype.type(r['min_s'])) + 1
+            s1 = 2 * np.searchsorted(sb, sb.dtype.type(r['max_s'])) + 1
+            lut[h0:h1 + 1, s0:s1 + 1] = i
+        h_codes *= lut.shape[1]
+        h_codes += s_codes
+        winner = lut.reshape(-1).take(h_codes)
+        del h_codes, s_codes
+
+        for i, rule in enumerate(rules):
+            if rule.get('mask_path'):
+                # Masked rules only win over lower-priority rules
+                winner[AutoPainter.rule_mask(rule, height_data, slope_map, bzn_paths, window, layers) & (winner < i)] = i
+
+        mat_ids = np.array([r['mat_id'] for r in rules] + [0]).astype(np.uint8)
+        return mat_ids[winner]
 
     @staticmethod
-    def generate_mat(height_data, rules, progress_callback=None, bzn_paths=None):
+    def generate_mat(height_data, rules, progress_callback=None, bzn_paths=None, slope_map=None,
+                     variants=None, seed=0, anti_repeat=False):
         """
         height_data: 2D numpy array (H, W)
         rules: List of dicts [{'mat_id': int, 'min_h': float, 'max_h': float, 'min_s': float, 'max_s': float}]
                Ordered by Priority (Lowest to Highest).
+        slope_map: precomputed slope in degrees (see HeightmapCache.slope), else unit-spacing slope.
+        variants: TRNParser "SolidVariants"; solid tiles then get seeded variants (see assign_variants).
         """
         h, w = height_data.shape
         # MAT resolution is half of heightmap
@@ -432,160 +2495,253 @@ class AutoPainter:
         
         # 1. Calculate Vertex Materials (Ideal)
         # Result: (H, W) array of Material IDs
-        slope_map = AutoPainter.calculate_slope_map(height_data)
-        vertex_mats = np.zeros_like(height_data, dtype=np.uint8)
-        
-        # Apply rules from bottom to top priority
-        # Default to 0
-        for rule in rules:
-            mat_id = rule['mat_id']
-            min_h, max_h = rule['min_h'], rule['max_h']
-            min_s, max_s = rule['min_s'], rule['max_s']
-            
-            # Evaluate Mask
-            mask = (height_data >= min_h) & (height_data <= max_h) & \
-                   (slope_map >= min_s) & (slope_map <= max_s)
-            
-            # Apply Image/Path Mask
-            if rule.get('mask_path'):
-                m_path = rule['mask_path']
-                if m_path.startswith("PATH:") and bzn_paths:
-                    # Path-based mask
-                    path_label = m_path[5:]
-                    mask &= AutoPainter.rasterize_path_mask(h, w, bzn_paths, path_label)
-                elif os.path.exists(m_path):
-                    # Image-based mask
-                    try:
-                        mask_img = Image.open(m_path).convert("L")
-                        if mask_img.size != (w, h):
-                            mask_img = mask_img.resize((w, h), Image.Resampling.BILINEAR)
-                        mask_arr = np.array(mask_img)
-                        mask &= (mask_arr > 127) # Threshold
-                    except Exception as e:
-                        print(f"Mask Load Error: {e}")
-
-            vertex_mats[mask] = mat_id
+        if slope_map is None:
+            slope_map = AutoPainter.calculate_slope_map(height_data)
+        vertex_mats = AutoPainter.classify_vertices(height_data, slope_map, rules, bzn_paths)
             
         # 2. Generate Tiles (Marching Squares)
+        mat_data = AutoPainter.tile_vertex_mats(vertex_mats, progress_callback)
+        if variants:
+            mat_data = AutoPainter.assign_variants(mat_data, variants, seed, anti_repeat)
+        return mat_data
+
+    @staticmethod
+    def generate_mat_tiled(source, rules, out_path, bits=None, progress_callback=None, bzn_paths=None,
+                           spacing=1.0, scale_factor=0.1, kernel="central", tile=512,
+                           variants=None, seed=0, anti_repeat=False, layers=None):
+        """
+        Out-of-core generate_mat: paints tile x tile pixel blocks and writes MAT
+        rows to out_path one band at a time, so memory is bounded by the tile
+        size instead of the map. The .mat is identical to generate_mat on
+        HeightmapCache.to_paint_heights of the whole map with the same slope.
+
+        source: an HG2File (windows come off its memmap, bits from the file)
+                or any 2D array of raw 16-bit words (bits as in height_bits).
+        Tiles start on even pixels, so every MAT tile's four vertices are in
+        one block. Each block is read with a halo for the slope kernel (and
+        two more MAT tiles for the anti-repeat pass), which is cropped again.
+        layers: TerrainLayers for LAYER: rules (see source_mask).
+        """
+        if isinstance(source, HG2File):
+            bits = source.height_bits
+            h, w = source.height, source.width
+            read = lambda y0, y1, x0, x1: source.region(x0, y0, x1, y1)
+        else:
+            h, w = source.shape
+            read = lambda y0, y1, x0, x1: source[y0:y1, x0:x1]
+        mat_h, mat_w = h // 2, w // 2
+        step = max(1, tile // 2)  # MAT tiles per block side
+        halo = len(AutoPainter.SLOPE_KERNELS[kernel][0]) // 2 if kernel in AutoPainter.SLOPE_KERNELS else 1
+        mat_halo = 2 if variants and anti_repeat else 0
+
+        with open(out_path, "wb") as f:
+            for ty0 in range(0, mat_h, step):
+                if progress_callback:
+                    progress_callback(ty0 / mat_h * 100)
+                ty1 = min(mat_h, ty0 + step)
+                band = np.empty((ty1 - ty0, mat_w), dtype=np.uint16)
+                for tx0 in range(0, mat_w, step):
+                    tx1 = min(mat_w, tx0 + step)
+                    # MAT block (plus the anti-repeat halo), its vertices, and the slope halo around them
+                    my0, my1 = max(0, ty0 - mat_halo), min(mat_h, ty1 + mat_halo)
+                    mx0, mx1 = max(0, tx0 - mat_halo), min(mat_w, tx1 + mat_halo)
+                    vy0, vy1, vx0, vx1 = 2 * my0, 2 * my1, 2 * mx0, 2 * mx1
+                    ry0, ry1 = max(0, vy0 - halo), min(h, vy1 + halo)
+                    rx0, rx1 = max(0, vx0 - halo), min(w, vx1 + halo)
+
+                    heights = HeightmapCache.to_paint_heights(read(ry0, ry1, rx0, rx1), bits)
+                    slope_map = AutoPainter.calculate_slope_map(heights, scale_factor, spacing, kernel)
+                    crop = (slice(vy0 - ry0, vy1 - ry0), slice(vx0 - rx0, vx1 - rx0))
+                    vertex_mats = AutoPainter.classify_vertices(heights[crop], slope_map[crop], rules, bzn_paths,
+                                                                window=(vy0, vx0, h, w), layers=layers)
+                    del heights, slope_map
+                    mat = AutoPainter.tile_vertex_mats(vertex_mats)
+                    if variants:
+                        mat = AutoPainter.assign_variants(mat, variants, seed, anti_repeat, origin=(my0, mx0))
+                    band[:, tx0:tx1] = mat[ty0 - my0:ty1 - my0, tx0 - mx0:tx1 - mx0]
+                f.write(band.tobytes())
+        return mat_h, mat_w
+
+    # Marching-squares shapes by 4-bit corner mask (TL=8, TR=4, BR=2, BL=1 set where the
+    # corner has the highest material): (cap, flip, rot, swap). swap puts the highest
+    # material in Base and shapes the single low corner instead (inverse corners).
+    # 0 and 15 cannot be transitions (min == max) and encode as solid tiles.
+    TILE_SHAPES = [
+        (0, 0, 0, 0),  # 0000 all base (solid)
+        (0, 0, 1, 0),  # 0001 BL corner, 90 deg
+        (0, 0, 2, 0),  # 0010 BR corner, 180 deg
+        (0, 1, 2, 0),  # 0011 bottom half
+        (0, 0, 3, 0),  # 0100 TR corner, -90 deg
+        (1, 1, 0, 0),  # 0101 diagonal TR+BL
+        (0, 1, 3, 0),  # 0110 right half
+        (0, 0, 0, 1),  # 0111 inverse corner, TL low
+        (0, 0, 0, 0),  # 1000 TL corner
+        (0, 1, 1, 0),  # 1001 left half
+        (1, 0, 0, 0),  # 1010 diagonal TL+BR
+        (0, 0, 3, 1),  # 1011 inverse corner, TR low
+        (0, 1, 0, 0),  # 1100 top half
+        (0, 0, 2, 1),  # 1101 inverse corner, BR low
+        (0, 0, 1, 1),  # 1110 inverse corner, BL low
+        (0, 0, 0, 0),  # 1111 all next (solid)
+    ]
+    _shape_bits = np.array([(rot << 4) | (flip << 6) | (cap << 7) for cap, flip, rot, _ in TILE_SHAPES], dtype=np.uint16)
+    _shape_swap = np.array([swap for _, _, _, swap in TILE_SHAPES], dtype=bool)
+
+    @staticmethod
+    def tile_vertex_mats(vertex_mats, progress_callback=None, band_rows=256):
+        """
+        (H, W) vertex materials -> (H//2, W//2) MAT entries. Each tile's four
+        corners come from strided slices, so the whole band is encoded with
+        array ops (same entries as encode_entry, variant 0).
+        """
+        h, w = vertex_mats.shape
+        mat_h, mat_w = h // 2, w // 2
         mat_data = np.zeros((mat_h, mat_w), dtype=np.uint16)
-        
-        for y in range(mat_h):
-            if progress_callback and y % 10 == 0:
-                progress_callback(y / mat_h * 100)
-                
-            for x in range(mat_w):
-                # Get the 4 corners of this tile
-                # Grid:
-                # TL(x,y)     TR(x+1,y)
-                # BL(x,y+1)   BR(x+1,y+1)
-                
-                # In numpy/image coords (row, col):
-                # TL(y,x)     TR(y, x+1)
-                # BL(y+1,x)   BR(y+1, x+1)
-                
-                # Careful with indices vs size
-                colors = [
-                    vertex_mats[y*2, x*2],     # TL
-                    vertex_mats[y*2, x*2+1],   # TR
-                    vertex_mats[y*2+1, x*2+1], # BR
-                    vertex_mats[y*2+1, x*2]    # BL
-                ]
-                
-                # Determine dominant materials
-                unique_mats = sorted(list(set(colors)))
-                
-                base_mat = unique_mats[0]
-                next_mat = unique_mats[-1] if len(unique_mats) > 1 else base_mat
-                
-                # If only 1 material -> Solid
-                if base_mat == next_mat:
-                    # Solid
-                    entry = AutoPainter.encode_entry(base_mat, base_mat, cap=0, flip=0, rot=0, variant=0)
-                else:
-                    # Transition
-                    # We only support 2-way transitions well in this format (Base -> Next).
-                    # Higher ID usually means "Overlaying" Lower ID.
-                    # So Base = Lower, Next = Higher.
-                    # But if we have [0, 2, 5], we might struggle. 
-                    # Let's simplify: Base = Min(colors), Next = Max(colors)
-                    
-                    # Generate 4-bit mask for High Priority (Next) corners
-                    # TL, TR, BR, BL order
-                    mask = 0
-                    if colors[0] == next_mat: mask |= 8 # 1000
-                    if colors[1] == next_mat: mask |= 4 # 0100
-                    if colors[2] == next_mat: mask |= 2 # 0010
-                    if colors[3] == next_mat: mask |= 1 # 0001
-                    
-                    # Look up shape
-                    cap = 0
-                    flip = 0
-                    rot = 0
-                    
-                    # Shapes (1 = Next Mat / High Priority)
-                    if mask == 0: # All Base
-                        pass # handled above
-                    elif mask == 15: # All Next
-                        base_mat = next_mat # promote
-                    
-                    # Corners (1 high corner) -> Cap
-                    elif mask == 8: # 1000 TL
-                        cap=0; flip=0; rot=0 # Check rotation later
-                    elif mask == 4: # 0100 TR
-                        cap=0; flip=0; rot=3 # -90 deg
-                    elif mask == 2: # 0010 BR
-                        cap=0; flip=0; rot=2 # 180 deg
-                    elif mask == 1: # 0001 BL
-                        cap=0; flip=0; rot=1 # 90 deg
-                        
-                    # Sides (2 adjacent) -> Cap (Side?) -> Actually traditionally "Cap" is 1 corner?
-                    # Some sets use Caps for sides too. 
-                    # If 2 corners are high, it's a Half/Half.
-                    # BZ usually handles this with Caps or Diagonals?
-                    # Let's approximate 2-side as Cap for now? Or Diagonal?
-                    # Diagonal is 1010 (Opposite).
-                    
-                    # Half/Half (Side)
-                    elif mask == 12: # 1100 Top (TL+TR)
-                        cap=0; flip=1; rot=0 
-                    elif mask == 6:  # 0110 Right (TR+BR)
-                        cap=0; flip=1; rot=3
-                    elif mask == 3:  # 0011 Bottom (BR+BL)
-                        cap=0; flip=1; rot=2
-                    elif mask == 9:  # 1001 Left (TL+BL)
-                        cap=0; flip=1; rot=1
-                        
-                    # Diagonals (Opposite)
-                    elif mask == 10: # 1010 TL+BR
-                        cap=1; flip=0; rot=0
-                    elif mask == 5:  # 0101 TR+BL
-                        cap=1; flip=1; rot=0 # or rot 1
-                        
-                    # Inverse Corners (3 High, 1 Low) -> Swap Base/Next and treat as 1 High Corner of Low
-                    # Mask 0111 (7) -> TL is Low.
-                    elif mask in [7, 11, 13, 14]:
-                        # Swap
-                        temp = base_mat
-                        base_mat = next_mat
-                        next_mat = temp
-                        # Invert mask (bitwise not & 15)
-                        inv_mask = (~mask) & 15
-                        # Re-process as Corner
-                        if inv_mask == 8: # TL
-                            cap=0; flip=0; rot=0
-                        elif inv_mask == 4: # TR
-                            cap=0; flip=0; rot=3
-                        elif inv_mask == 2: # BR
-                            cap=0; flip=0; rot=2
-                        elif inv_mask == 1: # BL
-                            cap=0; flip=0; rot=1
-                            
-                    entry = AutoPainter.encode_entry(base_mat, next_mat, cap, flip, rot, variant=0)
-                
-                mat_data[y, x] = entry
-                
+
+        for y0 in range(0, mat_h, band_rows):
+            if progress_callback:
+                progress_callback(y0 / mat_h * 100)
+            y1 = min(mat_h, y0 + band_rows)
+            # Corners: TL(2y,2x) TR(2y,2x+1) BR(2y+1,2x+1) BL(2y+1,2x)
+            top = vertex_mats[2 * y0 : 2 * y1 : 2, : 2 * mat_w]
+            bottom = vertex_mats[2 * y0 + 1 : 2 * y1 : 2, : 2 * mat_w]
+            tl, tr = top[:, 0::2], top[:, 1::2]
+            bl, br = bottom[:, 0::2], bottom[:, 1::2]
+
+            mat_data[y0:y1] = AutoPainter.encode_tiles(tl, tr, br, bl)
+
         return mat_data
 
+    @staticmethod
+    def encode_tiles(tl, tr, br, bl):
+        """MAT entries (variant 0) for tiles with the given corner materials (arrays of any one shape)."""
+        lo = np.minimum(np.minimum(tl, tr), np.minimum(br, bl))
+        hi = np.maximum(np.maximum(tl, tr), np.maximum(br, bl))
+        mask = ((tl == hi).astype(np.uint8) << 3) | ((tr == hi).astype(np.uint8) << 2) | \
+               ((br == hi).astype(np.uint8) << 1) | (bl == hi).astype(np.uint8)
+
+        swap = AutoPainter._shape_swap[mask]
+        base = np.where(swap, hi, lo).astype(np.uint16)
+        next_mat = np.where(swap, lo, hi).astype(np.uint16)
+        return AutoPainter._shape_bits[mask] | ((next_mat & 0xF) << 8) | ((base & 0xF) << 12)
+
+    @staticmethod
+    def variant_table(solid_variants):
+        """
+        (codes, looks, counts) for material ids 0-15 from TRNParser "SolidVariants".
+        codes[m, :counts[m]] are the variant letters the TRN defines for m (A only
+        when it lists none); looks[m, k] numbers the distinct map files, since
+        stock TRNs often point B/C/D at the A maps.
+        """
+        codes = np.zeros((16, 4), dtype=np.uint8)
+        looks = np.zeros((16, 4), dtype=np.uint8)
+        counts = np.ones(16, dtype=np.uint8)
+        for tid, found in (solid_variants or {}).items():
+            if not 0 <= tid < 16 or not found:
+                continue
+            names = []
+            for k, v in enumerate(sorted(found)):
+                if found[v] not in names:
+                    names.append(found[v])
+                codes[tid, k] = v
+                looks[tid, k] = names.index(found[v])
+            counts[tid] = len(found)
+        return codes, looks, counts
+
+    @staticmethod
+    def tile_hash(mat_h, mat_w, seed, materials, origin=(0, 0)):
+        """
+        (mat_h, mat_w) uint32 hash of (x, y, seed, material), integer-only so a
+        seed paints the same variants on every machine. origin: (y, x) of the
+        block's first tile in the whole MAT.
+        """
+        ys = np.arange(origin[0], origin[0] + mat_h, dtype=np.uint32)[:, None] * np.uint32(0x9E3779B1)
+        xs = np.arange(origin[1], origin[1] + mat_w, dtype=np.uint32)[None, :] * np.uint32(0x85EBCA77)
+        h = ys ^ xs
+        h ^= materials.astype(np.uint32) * np.uint32(0xC2B2AE3D)
+        h ^= np.uint32((int(seed) * 0x27D4EB2F) & 0xFFFFFFFF)
+        # murmur3 finaliser
+        h ^= h >> 16
+        h *= np.uint32(0x85EBCA6B)
+        h ^= h >> 13
+        h *= np.uint32(0xC2B2AE35)
+        h ^= h >> 16
+        return h
+
+    @staticmethod
+    def assign_variants(mat_data, solid_variants, seed=0, anti_repeat=False, origin=(0, 0)):
+        """
+        Copy of mat_data with a seeded A-D variant on every solid tile, picked
+        from the variants the TRN defines for that material. Transition tiles
+        keep variant A (the TRN only lists CapTo/DiagonalTo A maps for most).
+
+        anti_repeat: no solid tile shows the same map file as a solid
+        4-neighbour of the same material wherever the TRN has enough distinct
+        maps. Resolved as a red/black checkerboard: tiles of one colour only
+        border the other colour, so each half is fixed in one array pass.
+        A tile's result depends on tiles up to two steps away, so a block
+        (at origin in the whole MAT) with a two-tile margin matches the whole.
+        """
+        codes, looks, counts = AutoPainter.variant_table(solid_variants)
+        base = (mat_data >> 12) & 0xF
+        solid = base == ((mat_data >> 8) & 0xF)
+        mat_h, mat_w = mat_data.shape
+        h = AutoPainter.tile_hash(mat_h, mat_w, seed, base, origin)
+        count = counts[base]
+        pick = (h % count).astype(np.uint8)
+
+        if anti_repeat:
+            parity = (np.arange(origin[0], origin[0] + mat_h)[:, None] + np.arange(origin[1], origin[1] + mat_w)[None, :]) & 1
+            free = solid & (count > 1)
+            for colour in (0, 1):
+                # Bitmask of the map files used by same-material solid neighbours
+                look_bit = np.where(solid, np.left_shift(1, looks[base, pick]), 0).astype(np.uint8)
+                forbidden = np.zeros((mat_h, mat_w), dtype=np.uint8)
+                same = base[1:] == base[:-1]
+                forbidden[1:] |= np.where(same, look_bit[:-1], 0).astype(np.uint8)
+                forbidden[:-1] |= np.where(same, look_bit[1:], 0).astype(np.uint8)
+                same = base[:, 1:] == base[:, :-1]
+                forbidden[:, 1:] |= np.where(same, look_bit[:, :-1], 0).astype(np.uint8)
+                forbidden[:, :-1] |= np.where(same, look_bit[:, 1:], 0).astype(np.uint8)
+
+                # First variant in the tile's own hashed rotation that no neighbour shows
+                todo = free & (parity == colour)
+                for k in range(4):
+                    cand = ((h + np.uint32(k)) % count).astype(np.uint8)
+                    ok = todo & (k < count) & (((forbidden >> looks[base, cand]) & 1) == 0)
+                    pick[ok] = cand[ok]
+                    todo &= ~ok
+
+        variant = np.where(solid, codes[base, pick], 0).astype(np.uint16)
+        return (mat_data & np.uint16(0xFFFC)) | variant
+
+    # Preview colours for material ids 0-15
+    PREVIEW_PALETTE = np.array([
+        (90, 140, 60), (200, 180, 120), (120, 120, 120), (230, 230, 240),
+        (60, 100, 170), (150, 90, 50), (40, 90, 40), (210, 120, 60),
+        (170, 60, 60), (110, 160, 170), (180, 170, 60), (120, 80, 150),
+        (70, 60, 50), (200, 110, 170), (100, 200, 130), (250, 210, 90),
+    ], dtype=np.float32)
+
+    @staticmethod
+    def preview_rgb(mat_data, heights=None, alpha=0.65):
+        """
+        (H, W, 3) uint8 colour-coded MAT: each tile gets its base material's
+        palette colour; transition tiles blend base and next and are darkened.
+        With heights (same shape) the colours are laid over a grey height ramp.
+        """
+        base = (mat_data >> 12) & 0xF
+        next_mat = (mat_data >> 8) & 0xF
+        rgb = AutoPainter.PREVIEW_PALETTE[base]
+        transition = base != next_mat
+        rgb[transition] = (rgb[transition] + AutoPainter.PREVIEW_PALETTE[next_mat[transition]]) * 0.375
+        if heights is not None:
+            lo, hi = np.nanmin(heights), np.nanmax(heights)
+            grey = np.nan_to_num((heights - lo) * (255.0 / max(hi - lo, 1e-6)))
+            rgb *= alpha
+            rgb += (grey * (1.0 - alpha))[..., None]
+        return np.clip(rgb, 0, 255).astype(np.uint8)
+
     @staticmethod
     def encode_entry(base, next_mat, cap, flip, rot, variant=0):
         """
@@ -598,6 +2754,8 @@ class AutoPainter:
         8-11: Next
         12-15: Base
         """
+        # Plain ints: with NumPy 2, uint8 material ids would overflow in the shifts below
+        base, next_mat = int(base), int(next_mat)
         entry = 0
         entry |= (variant & 0x3)
         entry |= ((rot & 0x3) << 4)
@@ -607,18 +2765,220 @@ class AutoPainter:
         entry |= ((base & 0xF) << 12)
         return entry
 
+class AutoPainterSession:
+    """
+    AutoPainter state kept between runs of the same heightmap: the vertex materials,
+    the MAT, and each masked rule's image/path mask (packed bits). After a rule edit
+    only the vertices where an edited rule's mask flipped are re-resolved against
+    all rules, and only the MAT tiles holding vertices that changed are re-encoded.
+    """
+
+    # Re-resolving is per pixel; past this share of the map a full repaint is cheaper
+    FULL_REPAINT_FRACTION = 0.25
+    # Value bins of the height/slope index that finds a changed band's pixels
+    INDEX_BINS = 4096
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.height_data = None
+        self.slope_map = None
+        self.stamps = []        # one per rule of the last run
+        self.sources = {}       # stamp -> packed image/path mask, or None for "no mask"
+        self.index = {}         # 0 (heights) / 1 (slopes) -> (lo, scale, order, starts)
+        self.vertex_mats = None
+        self.mat = None
+        # Vertices re-resolved and tiles re-encoded by the last paint(), None after a full repaint
+        self.last_dirty = None
+        self.last_tiles = None
+
+    @staticmethod
+    def stamp(rule, bzn_paths=None):
+        """Everything a rule's result depends on besides the heightmap, including its mask file's state."""
+        m_path = rule.get('mask_path') or ""
+        source = None
+        if m_path.startswith("PATH:") and bzn_paths:
+            layer = bzn_paths if isinstance(bzn_paths, PathMaskLayer) else None
+            source = ("path", layer.mtime, layer.bounds, layer.line_width) if layer else ("paths", id(bzn_paths))
+        elif m_path.startswith("LAYER:"):
+            source = ("layer", TERRAIN_LAYERS.version)
+        elif m_path and os.path.exists(m_path):
+            source = ("image", os.stat(m_path).st_mtime_ns)
+        return (rule['mat_id'], rule['min_h'], rule['max_h'], rule['min_s'], rule['max_s'], m_path, source)
+
+    def paint(self, height_data, slope_map, rules, bzn_paths=None, progress_callback=None):
+        """Same result as AutoPainter.generate_mat. The returned MAT is owned by the session."""
+        if isinstance(bzn_paths, PathMaskLayer):
+            bzn_paths.refresh()
+        stamps = [AutoPainterSession.stamp(r, bzn_paths) for r in rules]
+
+        if self.mat is None or height_data is not self.height_data or slope_map is not self.slope_map:
+            self.reset()
+            self.height_data, self.slope_map = height_data, slope_map
+        else:
+            dirty = self.dirty_pixels(rules, stamps, bzn_paths)
+            if dirty is not None:
+                self.repaint(dirty, rules, stamps)
+                self.finish(stamps)
+                return self.mat
+
+        self.store_sources(rules, stamps, bzn_paths)
+        self.vertex_mats = AutoPainter.classify_vertices(height_data, slope_map, rules, bzn_paths)
+        self.mat = AutoPainter.tile_vertex_mats(self.vertex_mats, progress_callback)
+        self.last_dirty = self.last_tiles = None
+        self.finish(stamps)
+        return self.mat
+
+    def finish(self, stamps):
+        self.stamps = stamps
+        # Forget masks no current rule uses
+        keep = set(stamps)
+        for st in [s for s in self.sources if s not in keep]:
+            del self.sources[st]
+
+    def store_sources(self, rules, stamps, bzn_paths):
+        """Pack the image/path masks of the current rules (old ones stay until the edit is resolved)."""
+        shape = self.height_data.shape
+        for rule, st in zip(rules, stamps):
+            if st not in self.sources:
+                source = AutoPainter.source_mask(rule, shape, bzn_paths)
+                self.sources[st] = None if source is None else np.packbits(source, axis=1)
+
+    def source_bits(self, st, rows, cols):
+        packed = self.sources.get(st)
+        if packed is None:
+            return None
+        return ((packed[rows, cols >> 3] >> (7 - (cols & 7)).astype(np.uint8)) & 1).astype(bool)
+
+    def band_index(self, axis):
+        """Pixels sorted by a coarse value bin (radix sort on uint16), so a value band is one slice."""
+        if axis not in self.index:
+            data = (self.height_data if axis == 0 else self.slope_map).reshape(-1)
+            lo, hi = float(np.nanmin(data)), float(np.nanmax(data))
+            scale = (self.INDEX_BINS - 1) / (hi - lo) if hi > lo else 0.0
+            keys = (data - np.float32(lo)) * np.float32(scale)
+            np.fmax(keys, 0, out=keys)  # NaN goes to bin 0 and never matches a rule
+            keys = np.minimum(keys, self.INDEX_BINS - 1).astype(np.uint16)
+            order = np.argsort(keys, kind="stable").astype(np.int32)
+            starts = np.zeros(self.INDEX_BINS + 1, dtype=np.int64)
+            np.cumsum(np.bincount(keys, minlength=self.INDEX_BINS), out=starts[1:])
+            self.index[axis] = (lo, scale, order, starts)
+        return self.index[axis]
+
+    def band_pixels(self, axis, a, b):
+        """Flat indices of a superset of the pixels with value in [a, b]."""
+        lo, scale, order, starts = self.band_index(axis)
+        if not a <= b:
+            return order[:0]
+        # One bin of margin each side covers float32 rounding at bin edges
+        k0 = max(0, math.floor(min(max((a - lo) * scale, -2.0), self.INDEX_BINS + 1.0)) - 1)
+        k1 = min(self.INDEX_BINS - 1, math.floor(min(max((b - lo) * scale, -2.0), self.INDEX_BINS + 1.0)) + 1)
+        if k1 < k0:
+            return order[:0]
+        return order[starts[k0]:starts[k1 + 1]]
+
+    @staticmethod
+    def interval_change(a, b, c, d):
+        """Closed intervals covering the symmetric difference of [a, b] and [c, d]."""
+        if not a <= b:
+            return [(c, d)]
+        if not c <= d:
+            return [(a, b)]
+        return [(min(a, c), max(a, c)), (min(b, d), max(b, d))]
+
+    def rule_pixels(self, st, flat):
+        """Whether the rule with stamp st applies at the given flat pixels."""
+        rows, cols = np.divmod(flat, self.height_data.shape[1])
+        rule = {'min_h': st[1], 'max_h': st[2], 'min_s': st[3], 'max_s': st[4]}
+        mask = AutoPainter.range_mask(rule, self.height_data.reshape(-1)[flat], self.slope_map.reshape(-1)[flat])
+        source = self.source_bits(st, rows, cols)
+        if source is not None:
+            mask &= source
+        return mask
+
+    def dirty_pixels(self, rules, stamps, bzn_paths):
+        """
+        Flat indices of every pixel whose winning rule can have changed, or None if
+        too much changed for an incremental repaint to pay off.
+        """
+        n = self.height_data.size
+        limit = int(n * self.FULL_REPAINT_FRACTION)
+        changed = [i for i in range(max(len(stamps), len(self.stamps)))
+                   if i >= len(stamps) or i >= len(self.stamps) or stamps[i] != self.stamps[i]]
+        # New masks must be packed before candidate pixels can be checked against them
+        self.store_sources(rules, stamps, bzn_paths)
+
+        parts = []
+        total = 0
+        for i in changed:
+            old = self.stamps[i] if i < len(self.stamps) else None
+            new = stamps[i] if i < len(stamps) else None
+            recolor = old is not None and new is not None and old[1:] == new[1:]
+            if recolor:
+                bands = [(0, new[1], new[2])]  # only the material changed: its whole footprint
+            elif old is None or new is None or old[5:] != new[5:]:
+                # Added, removed or re-masked rule: both footprints
+                bands = [(0, st[1], st[2]) for st in (old, new) if st is not None]
+            else:
+                bands = [(0, a, b) for a, b in self.interval_change(old[1], old[2], new[1], new[2])] + \
+                        [(1, a, b) for a, b in self.interval_change(old[3], old[4], new[3], new[4])]
+
+            cand = np.unique(np.concatenate([self.band_pixels(axis, a, b) for axis, a, b in bands]))
+            if cand.size > limit:
+                return None
+            was = self.rule_pixels(old, cand) if old is not None else np.zeros(cand.size, dtype=bool)
+            now = self.rule_pixels(new, cand) if new is not None else np.zeros(cand.size, dtype=bool)
+            hit = cand[was | now] if recolor else cand[was ^ now]
+            total += hit.size
+            if total > limit:
+                return None
+            parts.append(hit)
+
+        return np.unique(np.concatenate(parts)) if parts else np.zeros(0, dtype=np.intp)
+
+    def repaint(self, dirty, rules, stamps):
+        """Re-resolve the dirty pixels against all rules and re-encode the MAT tiles they touch."""
+        winner = np.full(dirty.size, -1, dtype=np.int16)
+        for i, st in enumerate(stamps):
+            winner[self.rule_pixels(st, dirty)] = i
+        mat_ids = np.array([r['mat_id'] for r in rules] + [0]).astype(np.uint8)
+        new = mat_ids[winner]
+
+        flat_mats = self.vertex_mats.reshape(-1)
+        moved = new != flat_mats[dirty]
+        changed = dirty[moved]
+        flat_mats[changed] = new[moved]
+        self.last_dirty = dirty.size
+
+        # Each MAT tile covers one 2x2 vertex block
+        w = self.vertex_mats.shape[1]
+        mat_h, mat_w = self.mat.shape
+        ty, tx = np.divmod(changed, w)
+        ty >>= 1
+        tx >>= 1
+        inside = (ty < mat_h) & (tx < mat_w)
+        tiles = np.unique(ty[inside] * mat_w + tx[inside])
+        ty, tx = np.divmod(tiles, mat_w)
+        vm = self.vertex_mats
+        self.mat.reshape(-1)[tiles] = AutoPainter.encode_tiles(vm[2 * ty, 2 * tx], vm[2 * ty, 2 * tx + 1],
+                                                               vm[2 * ty + 1, 2 * tx + 1], vm[2 * ty + 1, 2 * tx])
+        self.last_tiles = tiles.size
+
 class TRNParser:
     @staticmethod
     def parse(path):
         data = {
             "MinX": 0.0, "MinZ": 0.0, "MaterialName": None,
             "Width": None, "Depth": None,
-            "TextureTypes": [] # List of found IDs
+            "TextureTypes": [], # List of found IDs
+            "SolidVariants": {} # tid -> {variant (A=0..D=3): rot-0 map name}
         }
         if not os.path.exists(path):
             return data
             
         current_section = None
+        current_tid = None
         
         try:
             with open(path, 'r') as f:
@@ -629,6 +2989,7 @@ class TRNParser:
                         
                     if line.startswith('[') and line.endswith(']'):
                         current_section = line[1:-1]
+                        current_tid = None
                         
                         # Parse Texture Types
                         if current_section.lower().startswith("texturetype"):
@@ -636,6 +2997,7 @@ class TRNParser:
                                 # Extract ID from "TextureType0" -> 0
                                 tid_str = current_section[11:] 
                                 tid = int(tid_str)
+                                current_tid = tid
                                 if tid not in data["TextureTypes"]:
                                     data["TextureTypes"].append(tid)
                             except: 
@@ -646,6 +3008,14 @@ class TRNParser:
                     if "=" in line:
                         key, val = [x.strip() for x in line.split("=", 1)]
                         
+                        # SolidA0..SolidD3 (letter case varies between stock TRNs)
+                        if current_tid is not None:
+                            m = re.match(r"solid([a-d])([0-3])$", key, re.IGNORECASE)
+                            if m and m.group(2) == "0":
+                                variants = data["SolidVariants"].setdefault(current_tid, {})
+                                variants["abcd".index(m.group(1).lower())] = val.lower()
+                            continue
+                        
                         # Global / Atlases scope
                         if key.lower() == "minx":
                             data["MinX"] = float(val)
@@ -797,6 +3167,13 @@ class BZ98TRNArchitect:
         ]
         
         self.selected_preset = tk.StringVar(value=self.map_presets[2]) # Defaults to Medium
+
+        # Auto-levels presets: fraction of samples clipped off each end (None = reset)
+        self.level_presets = {
+            "Full Range": 0.0, "Auto (0.5% clip)": 0.005,
+            "High Contrast (2% clip)": 0.02, "Reset (1.0 / 1.0)": None
+        }
+        self.hg2_levels_preset = tk.StringVar(value="Auto (0.5% clip)")
         
         self.hg2_width_meters = tk.IntVar(value=5120)
         self.hg2_depth_meters = tk.IntVar(value=5120)
@@ -833,6 +3210,24 @@ class BZ98TRNArchitect:
         self.hg2img_compat = tk.BooleanVar(value=self.config.get("hg2img_compat", True))
         self.hg2img_precision = tk.BooleanVar(value=self.config.get("hg2img_precision", True))
         self.hgt_output = tk.BooleanVar(value=self.config.get("hgt_output", False))
+        self.hg2_export_formats = {
+            "PNG 16-bit": ".png", "TIFF 16-bit": ".tif", "RAW16 (.r16)": ".r16", "R32 float (.r32)": ".r32"
+        }
+        self.hg2_export_format = tk.StringVar(value=self.config.get("hg2_export_format", "PNG 16-bit"))
+        self.hg2_incremental = tk.BooleanVar(value=self.config.get("hg2_incremental", True))
+        self.dither_modes = {
+            "None (plain divide)": "none", "Ordered (Bayer 8x8)": "ordered",
+            "Blue Noise": "blue", "Error Diffusion": "diffusion"
+        }
+        self.hg2_dither = tk.StringVar(value=self.config.get("hg2_dither", "None (plain divide)"))
+        self.hgz_cache = tk.BooleanVar(value=self.config.get("hgz_cache", False))
+        self.hg2_keep_flags = tk.BooleanVar(value=self.config.get("hg2_keep_flags", True))
+        self.mask_cache_mb = tk.IntVar(value=self.config.get("mask_cache_mb", 64))
+        self.path_width_m = tk.DoubleVar(value=self.config.get("path_width_m", 8.0))
+        self.slope_kernel = tk.StringVar(value=self.config.get("slope_kernel", "central"))
+        self.variant_seed = tk.IntVar(value=self.config.get("variant_seed", 0))
+        self.variant_anti_repeat = tk.BooleanVar(value=self.config.get("variant_anti_repeat", True))
+        self.paint_tiled = tk.BooleanVar(value=self.config.get("paint_tiled", False))
         
         # Legacy Atlas Variables
         self.legacy_source_dir = tk.StringVar()
@@ -941,7 +3336,18 @@ class BZ98TRNArchitect:
             "exp_normal": self.exp_normal.get(),
             "hg2img_compat": self.hg2img_compat.get(),
             "hg2img_precision": self.hg2img_precision.get(),
-            "hgt_output": self.hgt_output.get()
+            "hgt_output": self.hgt_output.get(),
+            "hg2_incremental": self.hg2_incremental.get(),
+            "hg2_dither": self.hg2_dither.get(),
+            "hg2_export_format": self.hg2_export_format.get(),
+            "hgz_cache": self.hgz_cache.get(),
+            "hg2_keep_flags": self.hg2_keep_flags.get(),
+            "mask_cache_mb": self.mask_cache_mb.get(),
+            "path_width_m": self.path_width_m.get(),
+            "slope_kernel": self.slope_kernel.get(),
+            "variant_seed": self.variant_seed.get(),
+            "variant_anti_repeat": self.variant_anti_repeat.get(),
+            "paint_tiled": self.paint_tiled.get()
         }
         with open(CONFIG_FILE, 'w') as f:
             json.dump(cfg, f, indent=4)
@@ -1093,6 +3499,9 @@ class BZ98TRNArchitect:
         ttk.Label(r_frame, text="Mask:").pack(side="left", padx=5)
         self.ap_mask_path = ttk.Entry(r_frame, width=15)
         self.ap_mask_path.pack(side="left")
+        ToolTip(self.ap_mask_path, "Mask image, PATH:<label> (BZN paths) or LAYER:flow>=N, LAYER:twi>=N, LAYER:channel<=meters.\n"
+                                   f"LAYER fields are computed at no more than {TerrainLayers.MAX_SIDE}px a side: on bigger "
+                                   "heightmaps they are stretched back up, so channels are at least one proxy cell wide.")
         ttk.Button(r_frame, text="...", command=self.browse_ap_mask, width=3).pack(side="left", padx=2)
         
         ttk.Button(r_frame, text="Add/Update Rule", command=self.add_paint_rule).pack(side="left", padx=10)
@@ -1112,6 +3521,15 @@ class BZ98TRNArchitect:
         
         self.rules_tree.column("Mask", width=150)
         
+        # Live MAT preview (painted at canvas resolution on a worker thread)
+        preview_frame = ttk.LabelFrame(list_frame, text=" MAT Preview ")
+        preview_frame.pack(side="right", fill="both", padx=(5, 0))
+        self.mat_preview_canvas = tk.Canvas(preview_frame, bg="#050505", highlightthickness=0, width=320, height=320)
+        self.mat_preview_canvas.pack(expand=True, fill="both", padx=5, pady=5)
+        self.mat_preview_worker = PreviewWorker(self.root, self._render_mat_preview, self._show_mat_preview)
+        self.hg2_path.trace_add("write", lambda *args: self.update_mat_preview())
+        self.slope_kernel.trace_add("write", lambda *args: self.update_mat_preview())
+        
         self.rules_tree.pack(side="left", fill="both", expand=True)
         
         # Buttons
@@ -1124,11 +3542,25 @@ class BZ98TRNArchitect:
         ttk.Button(btn_frame, text="Validate", command=self.validate_rules).pack(side="left", padx=2)
         
         ttk.Button(btn_frame, text="Load BZN Paths...", command=self.load_bzn_paths).pack(side="left", padx=2)
+        ttk.Label(btn_frame, text="Variant seed:").pack(side="left", padx=(10, 0))
+        ttk.Spinbox(btn_frame, from_=0, to=99999, increment=1, width=6, textvariable=self.variant_seed).pack(side="left", padx=2)
+        ttk.Checkbutton(btn_frame, text="Anti-repeat", variable=self.variant_anti_repeat).pack(side="left", padx=2)
         ttk.Button(btn_frame, text="Generate .MAT...", command=self.run_auto_painter).pack(side="right", padx=2)
+        ttk.Checkbutton(btn_frame, text="Low memory (tiled)", variable=self.paint_tiled).pack(side="right", padx=2)
+        ttk.Spinbox(btn_frame, from_=0, to=4096, increment=16, width=5, textvariable=self.mask_cache_mb).pack(side="right", padx=2)
+        ttk.Label(btn_frame, text="Mask cache (MB):").pack(side="right")
+        ttk.Spinbox(btn_frame, from_=1, to=200, increment=1, width=4, textvariable=self.path_width_m).pack(side="right", padx=2)
+        ttk.Label(btn_frame, text="Path width (m):").pack(side="right")
+        ttk.Combobox(btn_frame, textvariable=self.slope_kernel, values=("central", "horn", "sobel"),
+                     state="readonly", width=8).pack(side="right", padx=2)
+        ttk.Label(btn_frame, text="Slope:").pack(side="right")
         
         # Store rules
         self.paint_rules = []
         self.bzn_paths = []
+        self.paint_variants = {} # SolidVariants of the last TRN loaded here
+        self.paint_session = AutoPainterSession()
+        self.paint_running = False
         self.sort_descending = False
 
     def sort_paint_rules(self, key):
@@ -1164,19 +3596,13 @@ class BZ98TRNArchitect:
             return
             
         try:
-            with open(path, "rb") as f:
-                data = f.read()
-            
-            parser = BinaryBZNParser(data)
-            paths = parser.load()
-            
-            if not paths:
-                # Attempt heuristic scan if structured load failed
-                paths = parser.scan_for_paths()
+            paths = PathMaskLayer.load(path)
                 
             if paths:
                 self.bzn_paths = paths
-                messagebox.showinfo("BZN Loaded", f"Loaded {len(paths)} paths from {os.path.basename(path)}.\n\nYou can now use 'PATH:Label' in the Mask field.")
+                self.update_mat_preview()
+                messagebox.showinfo("BZN Loaded", f"Loaded {len(paths)} paths from {os.path.basename(path)}.\n\nYou can now use 'PATH:Label' in the Mask field.\n"
+                                    "(LAYER:flow>=N, LAYER:twi>=N and LAYER:channel<=meters work without a BZN.)")
             else:
                 messagebox.showwarning("BZN Warning", "No paths found in BZN file. It might be an ASCII BZN or a different version.")
                 
@@ -1204,35 +3630,204 @@ class BZ98TRNArchitect:
                 f"{r['min_s']} - {r['max_s']}",
                 m_name if m_name else "None"
             ))
+        self.update_mat_preview()
             
+    @staticmethod
+    def _paint_world_bounds(height_path, shape=None):
+        """
+        (MinX, MinZ, Width, Depth) in meters for the painted heightmap: its TRN, else the
+        HG2 zone count, else the standard 10m grid (128px per 1280m zone) for the given shape.
+        """
+        trn = TRNParser.parse(os.path.splitext(height_path)[0] + ".trn")
+        if trn.get("Width") and trn.get("Depth"):
+            return (trn["MinX"], trn["MinZ"], trn["Width"], trn["Depth"])
+        if height_path.lower().endswith(".hg2"):
+            try:
+                with HG2File(height_path) as hg:
+                    return (0.0, 0.0, hg.zw * 1280.0, hg.zl * 1280.0)
+            except (OSError, ValueError):
+                pass
+        if shape is not None:
+            return (0.0, 0.0, shape[1] * 10.0, shape[0] * 10.0)
+        return PathMaskLayer.DEFAULT_BOUNDS
+
+    def _paint_params(self):
+        """Snapshot of the Auto-Painter inputs, taken on the Tk thread for a worker."""
+        try:
+            width_m = float(self.path_width_m.get())
+        except (tk.TclError, ValueError):
+            width_m = None
+        try:
+            mask_cap = max(0, int(self.mask_cache_mb.get())) << 20
+        except (tk.TclError, ValueError):
+            mask_cap = None
+        try:
+            seed = int(self.variant_seed.get())
+        except (tk.TclError, ValueError):
+            seed = 0
+        return {
+            "path": self.hg2_path.get(),
+            "zw": self.hg2_target_zw.get(),
+            "zl": self.hg2_target_zl.get(),
+            "rules": [dict(r) for r in self.paint_rules],
+            "bzn_paths": self.bzn_paths,
+            "kernel": self.slope_kernel.get(),
+            "width_m": width_m,
+            "mask_cap": mask_cap,
+            "variants": self.paint_variants,
+            "seed": seed,
+            "anti_repeat": self.variant_anti_repeat.get(),
+            "tiled": self.paint_tiled.get(),
+        }
+
+    def _paint_inputs(self, p):
+        """(heights, slope) for a paint, from the heightmap cache; also applies the mask/path settings."""
+        # Load through the heightmap cache: decoded heights and the slope field
+        # are kept with the file, so rule-tuning reruns skip both
+        entry = HEIGHTMAP_CACHE.get(p["path"], p["zw"], p["zl"])
+        arr = HeightmapCache.paint_heights(entry)
+        bounds = self._paint_world_bounds(p["path"], arr.shape)
+        spacing = (bounds[3] / arr.shape[0], bounds[2] / arr.shape[1])
+        slope_map = HeightmapCache.slope(entry, spacing, 0.1, p["kernel"])
+        raw = entry["heights"]
+        TERRAIN_LAYERS.bind(entry["key"], lambda y0, y1, x0, x1: raw[y0:y1, x0:x1], raw.shape,
+                            HeightmapCache.height_bits(p["path"]), spacing, log=self.log)
+        if p["mask_cap"] is not None:
+            MASK_CACHE.set_limit(p["mask_cap"])
+        if isinstance(p["bzn_paths"], PathMaskLayer):
+            p["bzn_paths"].configure(bounds, p["width_m"])
+        return arr, slope_map
+
+    def _paint_tiled(self, p, save_path):
+        """Block-by-block paint straight to save_path; HG2/HGT heights are read off the memmap, never detiled."""
+        path = p["path"]
+        hg = HG2File(path, p["zw"], p["zl"]) if path.lower().endswith((".hg2", ".hgt")) else None
+        try:
+            source = hg if hg is not None else HeightmapCache.load(path)
+            shape = (hg.height, hg.width) if hg is not None else source.shape
+            bounds = self._paint_world_bounds(path, shape)
+            spacing = (bounds[3] / shape[0], bounds[2] / shape[1])
+            if hg is not None:
+                read = lambda y0, y1, x0, x1: hg.region(x0, y0, x1, y1)
+            else:
+                read = lambda y0, y1, x0, x1: source[y0:y1, x0:x1]
+            # Own binding: read() dies with hg below, and a preview may be reading TERRAIN_LAYERS
+            layers = TERRAIN_LAYERS.bound(HeightmapCache.make_key(path, p["zw"], p["zl"]), read, shape,
+                                          HeightmapCache.height_bits(path), spacing, log=self.log)
+            if p["mask_cap"] is not None:
+                MASK_CACHE.set_limit(p["mask_cap"])
+            if isinstance(p["bzn_paths"], PathMaskLayer):
+                p["bzn_paths"].configure(bounds, p["width_m"])
+            t0 = time.perf_counter()
+            mat_h, mat_w = AutoPainter.generate_mat_tiled(
+                source, p["rules"], save_path, bits=HeightmapCache.height_bits(path), bzn_paths=p["bzn_paths"],
+                spacing=spacing, scale_factor=0.1, kernel=p["kernel"],
+                variants=self._paint_variants(p), seed=p["seed"], anti_repeat=p["anti_repeat"], layers=layers)
+            self.log(f"Auto-Painter: tiled paint of {mat_w}x{mat_h} tiles in {(time.perf_counter() - t0) * 1000:.0f} ms")
+            self.log(MASK_CACHE.summary())
+        finally:
+            if hg is not None:
+                hg.close()
+
+    @staticmethod
+    def _paint_variants(p):
+        """Solid variants for a paint: the heightmap's own TRN if it has one, else the TRN loaded as rules."""
+        trn_path = os.path.splitext(p["path"])[0] + ".trn"
+        if os.path.exists(trn_path):
+            variants = TRNParser.parse(trn_path)["SolidVariants"]
+            if variants:
+                return variants
+        return p["variants"]
+
+    def update_mat_preview(self):
+        """Queue a preview repaint with the current rules (the worker keeps only the newest request)."""
+        if not hasattr(self, "mat_preview_worker"): return
+        path = self.hg2_path.get()
+        if not path or not os.path.exists(path) or not self.paint_rules:
+            self.mat_preview_canvas.delete("all")
+            return
+        cw = self.mat_preview_canvas.winfo_width()
+        ch = self.mat_preview_canvas.winfo_height()
+        if cw < 10: cw, ch = 320, 320
+        p = self._paint_params()
+        p.update(cw=cw, ch=ch)
+        self.mat_preview_worker.submit(p)
+
+    def _render_mat_preview(self, p, cancelled):
+        """Preview worker: paints every step-th vertex so the MAT comes out about canvas-sized."""
+        try:
+            arr, slope_map = self._paint_inputs(p)
+            if cancelled(): return None
+            h, w = arr.shape
+            step = max(1, int(math.ceil(max(w / (2.0 * p["cw"]), h / (2.0 * p["ch"])))))
+            heights = arr[::step, ::step]
+            mat = AutoPainter.generate_mat(heights, p["rules"], bzn_paths=p["bzn_paths"], slope_map=slope_map[::step, ::step])
+            if cancelled(): return None
+            mat_h, mat_w = mat.shape
+            rgb = AutoPainter.preview_rgb(mat, heights[:2 * mat_h:2, :2 * mat_w:2])
+            # Same orientation as the heightmap preview (MAT rows follow heightmap rows)
+            preview = Image.fromarray(rgb)
+            scale = min(p["cw"] / mat_w, p["ch"] / mat_h)
+            preview = preview.resize((max(1, int(mat_w * scale)), max(1, int(mat_h * scale))), Image.Resampling.NEAREST)
+            return preview, p["cw"], p["ch"]
+        except Exception as e:
+            print(f"MAT Preview Error: {e}")
+            return None
+
+    def _show_mat_preview(self, result):
+        preview, cw, ch = result
+        self.mat_tk_photo = ImageTk.PhotoImage(preview)
+        self.mat_preview_canvas.delete("all")
+        self.mat_preview_canvas.create_image(cw // 2, ch // 2, image=self.mat_tk_photo)
+
     def run_auto_painter(self):
         # 1. Get Height Data
         if not self.hg2_path.get():
              messagebox.showerror("Error", "Please select an input image/HG2 first.")
              return
-             
-        # Load Data similar to convert worker
+        if self.paint_running:
+            self.log("Auto-Painter: still painting the previous run.", "warning")
+            return
+
+        save_path = filedialog.asksaveasfilename(defaultextension=".mat", filetypes=[("Material Map", "*.mat")])
+        if not save_path:
+            return
+        p = self._paint_params()
+        self.paint_running = True
+        threading.Thread(target=self._auto_painter_worker, args=(p, save_path), daemon=True).start()
+
+    def _auto_painter_worker(self, p, save_path):
+        """Paints and writes the .mat off the Tk thread."""
         try:
-            img = Image.open(self.hg2_path.get()).convert("I;16")
-            arr = np.array(img).astype(np.float32)
-            # Replicate scaling logic used in HG2
-            is_hg2 = self.hg2_path.get().lower().endswith(".hg2")
-            
-            if not is_hg2:
-                arr = (arr / 65535.0) * 4095.0
-            
-            # Run Painter
-            mat_data = AutoPainter.generate_mat(arr, self.paint_rules, bzn_paths=self.bzn_paths)
-            
-            # Save
-            save_path = filedialog.asksaveasfilename(defaultextension=".mat", filetypes=[("Material Map", "*.mat")])
-            if save_path:
-                with open(save_path, "wb") as f:
-                    f.write(mat_data.tobytes()) # Numpy tobytes writes simple binary array
-                messagebox.showinfo("Success", f"Saved {save_path}")
-                
+            if p["tiled"]:
+                self._paint_tiled(p, save_path)
+                self.root.after(0, lambda: messagebox.showinfo("Success", f"Saved {save_path}"))
+                return
+            arr, slope_map = self._paint_inputs(p)
+            # Reruns on the same heightmap only repaint where the edited rules changed something
+            t0 = time.perf_counter()
+            mat_data = self.paint_session.paint(arr, slope_map, p["rules"], p["bzn_paths"])
+            elapsed = (time.perf_counter() - t0) * 1000
+            if self.paint_session.last_dirty is None:
+                self.log(f"Auto-Painter: full repaint in {elapsed:.0f} ms")
+            else:
+                self.log(f"Auto-Painter: {self.paint_session.last_dirty} vertices re-resolved, "
+                         f"{self.paint_session.last_tiles} tiles re-encoded in {elapsed:.0f} ms")
+            self.log(MASK_CACHE.summary())
+
+            # Variants go on a copy so the session keeps its variant-free MAT for the next rerun
+            variants = self._paint_variants(p)
+            if variants:
+                mat_data = AutoPainter.assign_variants(mat_data, variants, p["seed"], p["anti_repeat"])
+                self.log(f"Auto-Painter: solid variants from {len(variants)} texture types (seed {p['seed']})")
+
+            with open(save_path, "wb") as f:
+                f.write(mat_data.tobytes()) # Numpy tobytes writes simple binary array
+            self.root.after(0, lambda: messagebox.showinfo("Success", f"Saved {save_path}"))
         except Exception as e:
-            messagebox.showerror("Error", f"Failed: {e}")
+            self.root.after(0, lambda e=e: messagebox.showerror("Error", f"Failed: {e}"))
+        finally:
+            self.paint_running = False
 
     def load_auto_painter_config(self):
         path = filedialog.askopenfilename(filetypes=[("Paint Config", "*.trn *.ini *.txt"), ("All Files", "*.*")])
@@ -1244,6 +3839,7 @@ class BZ98TRNArchitect:
         if ext == ".trn":
             # Load TRN -> Auto-populate materials
             data = TRNParser.parse(path)
+            self.paint_variants = data["SolidVariants"]
             if not data.get("TextureTypes"):
                 messagebox.showwarning("Warning", "No [TextureTypeX] sections found in TRN.")
                 return
@@ -1376,34 +3972,55 @@ class BZ98TRNArchitect:
         self.refresh_rules_list()
 
     def browse_hg2(self):
-        path = filedialog.askopenfilename(filetypes=[("Heightmaps", "*.hg2 *.hgt *.png *.bmp")])
+        path = filedialog.askopenfilename(filetypes=[("Heightmaps", "*.hg2 *.hgt *.png *.bmp *.tif *.tiff *.r16 *.raw *.r32")])
         if path:
             self.hg2_path.set(path)
-            # Auto-detect dimensions if it's an HG2
-            if path.lower().endswith(".hg2"):
-                try:
-                    with open(path, "rb") as f:
-                        header = f.read(12)
-                        _, _, z_w, z_l, _, _ = struct.unpack("<HHHHHH", header)
-                        self.hg2_target_zw.set(z_w)
-                        self.hg2_target_zl.set(z_l)
-                except:
-                    pass
-            elif path.lower().endswith(".hgt"):
-                try:
-                    trn_path = os.path.splitext(path)[0] + ".trn"
-                    trn = TRNParser.parse(trn_path)
-                    if trn.get("Width") and trn.get("Depth"):
-                        zw = int(round(trn["Width"] / 1280.0))
-                        zl = int(round(trn["Depth"] / 1280.0))
-                        if zw > 0 and zl > 0:
-                            self.hg2_target_zw.set(zw)
-                            self.hg2_target_zl.set(zl)
-                except:
-                    pass
+            # Auto-detect dimensions from the folder index. A new or changed file gets
+            # hashed and scanned, so that runs on a worker and lands via root.after.
+            threading.Thread(target=self._lookup_heightmap_index, args=(path,), daemon=True).start()
             # Trigger preview update after selection
             self.update_hg2_preview()
             
+    def apply_heightmap_info(self, entry):
+        """Auto-fill zone counts and the size preset from an index entry."""
+        zw, zl = entry.get("zones_x"), entry.get("zones_z")
+        if zw and zl:
+            self.hg2_target_zw.set(zw)
+            self.hg2_target_zl.set(zl)
+            self.hg2_width_meters.set(zw * 1280)
+            self.hg2_depth_meters.set(zl * 1280)
+            preset = next((p for p in self.map_presets if f"({zw * 1280}m)" in p), "Custom") if zw == zl else "Custom"
+            self.preset_var.set(preset)
+
+        info = f"{entry['width']}x{entry['height']} {entry['format'].upper()}"
+        if entry.get("depth") is not None:
+            info += f", depth {entry['depth']}"
+        if zw and zl:
+            info += f", {zw}x{zl} zones"
+        info += f"\nHeights {entry['min']}-{entry['max']} (mean {entry['mean']:.0f})"
+        if entry.get("trn"):
+            info += f", TRN: {entry['trn']}"
+        self.hg2_index_info.config(text=info)
+
+    def _lookup_heightmap_index(self, path):
+        try:
+            index = HeightmapIndex.for_folder(os.path.dirname(path))
+            entry = index.lookup(path)
+        except Exception as e:
+            self.log(f"Heightmap index unavailable: {e}", "warning")
+            return
+        # Skip if the user picked another file while this one was being described
+        self.root.after(0, lambda: self.hg2_path.get() == path and self.apply_heightmap_info(entry))
+        self._refresh_heightmap_index(index)
+
+    def _refresh_heightmap_index(self, index):
+        try:
+            updated = index.refresh()
+            if updated:
+                self.log(f"Heightmap index: {updated} file(s) indexed in {index.folder}", "info")
+        except Exception as e:
+            self.log(f"Heightmap index refresh failed: {e}", "warning")
+
     def load_mission_overlay(self):
         # 1. Ask for BZN file (ASCII)
         bzn_path = filedialog.askopenfilename(title="Select Mission File (ASCII)", filetypes=[("Battlezone Mission", "*.bzn")])
@@ -1445,9 +4062,10 @@ class BZ98TRNArchitect:
         if not dir_path:
             return
             
-        # Common filenames
+        # Common filenames (WM/Gaea raw and TIFF exports count for the heightmap)
+        height_exts = (".png", ".tif", ".tiff", ".r16", ".raw", ".r32")
         files = {
-            "height": ["Heightmap.png", "Height.png", "output.png"],
+            "height": [stem + ext for stem in ("Heightmap", "Height", "output") for ext in height_exts],
             "flow": ["Flow.png", "erosion_flow.png"],
             "slope": ["Slopes.png", "Slope.png", "erosion_slope.png"]
         }
@@ -1461,7 +4079,7 @@ class BZ98TRNArchitect:
                     break
                     
         if not found.get("height"):
-            messagebox.showerror("By the Beard!", "Could not find a heightmap (Heightmap.png) in this folder.")
+            messagebox.showerror("By the Beard!", "Could not find a heightmap (Heightmap.png/.tif/.r16/.r32) in this folder.")
             return
             
         # 1. Set HG2 Path
@@ -1471,6 +4089,7 @@ class BZ98TRNArchitect:
         # 2. Setup Auto-Painter Rules
         msg = f"Found:\n- Height: {os.path.basename(found['height'])}\n"
         if found.get('flow'): msg += f"- Flow: {os.path.basename(found['flow'])}\n"
+        else: msg += "- Flow: none, derived from the heightmap (LAYER:flow)\n"
         if found.get('slope'): msg += f"- Slope: {os.path.basename(found['slope'])}\n"
         msg += "\nAuto-populate paint rules based on these masks?"
         
@@ -1486,9 +4105,11 @@ class BZ98TRNArchitect:
             else:
                  self.add_paint_rule_internal(1, 0, 4095, 30, 90)
                  
-            # Rule 3: Flow/Grass (Using Flow mask)
+            # Rule 3: Flow/Grass (Using Flow mask, else flow accumulation from the heightmap)
             if found.get("flow"):
                 self.add_paint_rule_internal(2, 0, 4095, 0, 90, mask_path=found["flow"])
+            else:
+                self.add_paint_rule_internal(2, 0, 4095, 0, 90, mask_path=f"LAYER:flow>={TerrainLayers.CHANNEL_FLOW}")
                 
             self.notebook.select(self.tab_paint)
             messagebox.showinfo("Success", "World Machine project imported. Rules populated in Auto-Painter.")
@@ -1504,64 +4125,18 @@ class BZ98TRNArchitect:
         
         self.btn_hg2_png.config(text="CONVERTING...", state="disabled")
         try:
-            if path.lower().endswith(".hg2"):
-                with open(path, "rb") as f:
-                    header = f.read(12)
-                    _, depth, z_w, z_l, _, _ = struct.unpack("<HHHHHH", header)
-                    
-                    zone_size = 2**depth
-                    full_w, full_h = z_w * zone_size, z_l * zone_size
-                    
-                    raw_data = np.frombuffer(f.read(), dtype=np.uint16)
-                    img_array = np.zeros((full_h, full_w), dtype=np.uint16)
-                    
-                    idx = 0
-                    for zy in range(z_l):
-                        for zx in range(z_w):
-                            start_x, start_y = zx * zone_size, zy * zone_size
-                            zone_data = raw_data[idx : idx + (zone_size * zone_size)]
-                            if zone_data.size == (zone_size * zone_size):
-                                img_array[start_y:start_y+zone_size, start_x:start_x+zone_size] = \
-                                    zone_data.reshape((zone_size, zone_size))
-                            idx += (zone_size * zone_size)
-            elif path.lower().endswith(".hgt"):
-                zone_size = 128
-                z_w = self.hg2_target_zw.get()
-                z_l = self.hg2_target_zl.get()
-                
-                trn_path = os.path.splitext(path)[0] + ".trn"
-                trn = TRNParser.parse(trn_path)
-                if trn.get("Width") and trn.get("Depth"):
-                    zw = int(round(trn["Width"] / 1280.0))
-                    zl = int(round(trn["Depth"] / 1280.0))
-                    if zw > 0 and zl > 0:
-                        z_w, z_l = zw, zl
-                
-                with open(path, "rb") as f:
-                    raw_data = np.frombuffer(f.read(), dtype=np.uint16)
-                
-                expected = z_w * z_l * zone_size * zone_size
-                if raw_data.size != expected:
-                    raise ValueError(f"Invalid HGT size. Expected {expected} entries, got {raw_data.size}.")
-                
-                full_w, full_h = z_w * zone_size, z_l * zone_size
-                img_array = np.zeros((full_h, full_w), dtype=np.uint16)
-                
-                idx = 0
-                for zy in range(z_l):
-                    for zx in range(z_w):
-                        start_x, start_y = zx * zone_size, zy * zone_size
-                        zone_data = raw_data[idx : idx + (zone_size * zone_size)]
-                        if zone_data.size == (zone_size * zone_size):
-                            img_array[start_y:start_y+zone_size, start_x:start_x+zone_size] = \
-                                zone_data.reshape((zone_size, zone_size))
-                        idx += (zone_size * zone_size)
+            if path.lower().endswith((".hg2", ".hgt")):
+                # HGT zone counts come from the sibling TRN if available
+                with HG2File(path, self.hg2_target_zw.get(), self.hg2_target_zl.get()) as hg:
+                    img_array = hg.detile()
             else:
                 raise ValueError("Unsupported input format for HG2/HGT conversion.")
 
-            out_path = os.path.splitext(path)[0] + "_edit.png"
+            fmt = self.hg2_export_formats.get(self.hg2_export_format.get(), ".png")
+            out_path = os.path.splitext(path)[0] + "_edit" + fmt
             
             if self.hg2img_compat.get():
+                out_path = os.path.splitext(path)[0] + "_edit.png"
                 # HG2IMG legacy mode: 12-bit heights in RG, vertical flip
                 h = (img_array & 0x0FFF).astype(np.uint16)
                 h = np.flipud(h)
@@ -1583,156 +4158,245 @@ class BZ98TRNArchitect:
                 else:
                     img_array = (img_array & 0x0FFF).astype(np.uint16)
                     img_array = (np.clip(img_array, 0, 4095).astype(np.uint32) * 16).astype(np.uint16)
-                out_img = Image.fromarray(img_array).convert("I;16")
-                out_img.save(out_path)
-                self.log(f"Success: Converted ({out_img.width}x{out_img.height})", "success")
+                if RawHeightmap.is_raw(out_path):
+                    RawHeightmap.write(out_path, img_array)
+                else:
+                    Image.fromarray(img_array).convert("I;16").save(out_path)
+                self.log(f"Success: Converted to {os.path.basename(out_path)} ({img_array.shape[1]}x{img_array.shape[0]})", "success")
         except Exception as e:
             self.log(f"Error: Conversion failed: {e}", "error")
         finally:
             self.root.after(0, lambda: self.btn_hg2_png.config(text="HG2 -> PNG", state="normal"))
 
+    def stitch_hg2_tiles(self):
+        paths = filedialog.askopenfilenames(title="Select HG2/HGT Tiles (sorted by name, row by row)",
+                                            filetypes=[("Heightfields", "*.hg2 *.hgt")])
+        if not paths: return
+        paths = sorted(paths)
+        cols = simpledialog.askinteger("Stitch Tiles", f"{len(paths)} tiles selected.\nTiles per row:",
+                                       initialvalue=int(round(math.sqrt(len(paths)))), minvalue=1, maxvalue=len(paths))
+        if not cols: return
+        if len(paths) % cols:
+            messagebox.showerror("Stitch Tiles", f"{len(paths)} tiles do not fill rows of {cols}.")
+            return
+        ext = os.path.splitext(paths[0])[1].lower()
+        out_path = filedialog.asksaveasfilename(defaultextension=ext, initialdir=os.path.dirname(paths[0]),
+                                                filetypes=[("Heightfield", "*" + ext)])
+        if not out_path: return
+        grid = [paths[i:i + cols] for i in range(0, len(paths), cols)]
+        threading.Thread(target=self._zone_tool_worker, args=("Stitched", HG2ZoneTools.stitch, grid, out_path),
+                         kwargs={"incremental": self.hg2_incremental.get()}, daemon=True).start()
+
+    def crop_hg2_zones(self):
+        path = self.hg2_path.get()
+        if not path or not path.lower().endswith((".hg2", ".hgt")) or not os.path.exists(path):
+            messagebox.showerror("Crop Zones", "Select an HG2/HGT file first.")
+            return
+        try:
+            with HG2File(path) as hg:
+                zw, zl = hg.zw, hg.zl
+        except Exception as e:
+            messagebox.showerror("Crop Zones", str(e))
+            return
+        text = simpledialog.askstring("Crop Zones", f"Map is {zw}x{zl} zones.\nZone rectangle (x0 z0 x1 z1, end exclusive):",
+                                      initialvalue=f"0 0 {max(1, zw // 2)} {max(1, zl // 2)}")
+        if not text: return
+        try:
+            zx0, zy0, zx1, zy1 = [int(v) for v in text.replace(",", " ").split()]
+        except ValueError:
+            messagebox.showerror("Crop Zones", "Enter four zone numbers: x0 z0 x1 z1")
+            return
+        base, ext = os.path.splitext(path)
+        out_path = f"{base}_crop_{zx0}_{zy0}_{zx1}_{zy1}{ext}"
+        threading.Thread(target=self._zone_tool_worker, args=("Cropped", HG2ZoneTools.crop, path, out_path, zx0, zy0, zx1, zy1),
+                         kwargs={"incremental": self.hg2_incremental.get()}, daemon=True).start()
+
+    def _zone_tool_worker(self, verb, func, *args, **kwargs):
+        try:
+            written, total = func(*args, **kwargs)
+            out_path = args[1]
+            self.log(f"Success: {verb} {os.path.basename(out_path)} ({written}/{total} zones written)", "success")
+            if out_path.lower().endswith(".hgt"):
+                self.log("HGT has no header: set Width/Depth in the matching TRN to the new zone counts x 1280.", "warning")
+        except Exception as e:
+            self.log(f"Error: {verb} output failed: {e}", "error")
+
     def convert_png_to_hg2(self):
         path = self.hg2_path.get()
         if not path or not os.path.exists(path): return
         
-        cfg = {
+        cfg = self._hg2_export_cfg(path)
+        self.btn_png_hg2.config(text="CONVERTING...", state="disabled")
+        threading.Thread(target=self._convert_png_to_hg2_worker, args=(cfg,), daemon=True).start()
+
+    def export_hg2_pyramid(self):
+        path = self.hg2_path.get()
+        if not path or not os.path.exists(path): return
+
+        cfg = self._hg2_export_cfg(path)
+        self.btn_hg2_lod.config(text="EXPORTING...", state="disabled")
+        threading.Thread(target=self._export_hg2_pyramid_worker, args=(cfg,), daemon=True).start()
+
+    def _hg2_export_cfg(self, path):
+        return {
             "path": path,
             "zw": getattr(self, 'hg2_target_zw', tk.IntVar(value=8)).get(),
             "zl": getattr(self, 'hg2_target_zl', tk.IntVar(value=8)).get(),
             "brightness": self.hg2_brightness.get() if hasattr(self, 'hg2_brightness') else 1.0,
             "contrast": self.hg2_contrast.get() if hasattr(self, 'hg2_contrast') else 1.0,
-            "smooth": self.hg2_smooth_val.get() if hasattr(self, 'hg2_smooth_val') else 0
+            "smooth": self.hg2_smooth_val.get() if hasattr(self, 'hg2_smooth_val') else 0,
+            "hgt": self.hgt_output.get(),
+            "incremental": self.hg2_incremental.get(),
+            "dither": self.dither_modes.get(self.hg2_dither.get(), "none"),
+            "hgz": self.hgz_cache.get(),
+            "keep_flags": self.hg2_keep_flags.get(),
+            "legacy": self.hg2img_compat.get(),
+            "precision": self.hg2img_precision.get()
         }
-        self.btn_png_hg2.config(text="CONVERTING...", state="disabled")
-        threading.Thread(target=self._convert_png_to_hg2_worker, args=(cfg,), daemon=True).start()
+
+    def _decode_height_source(self, cfg):
+        """Decodes the source image once into 16-bit (0-65535) heights. Returns (src, legacy_png)."""
+        if RawHeightmap.is_raw(cfg["path"]):
+            # Memory-mapped straight into the zone encoder, nothing is decoded up front
+            return RawHeightmap.open_height16(cfg["path"]), False
+        img = Image.open(cfg["path"])
+        legacy_png = cfg["legacy"] and img.mode not in ("I;16", "I;16B", "I;16L", "I")
+        if legacy_png:
+            # HG2IMG legacy PNG: 8-bit RG, vertically flipped. Always 12-bit heights.
+            img = img.convert("RGBA")
+            r = np.array(img.getchannel("R")).astype(np.uint16)
+            g = np.array(img.getchannel("G")).astype(np.uint16)
+            del img
+            use_precision = cfg["precision"]
+            if use_precision and r.max() > 15:
+                self.log("HG2IMG precision disabled: R channel exceeds 0-15 (treating as green-only).", "warning")
+                use_precision = False
+            if use_precision:
+                h = (g << 4) | (r & 0x0F)
+            else:
+                h = (g << 4)
+            del r, g
+            # Apply adjusters in 16-bit space for consistency (flip is a view, no copy)
+            h <<= 4
+            return np.flipud(h), True
+        # Lossless 16-bit PNG/TIFF -> 13-bit (HG2) or 12-bit (HGT)
+        img.close()
+        return load_height16(cfg["path"]), False
 
     def _convert_png_to_hg2_worker(self, cfg):
         try:
-            # 1. Load the PNG
-            img = Image.open(cfg["path"])
-            img_mode = img.mode
-            
-            # 2. Dynamic Dimensions Calculation
             z_w = cfg["zw"]
             z_l = cfg["zl"]
-            
-            # Calculate zone_size based on image width and number of zones
-            # This prevents the 512 -> 2048 scaling issue
             if z_w <= 0 or z_l <= 0:
                 raise ValueError("Invalid zone dimensions.")
-            if img.width % z_w != 0 or img.height % z_l != 0:
-                raise ValueError("Image size is not divisible by zone dimensions.")
-            zone_size = img.width // z_w
-            if zone_size != (img.height // z_l):
-                raise ValueError("Non-square zones detected. Check image size and zone dimensions.")
-            
-            # Determine depth for the HG2 header (2^depth = zone_size)
-            # e.g., 64px = depth 6, 128px = depth 7, 256px = depth 8
-            depth = int(math.log2(zone_size))
-            if 2**depth != zone_size:
-                raise ValueError("Zone size must be a power of two.")
-            
-            legacy_png = self.hg2img_compat.get() and img_mode not in ("I;16", "I;16B", "I;16L", "I")
 
-            if legacy_png:
-                # HG2IMG legacy PNG: 8-bit RG, vertically flipped
-                img = img.convert("RGBA")
-                arr = np.array(img).astype(np.uint8)
-                r = arr[..., 0].astype(np.uint16)
-                g = arr[..., 1].astype(np.uint16)
-                use_precision = self.hg2img_precision.get()
-                if use_precision and r.max() > 15:
-                    self.log("HG2IMG precision disabled: R channel exceeds 0-15 (treating as green-only).", "warn")
-                    use_precision = False
-                if use_precision:
-                    h = (g << 4) | (r & 0x0F)
-                else:
-                    h = (g << 4)
-                h = np.flipud(h)
-                
-                # Apply adjusters in 16-bit space for consistency
-                arr16 = (h.astype(np.float32) * 16.0)  # 0-65520
-                arr16 *= cfg["brightness"]
-                mean = 32768.0
-                arr16 = (arr16 - mean) * cfg["contrast"] + mean
-                
-                if cfg["smooth"] > 0:
-                    img_proc = Image.fromarray((arr16 / 256).astype(np.uint8)).convert("RGB")
-                    img_proc = img_proc.filter(ImageFilter.GaussianBlur(cfg["smooth"]))
-                    arr16 = np.array(img_proc.convert("L")).astype(np.float32) * 256
-                
-                img_final_arr = np.clip((arr16 / 16.0), 0, 4095).astype(np.uint16)
-                img_final_arr = img_final_arr & 0x0FFF
-            else:
-                # Lossless 16-bit PNG
-                img = img.convert("I;16")
-                arr = np.array(img).astype(np.float32)
-                arr *= cfg["brightness"]
-                mean = 32768.0
-                arr = (arr - mean) * cfg["contrast"] + mean
-                
-                # Smoothing fix for Pillow mode compatibility
-                if cfg["smooth"] > 0:
-                    img_proc = Image.fromarray((arr / 256).astype(np.uint8)).convert("RGB")
-                    img_proc = img_proc.filter(ImageFilter.GaussianBlur(cfg["smooth"]))
-                    img_final_arr = np.array(img_proc.convert("L")).astype(np.float32) * 256
-                else:
-                    img_final_arr = arr
+            # 1. Decode once into a 16-bit (0-65535) source; everything after this works per zone row
+            src, legacy_png = self._decode_height_source(cfg)
+            src_h, src_w = src.shape
 
-                # Scale to 13-bit (HG2) or 12-bit (HGT) and mask
-                if self.hgt_output.get():
-                    img_final_arr = (img_final_arr.astype(np.uint32) // 16)
-                    img_final_arr = np.clip(img_final_arr, 0, 4095).astype(np.uint16)
-                    img_final_arr = img_final_arr & 0x0FFF
-                else:
-                    img_final_arr = (img_final_arr.astype(np.uint32) // 8)
-                    img_final_arr = np.clip(img_final_arr, 0, 8191).astype(np.uint16)
-                    img_final_arr = img_final_arr & 0x1FFF
+            # 2. Zone size: HGT is fixed at 128, HG2 takes the power of two nearest to the
+            # source pixels per zone (this prevents the 512 -> 2048 scaling issue)
+            # e.g., 64px = depth 6, 128px = depth 7, 256px = depth 8
+            zone_size = HG2File.HGT_ZONE if cfg["hgt"] else HeightmapResampler.zone_size_for(src_w, z_w)
+            depth = int(math.log2(zone_size))
+            out_w, out_h = z_w * zone_size, z_l * zone_size
+            if (src_w, src_h) != (out_w, out_h):
+                # Resized a zone row at a time as the exporter reads it, not as one full-size float copy
+                self.log(f"Resampling {src_w}x{src_h} -> {out_w}x{out_h} ({zone_size}px zones)", "warning")
+                src = ResampledHeights(src, out_w, out_h)
+            bits = 12 if (legacy_png or cfg["hgt"]) else 13
 
-            h, w = img_final_arr.shape 
-            
-            if self.hgt_output.get():
-                # HGT output: 128x128 zones, no header. Flags are zeroed.
-                if zone_size != 128:
-                    raise ValueError("HGT requires 128x128 zones. Adjust map size/preset.")
-                hgt_data = (img_final_arr & 0x0FFF).astype(np.uint16)
-                output_data = bytearray()
-                for zy in range(z_l):
-                    for zx in range(z_w):
-                        zone = hgt_data[zy*zone_size : (zy+1)*zone_size, zx*zone_size : (zx+1)*zone_size]
-                        output_data.extend(zone.tobytes())
+            # 3. Stream zone rows straight to disk
+            if cfg["hgt"]:
+                # HGT output: 128x128 zones, no header. Flags are re-merged from the
+                # source HGT (or the previous export) unless keep_flags is off.
                 out_path = cfg["path"].rsplit('.', 1)[0] + "_export.hgt"
-                with open(out_path, "wb") as f:
-                    f.write(output_data)
-                self.log(f"Success: Exported {z_w}x{z_l} HGT", "success")
+                flags = self._find_flag_source(cfg, out_path, z_w, z_l, zone_size)
+                written, total = HG2Exporter.write(src, out_path, zone_size, cfg, bits, flags=flags)
+                self.log(f"Success: Exported {z_w}x{z_l} HGT ({written}/{total} zones written)", "success")
+                if cfg["hgz"]:
+                    self._write_hgz_cache(out_path, z_w, z_l)
             else:
-                # 6. Construct 12-byte HG2 Header using the calculated depth
+                # Construct 12-byte HG2 Header using the calculated depth
                 # Format: version, depth, width_zones, length_zones, map_version(low), map_version(high)/padding
                 # BZMapIO.py uses a 4-byte integer '10' for the last chunk.
                 # My previous code used 10 for the first 2 bytes and 0 for padding.
                 # struct.pack("<I") of 10 is b'\x0A\x00\x00\x00'
                 # struct.pack("<HH") of (10, 0) is b'\x0A\x00\x00\x00'
                 # So (10, 0) is identical to BZMapIO's implementation.
-                header = struct.pack("<HHHHHH", 1, depth, z_w, z_l, 10, 0)
-                
-                # 7. Pack data into zones
-                output_data = bytearray()
-                for zy in range(z_l):
-                    for zx in range(z_w):
-                        zone = img_final_arr[zy*zone_size : (zy+1)*zone_size, zx*zone_size : (zx+1)*zone_size]
-                        output_data.extend(zone.tobytes())
-                
+                header = HG2Codec.HEADER.pack(1, depth, z_w, z_l, 10, 0)
                 out_path = cfg["path"].rsplit('.', 1)[0] + "_export.hg2"
-                with open(out_path, "wb") as f:
-                    f.write(header)
-                    f.write(output_data)
-                        
-                self.log(f"Success: Exported {z_w}x{z_l} HG2 (Zone Size: {zone_size})", "success")
+                flags = self._find_flag_source(cfg, out_path, z_w, z_l, zone_size)
+                written, total = HG2Exporter.write(src, out_path, zone_size, cfg, bits, header=header, flags=flags)
+                self.log(f"Success: Exported {z_w}x{z_l} HG2 (Zone Size: {zone_size}, {written}/{total} zones written)", "success")
+                if cfg["hgz"]:
+                    self._write_hgz_cache(out_path)
             
         except Exception as e:
             self.log(f"Error: Failed to save HG2: {e}", "error")
         finally:
             self.root.after(0, lambda: self.btn_png_hg2.config(text="PNG -> HG2", state="normal"))
+
+    def _find_flag_source(self, cfg, out_path, zw, zl, zone):
+        """Flags to re-merge: the HG2/HGT this PNG was made from (name_edit.png -> name.hg2), else the previous export."""
+        if not cfg["keep_flags"]:
+            return None
+        base = os.path.splitext(cfg["path"])[0]
+        candidates = []
+        if base.endswith("_edit"):
+            candidates.append(base[:-len("_edit")] + os.path.splitext(out_path)[1])
+        candidates.append(out_path)
+        for path in candidates:
+            if not os.path.exists(path):
+                continue
+            try:
+                flags = HG2Exporter.open_flags(path, out_path, zw, zl, zone)
+            except Exception as e:
+                self.log(f"Flags not taken from {os.path.basename(path)}: {e}", "warning")
+                continue
+            if flags is not None:
+                self.log(f"Re-merging flag bits from {os.path.basename(path)}")
+                return flags
+            self.log(f"Flags not taken from {os.path.basename(path)}: different format or zone grid", "warning")
+        return None
+
+    def _write_hgz_cache(self, path, zw=None, zl=None):
+        t0 = time.perf_counter()
+        packed, raw = HGZFile.write(path, zw=zw, zl=zl)
+        self.log(f"  {os.path.basename(HGZFile.path_for(path))}: {packed / 1024.0:.1f} KB "
+                 f"({100.0 * packed / max(raw, 1):.1f}% of raw, {time.perf_counter() - t0:.2f}s)")
+
+    def _export_hg2_pyramid_worker(self, cfg):
+        """Depth 6/7/8 HG2s plus a 128-zone HGT from a single decode (area-averaged pyramid)."""
+        try:
+            z_w = cfg["zw"]
+            z_l = cfg["zl"]
+            if z_w <= 0 or z_l <= 0:
+                raise ValueError("Invalid zone dimensions.")
+
+            src, legacy_png = self._decode_height_source(cfg)
+            src_zone = src.shape[1] / z_w
+            levels = HeightmapResampler.pyramid(src, z_w, z_l, HeightmapResampler.LOD_DEPTHS)
+            del src
+
+            base = cfg["path"].rsplit('.', 1)[0]
+            outputs = [(f"{base}_export_d{d}.hg2", d, 12 if legacy_png else 13) for d in HeightmapResampler.LOD_DEPTHS]
+            outputs.append((base + "_export.hgt", 7, 12))
+            for out_path, depth, bits in outputs:
+                zone_size = 2**depth
+                # Smoothing radius is in source pixels; scale it so every level gets the same blur in meters
+                level_cfg = dict(cfg, smooth=cfg["smooth"] * zone_size / src_zone)
+                header = None if out_path.endswith(".hgt") else HG2Codec.HEADER.pack(1, depth, z_w, z_l, 10, 0)
+                written, total = HG2Exporter.write(levels[depth], out_path, zone_size, level_cfg, bits, header=header)
+                self.log(f"  {os.path.basename(out_path)}: {z_w * zone_size}x{z_l * zone_size} ({written}/{total} zones written)")
+                if cfg["hgz"]:
+                    self._write_hgz_cache(out_path, z_w, z_l)
+            self.log(f"Success: Exported LOD set for {z_w}x{z_l} zones", "success")
+
+        except Exception as e:
+            self.log(f"Error: LOD export failed: {e}", "error")
+        finally:
+            self.root.after(0, lambda: self.btn_hg2_lod.config(text="Export LOD Set (d6/d7/d8 + HGT)", state="normal"))
         
     # --- THE MISSING METHOD ---
     def create_fine_tune_slider(self, parent, label, var, from_, to, res=1.0, tip=None, command=None):
@@ -2266,7 +4930,8 @@ class BZ98TRNArchitect:
             "name": name,
             "world": self.stock_world_type.get(),
             "zones": zones,
-            "out_dir": out_dir
+            "out_dir": out_dir,
+            "hgz": self.hgz_cache.get()
         }
         
         self.btn_stock_gen.config(text="GENERATING...", state="disabled")
@@ -2286,7 +4951,7 @@ class BZ98TRNArchitect:
             zone_res = 128
             
             # Header: version(1), depth, x_zones, z_zones, 10, 0
-            header = struct.pack("<HHHHHH", 1, depth, zones, zones, 10, 0)
+            header = HG2Codec.HEADER.pack(1, depth, zones, zones, 10, 0)
             
             # Create flat data (mid-grey or 0?) BZ1 usually 0 is bottom.
             # Let's use 0 for flat ground.
@@ -2296,12 +4961,9 @@ class BZ98TRNArchitect:
             hg2_path = os.path.join(out_dir, f"{name}.hg2")
             with open(hg2_path, "wb") as f:
                 f.write(header)
-                # Pack data zone by zone
-                for zy in range(zones):
-                    for zx in range(zones):
-                        # Extract chunk (all zeros here)
-                        chunk = flat_data[zy*zone_res:(zy+1)*zone_res, zx*zone_res:(zx+1)*zone_res]
-                        f.write(chunk.tobytes())
+                HG2Codec.encode_zones(flat_data, zone_res).tofile(f)
+            if cfg["hgz"]:
+                self._write_hgz_cache(hg2_path)
 
             # 2. Generate TRN File
             trn_path = os.path.join(out_dir, f"{name}.trn")
@@ -2463,6 +5125,8 @@ class BZ98TRNArchitect:
         preset_menu = ttk.Combobox(hg2_frame, textvariable=self.preset_var, values=self.map_presets, state="readonly")
         preset_menu.pack(fill="x", pady=5)
         preset_menu.bind("<<ComboboxSelected>>", self.apply_map_preset)
+        self.hg2_index_info = ttk.Label(hg2_frame, text="", font=(self.custom_font_name, 8), foreground=BZ_CYAN, justify="left")
+        self.hg2_index_info.pack(anchor="w")
 
         # Manual Dimension Controls
         dim_frame = ttk.Frame(hg2_frame)
@@ -2476,13 +5140,44 @@ class BZ98TRNArchitect:
         
         ttk.Label(hg2_frame, text="*Must be multiples of 1280", font=(self.custom_font_name, 7, "italic"), foreground="#666666").pack(anchor="w")
 
-        self.create_hg2_slider(hg2_frame, "Brightness:", self.hg2_brightness, 0.1, 2.0, 0.1)
-        self.create_hg2_slider(hg2_frame, "Contrast:", self.hg2_contrast, 0.1, 2.0, 0.1)
+        self.create_hg2_slider(hg2_frame, "Brightness:", self.hg2_brightness, 0.1, 2.0, 0.01)
+        self.create_hg2_slider(hg2_frame, "Contrast:", self.hg2_contrast, 0.1, 2.0, 0.01)
         self.create_hg2_slider(hg2_frame, "Smoothing:", self.hg2_smooth_val, 0, 10, 1)
+
+        levels_frame = ttk.Frame(hg2_frame)
+        levels_frame.pack(fill="x", pady=(0, 5))
+        levels_menu = ttk.Combobox(levels_frame, textvariable=self.hg2_levels_preset,
+                                   values=list(self.level_presets), state="readonly", width=22)
+        levels_menu.pack(side="left", fill="x", expand=True)
+        levels_menu.bind("<<ComboboxSelected>>", self.auto_levels)
+        ttk.Button(levels_frame, text="Auto-Levels", command=self.auto_levels).pack(side="left", padx=(5, 0))
         
         ttk.Checkbutton(hg2_frame, text="HG2IMG Legacy PNG (8-bit RG, flipped)", variable=self.hg2img_compat).pack(anchor="w", pady=(4, 0))
         ttk.Checkbutton(hg2_frame, text="HG2IMG Precision (use R low bits)", variable=self.hg2img_precision).pack(anchor="w")
         ttk.Checkbutton(hg2_frame, text="Output HGT (legacy format)", variable=self.hgt_output).pack(anchor="w")
+        ttk.Checkbutton(hg2_frame, text="Incremental save (rewrite changed zones only)", variable=self.hg2_incremental).pack(anchor="w")
+        flags_check = ttk.Checkbutton(hg2_frame, text="Preserve flag bits from source HG2/HGT", variable=self.hg2_keep_flags)
+        flags_check.pack(anchor="w")
+        ToolTip(flags_check, "Re-merges the upper (flag) bits from name.hg2 for name_edit.png, else from the previous export")
+        hgz_check = ttk.Checkbutton(hg2_frame, text="Write .hgz archive cache (fast loads)", variable=self.hgz_cache)
+        hgz_check.pack(anchor="w")
+        ToolTip(hgz_check, "Compressed per-zone sidecar; used automatically while it matches the exported file")
+
+        dither_frame = ttk.Frame(hg2_frame)
+        dither_frame.pack(fill="x", pady=(4, 0))
+        ttk.Label(dither_frame, text="Dithering:").pack(side="left")
+        dither_menu = ttk.Combobox(dither_frame, textvariable=self.hg2_dither,
+                                   values=list(self.dither_modes), state="readonly")
+        dither_menu.pack(side="left", fill="x", expand=True, padx=(5, 0))
+        ToolTip(dither_menu, "Breaks up terracing on gentle slopes when quantizing to 12/13-bit")
+
+        format_frame = ttk.Frame(hg2_frame)
+        format_frame.pack(fill="x", pady=(4, 0))
+        ttk.Label(format_frame, text="HG2 -> Image as:").pack(side="left")
+        format_menu = ttk.Combobox(format_frame, textvariable=self.hg2_export_format,
+                                   values=list(self.hg2_export_formats), state="readonly")
+        format_menu.pack(side="left", fill="x", expand=True, padx=(5, 0))
+        ToolTip(format_menu, "Output of HG2 -> PNG when HG2IMG Legacy is off")
 
         hg2_btn_frame = ttk.Frame(hg2_frame)
         hg2_btn_frame.pack(fill="x", pady=5)
@@ -2492,6 +5187,15 @@ class BZ98TRNArchitect:
         self.btn_png_hg2 = ttk.Button(hg2_btn_frame, text="PNG -> HG2", style="Action.TButton",
                   command=self.convert_png_to_hg2)
         self.btn_png_hg2.pack(side="left", expand=True, fill="x", padx=(2,0))
+        self.btn_hg2_lod = ttk.Button(hg2_frame, text="Export LOD Set (d6/d7/d8 + HGT)",
+                  command=self.export_hg2_pyramid)
+        self.btn_hg2_lod.pack(fill="x")
+        ToolTip(self.btn_hg2_lod, "Resamples the source once and writes _export_d6/d7/d8.hg2 and _export.hgt")
+
+        zone_tools_frame = ttk.Frame(hg2_frame)
+        zone_tools_frame.pack(fill="x", pady=(5, 0))
+        ttk.Button(zone_tools_frame, text="Stitch Tiles...", command=self.stitch_hg2_tiles).pack(side="left", expand=True, fill="x", padx=(0,2))
+        ttk.Button(zone_tools_frame, text="Crop Zones...", command=self.crop_hg2_zones).pack(side="left", expand=True, fill="x", padx=(2,0))
         
         wm_frame = ttk.LabelFrame(left_panel, text=" World Machine Workflow ", padding=10)
         wm_frame.pack(fill="x", pady=10)
@@ -2504,6 +5208,8 @@ class BZ98TRNArchitect:
 
         self.hg2_preview_canvas = tk.Canvas(right_panel, bg="#050505", highlightthickness=0)
         self.hg2_preview_canvas.pack(expand=True, fill="both", padx=10, pady=10)
+        self.hg2_preview_worker = PreviewWorker(self.root, self._render_hg2_preview,
+                                                 self._show_hg2_preview, self._report_hg2_preview)
 
     def setup_sky_tab(self):
         container = ttk.Frame(self.tab_sky, padding=20)
@@ -2559,6 +5265,42 @@ class BZ98TRNArchitect:
                 size = int(match.group(1))
                 self.hg2_width_meters.set(size)
                 self.hg2_depth_meters.set(size)
+                if size % 1280 == 0:
+                    self.hg2_target_zw.set(size // 1280)
+                    self.hg2_target_zl.set(size // 1280)
+
+    def auto_levels(self, event=None):
+        """Set brightness/contrast from the height histogram (computed once per file version)."""
+        path = self.hg2_path.get()
+        if not path or not os.path.exists(path): return
+        clip = self.level_presets.get(self.hg2_levels_preset.get())
+        if clip is None:
+            self._apply_levels(1.0, 1.0)
+            return
+        args = (path, self.hg2_target_zw.get(), self.hg2_target_zl.get(), clip)
+        threading.Thread(target=self._auto_levels_worker, args=args, daemon=True).start()
+
+    def _auto_levels_worker(self, path, zw, zl, clip):
+        try:
+            stats = HeightmapCache.stats(HEIGHTMAP_CACHE.get(path, zw, zl))
+            summary = stats.region()
+            lo, hi = HeightStats.levels(summary["hist"], clip)
+            step = 65536 >> stats.bits
+            brightness, contrast = HG2Exporter.levels_adjust(lo * step, (hi + 1) * step - 1)
+            brightness = min(2.0, max(0.1, brightness))
+            contrast = min(2.0, max(0.1, contrast))
+            used = (summary["max"] - summary["min"] + 1) / float(stats.bins)
+            self.log(f"Auto-levels: heights {summary['min']}-{summary['max']} use {used:.0%} of the "
+                     f"{stats.bits}-bit range; stretching {lo}-{hi} -> brightness {brightness:.2f}, contrast {contrast:.2f}")
+            self.root.after(0, lambda: self._apply_levels(brightness, contrast))
+        except Exception as e:
+            self.log(f"Auto-levels failed: {e}", "error")
+
+    def _apply_levels(self, brightness, contrast):
+        self.hg2_brightness.set(round(brightness, 2))
+        self.hg2_contrast.set(round(contrast, 2))
+        self.update_hg2_preview()
+
     def create_hg2_slider(self, parent, label, var, from_, to, res):
         """Helper to create sliders that trigger the preview update"""
         ttk.Label(parent, text=label, font=(self.custom_font_name, 9)).pack(anchor="w")
@@ -2568,93 +5310,68 @@ class BZ98TRNArchitect:
         s.pack(fill="x", pady=(0, 8))
 
     def update_hg2_preview(self, *args):
+        """Snapshot the HG2 tab settings on the Tk thread and hand them to the preview worker."""
         path = self.hg2_path.get()
         if not path or not os.path.exists(path): return
 
+        cw = self.hg2_preview_canvas.winfo_width()
+        ch = self.hg2_preview_canvas.winfo_height()
+        if cw < 10: cw, ch = 600, 600
+
+        self.hg2_preview_worker.submit({
+            "path": path,
+            "zw": self.hg2_target_zw.get(),
+            "zl": self.hg2_target_zl.get(),
+            "brightness": self.hg2_brightness.get(),
+            "contrast": self.hg2_contrast.get(),
+            "smooth": self.hg2_smooth_val.get(),
+            "cw": cw, "ch": ch
+        })
+
+    def _render_hg2_preview(self, p, cancelled):
+        """Preview worker: builds the thumbnail off the Tk thread. Returns None if superseded."""
         try:
-            if path.lower().endswith(".hg2"):
-                with open(path, "rb") as f:
-                    header = f.read(12)
-                    _, depth, x_zones, z_zones, _, _ = struct.unpack("<HHHHHH", header)
-                    z_width = 2**depth
-                    raw_data = np.frombuffer(f.read(), dtype=np.uint16)
-                    
-                    full_w, full_h = x_zones * z_width, z_zones * z_width
-                    arr = np.zeros((full_h, full_w), dtype=np.float32)
-                    
-                    idx = 0
-                    for zy in range(z_zones):
-                        for zx in range(x_zones):
-                            zone_size = z_width * z_width
-                            zone_block = raw_data[idx:idx+zone_size].reshape((z_width, z_width))
-                            arr[zy*z_width:(zy+1)*z_width, zx*z_width:(zx+1)*z_width] = zone_block
-                            idx += zone_size
-            elif path.lower().endswith(".hgt"):
-                zone_size = 128
-                x_zones = self.hg2_target_zw.get()
-                z_zones = self.hg2_target_zl.get()
-                
-                # Try TRN if available
-                trn_path = os.path.splitext(path)[0] + ".trn"
-                trn = TRNParser.parse(trn_path)
-                if trn.get("Width") and trn.get("Depth"):
-                    zw = int(round(trn["Width"] / 1280.0))
-                    zl = int(round(trn["Depth"] / 1280.0))
-                    if zw > 0 and zl > 0:
-                        x_zones, z_zones = zw, zl
-                
-                with open(path, "rb") as f:
-                    raw_data = np.frombuffer(f.read(), dtype=np.uint16)
-                
-                expected = x_zones * z_zones * zone_size * zone_size
-                if raw_data.size != expected:
-                    raise ValueError(f"Invalid HGT size. Expected {expected} entries, got {raw_data.size}.")
-                
-                full_w, full_h = x_zones * zone_size, z_zones * zone_size
-                arr = np.zeros((full_h, full_w), dtype=np.float32)
-                
-                idx = 0
-                for zy in range(z_zones):
-                    for zx in range(x_zones):
-                        zone_block = raw_data[idx:idx+(zone_size*zone_size)].reshape((zone_size, zone_size))
-                        arr[zy*zone_size:(zy+1)*zone_size, zx*zone_size:(zx+1)*zone_size] = zone_block
-                        idx += zone_size * zone_size
-            else:
-                img_input = Image.open(path).convert("I;16")
-                arr = np.array(img_input).astype(np.float32)
+            # Decoded once per file version; adjusters run on a canvas-sized proxy.
+            # HGT zone counts come from the sibling TRN if available.
+            entry = HEIGHTMAP_CACHE.get(p["path"], p["zw"], p["zl"])
+            proxy, factor = HeightmapCache.proxy(entry, p["cw"], p["ch"])
+            stats = HeightmapCache.stats(entry)
+            if cancelled(): return None
 
             # Apply Adjusters
-            arr *= self.hg2_brightness.get()
-            mean = 32768.0
-            arr = (arr - mean) * self.hg2_contrast.get() + mean
-            
-            # High-precision blur in Mode F (prevents banding)
-            temp_img = Image.fromarray(arr, mode='F')
-            if self.hg2_smooth_val.get() > 0:
-                temp_img = temp_img.filter(ImageFilter.GaussianBlur(self.hg2_smooth_val.get()))
+            arr = HG2Exporter.adjust(proxy, p["brightness"], p["contrast"])
             
-            final_arr = np.array(temp_img)
+            # High-precision float32 blur (prevents banding), radius scaled to the proxy
+            final_arr = arr
+            if p["smooth"] > 0:
+                final_arr = HeightmapFilters.gaussian_smooth(arr, p["smooth"] / factor)
+            if cancelled(): return None
             
-            # Better Normalization for UI (prevents stepping/banding)
-            f_min, f_max = final_arr.min(), final_arr.max()
+            # Normalize with the stored height range (adjust is linear, so no min/max pass)
+            src_range = np.array(stats.source_range(), dtype=np.float32)
+            f_min, f_max = HG2Exporter.adjust(src_range, p["brightness"], p["contrast"])
             if f_max > f_min:
-                norm_arr = (final_arr - f_min) / (f_max - f_min)
+                norm_arr = np.clip((final_arr - f_min) / (f_max - f_min), 0.0, 1.0)
             else:
-                norm_arr = final_arr / 65535.0
+                norm_arr = np.clip(final_arr / 65535.0, 0.0, 1.0)
                 
             preview_8bit = Image.fromarray((norm_arr * 255).astype(np.uint8))
             
-            cw = self.hg2_preview_canvas.winfo_width()
-            ch = self.hg2_preview_canvas.winfo_height()
-            if cw < 10: cw, ch = 600, 600
-            
-            preview_8bit.thumbnail((cw, ch), self.resample_method)
-            self.hg2_tk_photo = ImageTk.PhotoImage(preview_8bit)
-            self.hg2_preview_canvas.delete("all")
-            self.hg2_preview_canvas.create_image(cw//2, ch//2, image=self.hg2_tk_photo)
+            preview_8bit.thumbnail((p["cw"], p["ch"]), self.resample_method)
+            return preview_8bit, p["cw"], p["ch"]
             
         except Exception as e:
             print(f"Preview Update Error: {e}")
+            return None
+
+    def _show_hg2_preview(self, result):
+        preview_8bit, cw, ch = result
+        self.hg2_tk_photo = ImageTk.PhotoImage(preview_8bit)
+        self.hg2_preview_canvas.delete("all")
+        self.hg2_preview_canvas.create_image(cw//2, ch//2, image=self.hg2_tk_photo)
+
+    def _report_hg2_preview(self, latency_ms, dropped):
+        self.log(f"HG2 preview: {latency_ms:.0f} ms input-to-pixels ({dropped} stale renders dropped)", "timestamp")
 
     def bind_events(self):
         self.canvas.bind("<ButtonPress-1>", self.on_drag_start)
@@ -3398,11 +6115,8 @@ class BZ98TRNArchitect:
         try:
             if path.lower().endswith(".hg2"):
                 # HG2 Loading Logic (Visual)
-                with open(path, "rb") as f:
-                    header = f.read(12)
-                    _, _, z_w, z_l, _, _ = struct.unpack("<HHHHHH", header)
-                    raw_data = f.read()
-                    arr = np.frombuffer(raw_data, dtype=np.uint16).reshape((z_l*64, z_w*64))
+                with HG2File(path) as hg:
+                    arr = hg.detile()
                     # Normalize for display
                     arr_norm = (arr / 4095.0 * 255).astype(np.uint8)
                     img = Image.fromarray(arr_norm)
@@ -3472,55 +6186,20 @@ class BZ98TRNArchitect:
              
         mx, my, mw, mh = self.map_draw_rect
         
-        # Coordinate Space:
-        # Texture Map (0,0) -> (Width, Height) usually corresponds to World (MinX, MinZ) -> (MaxX, MaxZ)
-        # BZ Coords: +X (East), +Z (North).
-        # Image Coords: +X (Right), +Y (Down).
-        # So World Z maps to Image Y (inverted).
-        
-        # Assume Map Image covers the whole TRN area?
-        # If we parsed TRN MinX/MinZ, we can offset.
-        offset_x = getattr(self, 'min_x', 0)
-        offset_z = getattr(self, 'min_z', 0)
-        
-        # We need map dimensions in METERS to scale properly.
-        # HG2 -> 1px = ~10m? Or 20m? Depends on resolution.
-        # If we loaded an HG2, we know pixels. If we don't know grid step, we guess.
-        # Config has "tile_res" and "map_presets".
-        # Let's assume the loaded image represents the full square world.
-        # World Size?
+        # Assume the map image covers the whole square world of the selected preset, from the TRN MinX/MinZ.
         try:
              world_size = int(self.selected_preset.get().split('(')[1].split('m')[0])
         except:
              world_size = 5120
-             
-        # Scale Factor: Pixels per Meter
-        ppm = mw / world_size
+        bounds = (getattr(self, 'min_x', 0), getattr(self, 'min_z', 0), world_size, world_size)
         
-        for obj in self.mission_objects:
-            wx = obj["pos"][0]
-            wz = obj["pos"][2] # Z is height? No, pos=(x,h,z) from my parser
-             
-            # Normalize to 0-WorldSize based on offset
-            # Obj 0,0 is at World 0,0.
-            # Map Image 0,0 (Top Left) corresponds to World MinX, MaxZ (since Z goes up)
-            # Wait, BZ coordinates: 0,0 is center of specific map? Or corner?
-            # TRN Map:
-            # (MinX, MinZ) -> Bottom Left of the map?
-            # So Image (0, Height) -> (MinX, MinZ)
-            # Image (0, 0) -> (MinX, MaxZ)
-            
-            # Rel to Map Origin
-            rel_x = wx - offset_x
-            rel_z = wz - offset_z
-            
-            # Map to Image Pixels
-            # img_x = rel_x * ppm
-            # img_y = (world_size - rel_z) * ppm (Flip Z)
-            
-            # Canvas Coords
-            cx = mx + (rel_x * ppm)
-            cy = my + (mh - (rel_z * ppm)) # Flip Z for image Y 
+        # Same mapping as the PATH: masks. The background is the de-tiled HG2 as-is, so its top row is MinZ
+        # and objects must not be flipped either (pos is (x, y, z), y up).
+        pixels = PathMaskLayer.world_to_pixel([(obj["pos"][0], obj["pos"][2]) for obj in self.mission_objects], bounds, (mh, mw))
+        
+        for obj, (px, py) in zip(self.mission_objects, pixels):
+            cx = mx + px
+            cy = my + py
             
             # Draw
             color = BZ_GREEN
@@ -3542,6 +6221,7 @@ class BZ98TRNArchitect:
         if ext == ".trn":
             # Load TRN -> Auto-populate materials
             data = TRNParser.parse(path)
+            self.paint_variants = data["SolidVariants"]
             if not data.get("TextureTypes"):
                 messagebox.showwarning("Warning", "No [TextureTypeX] sections found in TRN.")
                 return